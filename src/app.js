@@ -1,4 +1,6 @@
 document.addEventListener('DOMContentLoaded', function () {
+  // Identifies this browser tab's session on the server
+  var sessionId = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : String(Date.now()) + Math.random().toString(16).slice(2);
   // Initialize CodeMirror
   var editor = CodeMirror.fromTextArea(document.getElementById("code"), {
     mode: "python",
@@ -13,24 +15,72 @@ document.addEventListener('DOMContentLoaded', function () {
     lineWrapping: true,
   });
 
+  // The last revision of the code acknowledged by the server, and its text.
+  // Edits are exchanged as line patches against this revision.
+  var documentRevision = 0;
+  var documentText = '';
+
+  function setDocument(revision, code) {
+    documentRevision = revision;
+    documentText = code;
+    editor.setValue(code);
+  }
+
+  // Fetch the full document from the server
+  function loadDocument() {
+    return fetch('http://127.0.0.1:5000/document', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'X-Session-Id': sessionId
+      },
+    }).then(response => response.json())
+      .then(result => {
+        setDocument(result['revision'], result['code']);
+      });
+  }
+
+  // 32-bit FNV-1a hash of the UTF-8 encoded text (mirrors `checksum` in code_document.py)
+  function checksum(text) {
+    var hash = 0x811c9dc5;
+    for (const byte of new TextEncoder().encode(text)) {
+      hash ^= byte;
+      hash = Math.imul(hash, 0x01000193) >>> 0;
+    }
+    return hash.toString(16);
+  }
+
+  // Smallest single-range line patch that turns oldText into newText (mirrors `make_patch`)
+  function makePatch(oldText, newText) {
+    var oldLines = oldText.split('\n');
+    var newLines = newText.split('\n');
+    var start = 0;
+    while (start < oldLines.length && start < newLines.length && oldLines[start] === newLines[start]) {
+      start++;
+    }
+    var oldEnd = oldLines.length;
+    var newEnd = newLines.length;
+    while (oldEnd > start && newEnd > start && oldLines[oldEnd - 1] === newLines[newEnd - 1]) {
+      oldEnd--;
+      newEnd--;
+    }
+    return { start: start, end: oldEnd, lines: newLines.slice(start, newEnd) };
+  }
+
+  function applyPatch(text, patch) {
+    var lines = text.split('\n');
+    lines.splice(patch.start, patch.end - patch.start, ...patch.lines);
+    return lines.join('\n');
+  }
+
   fetch('http://127.0.0.1:5000/reset', {
     method: 'POST',
     headers: {
-      'Content-Type': 'application/x-www-form-urlencoded'
+      'Content-Type': 'application/x-www-form-urlencoded',
+      'X-Session-Id': sessionId
     },
     body: ''
-  }).then(result => {
-    fetch('http://127.0.0.1:5000/get_code', {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/x-www-form-urlencoded'
-      },
-    }).then(response => response.text())
-      .then(result => {
-        editor.setValue(result)
-      }
-      )
-  })
+  }).then(result => loadDocument())
 
 
   // Event listener for executing the code
@@ -39,14 +89,15 @@ document.addEventListener('DOMContentLoaded', function () {
     fetch('http://127.0.0.1:5000/revert_code', {
       method: 'POST',
       headers: {
-        'Content-Type': 'application/x-www-form-urlencoded'
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'X-Session-Id': sessionId
       },
     })
       .then(response => response.json())
       .then(result => {
         console.log('Code reverted:', result['code']);
         // Handle the response/result as needed
-        editor.setValue(result['code']);
+        setDocument(result['revision'], result['code']);
         if ('message' in result) {
           addMessage(result['message'], false)
         }
@@ -88,49 +139,167 @@ document.addEventListener('DOMContentLoaded', function () {
   }
 
 
-  function handleUserMessage() {
+  function describeProgress(event) {
+    switch (event.kind) {
+      case 'controller_decision':
+        return 'Controller: ' + event.chain + ' (' + event.score + ') ' + event.instructions;
+      case 'skill_started':
+        return event.chain + ': ' + event.skill + ' started';
+      case 'skill_finished':
+        return event.chain + ': ' + event.skill + (event.is_error ? ' failed' : ' finished') + ' in ' + event.duration.toFixed(1) + 's';
+      case 'chain_skipped':
+        return event.chain + ': skipped, the previous step failed';
+      case 'sandbox_exited':
+        return 'Sandbox exited with code ' + event.returncode + ' after ' + event.duration.toFixed(1) + 's';
+      default:
+        return null;
+    }
+  }
+
+  // Submit a turn as a background job, follow its progress and resolve with the final response
+  function runJob(body) {
+    return fetch('http://127.0.0.1:5000/jobs', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'X-Session-Id': sessionId
+      },
+      body: JSON.stringify(body)
+    }).then(response => response.json().then(result => {
+      if (response.status !== 202) {
+        throw new Error(result['error']);
+      }
+      return result['job_id'];
+    })).then(jobId => new Promise(resolve => {
+      var progress = new EventSource('http://127.0.0.1:5000/jobs/' + jobId + '/events');
+      progress.onmessage = function (event) {
+        var line = describeProgress(JSON.parse(event.data));
+        if (line !== null) {
+          logs_console.replaceRange('\n' + line, { line: logs_console.lastLine() });
+          logs_console.scrollIntoView({ line: logs_console.lastLine(), char: 0 }, 100);
+        }
+      };
+      var fetchResult = function () {
+        progress.close();
+        resolve(fetch('http://127.0.0.1:5000/jobs/' + jobId, {
+          headers: { 'X-Session-Id': sessionId }
+        }));
+      };
+      progress.addEventListener('done', fetchResult);
+      progress.onerror = function () {
+        if (progress.readyState === EventSource.CLOSED) {
+          fetchResult();
+        }
+      };
+    }));
+  }
+
+  // Send the user message together with the editor changes since the last acknowledged revision
+  function postUserMessage(message, code, retry) {
+    return runJob({
+      message: message,
+      base_revision: documentRevision,
+      patch: makePatch(documentText, code),
+      checksum: checksum(code),
+    }).then(response => {
+      if (response.status === 409 && retry) {
+        // The server copy changed: rebase the editor contents on it and try again
+        return response.json().then(result => {
+          console.warn('Code conflict:', result['error']);
+          documentRevision = result['revision'];
+          documentText = result['code'];
+          return postUserMessage(message, code, false);
+        });
+      }
+      return response.json().then(result => ({ result: result, code: code }));
+    });
+  }
 
-    // Post the code in the editor to the server first
-    var code = editor.getValue(); // Assuming you have an initialized CodeMirror editor
+  // Number of user messages sent and not answered yet
+  var pendingMessages = 0;
 
+  // Send the editor changes once the user stops typing, so that the server analyses the code
+  // before it is asked to run or fix it. Messages carry the changes themselves.
+  var postCodeTimer = null;
+  function postCode() {
+    var code = editor.getValue();
+    if (pendingMessages > 0 || code === documentText) {
+      return;
+    }
     fetch('http://127.0.0.1:5000/post_code', {
       method: 'POST',
       headers: {
-        'Content-Type': 'application/x-www-form-urlencoded'
+        'Content-Type': 'application/json',
+        'X-Session-Id': sessionId
       },
-      body: 'code=' + encodeURIComponent(code)
-    })
-      .then(response => response.text())
-      .then(result => {
-        console.log('Code executed:', result);
-        // Handle the response/result as needed
+      body: JSON.stringify({
+        base_revision: documentRevision,
+        patch: makePatch(documentText, code),
+        checksum: checksum(code),
       })
-      .catch(error => {
-        console.error('Error executing code:', error);
-        // Handle the error
-      });
+    }).then(response => response.json().then(result => {
+      // On a conflict the next message rebases the changes
+      if (response.ok && pendingMessages === 0) {
+        documentRevision = result['revision'];
+        documentText = code;
+      }
+    })).catch(error => console.warn('Error posting code:', error));
+  }
+  editor.on('change', function () {
+    clearTimeout(postCodeTimer);
+    postCodeTimer = setTimeout(postCode, 1000);
+  });
+
+  // Stop the turn the server is running for this session, to answer a newer message instead
+  function cancelPendingMessages() {
+    if (pendingMessages === 0) {
+      return Promise.resolve();
+    }
+    return fetch('http://127.0.0.1:5000/cancel', {
+      method: 'POST',
+      headers: { 'X-Session-Id': sessionId }
+    }).catch(error => console.warn('Error cancelling the previous message:', error));
+  }
 
+  // Nobody is waiting for the answer anymore once the page is closed
+  window.addEventListener('pagehide', function () {
+    if (pendingMessages > 0 && navigator.sendBeacon) {
+      navigator.sendBeacon('http://127.0.0.1:5000/cancel?session_id=' + encodeURIComponent(sessionId));
+    }
+  });
+
+  function handleUserMessage() {
 
     var message = messageInput.value.trim();
     if (message !== '') {
       addMessage(message, true); // Add the user's message to the chat interface
       messageInput.value = ''; // Clear the input field
 
-      // Send the user message to the server
-      fetch('http://127.0.0.1:5000/handle_user_message', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/x-www-form-urlencoded'
-        },
-        body: 'message=' + encodeURIComponent(message)
-      })
-        .then(response => response.json())
-        .then(result => {
+      // Send the user message and the code in the editor to the server
+      cancelPendingMessages()
+        .then(() => {
+          pendingMessages += 1;
+          return postUserMessage(message, editor.getValue(), true)
+            .finally(() => { pendingMessages -= 1; });
+        })
+        .then(({ result, code }) => {
           // Handle the response from the server
           addMessage(result['message'], false); // Add the AI assistant's response to the chat interface
           logs_console.setValue(result['message'])
-          editor.setValue(result['code'])
-          console.log(result['code'])
+
+          if (editor.getValue() !== code) {
+            console.warn('The editor changed while the message was handled, applying the server changes anyway.');
+          }
+          if (result['patch'] === null) {
+            // The server no longer has our revision
+            return loadDocument();
+          }
+          var newCode = applyPatch(code, result['patch']);
+          if (checksum(newCode) !== result['checksum']) {
+            console.warn('Code checksum mismatch, reloading the document.');
+            return loadDocument();
+          }
+          setDocument(result['revision'], newCode);
 
           // reloadOnChange();
         })
@@ -143,12 +312,15 @@ document.addEventListener('DOMContentLoaded', function () {
 
   const logsSource = new EventSource('http://127.0.0.1:5000/latest_log_stream');
 
+  // A reset event replaces the log, other events are appended to it.
+  // The browser resumes from the last received event id when it reconnects.
+  logsSource.addEventListener('reset', function (event) {
+    logs_console.setValue(event.data);
+  });
+
   logsSource.onmessage = function (event) {
-    // Update the UI with the latest log message
-    var latestLogMessage = event.data.split('|').join('\n');
-    console.log(latestLogMessage);
-    // Process the latest log message as needed
-    logs_console.setValue(latestLogMessage);
+    console.log(event.data);
+    logs_console.replaceRange('\n' + event.data, { line: logs_console.lastLine() });
     // Scroll to the bottom of the logs_console
     logs_console.scrollIntoView({ line: logs_console.lastLine(), char: 0 }, 100);
   };
@@ -3,10 +3,24 @@ from flask_cors import CORS
 from subprocess import run
 import os
 from python_agent.agent import AgentApp
+from python_agent.code_document import RevisionConflict, checksum
+from python_agent.session_store import SessionManager, SQLiteSessionStore
+from python_agent.jobs import JobQueue, JobQueueFull
+from python_agent.metrics import AgentMetrics
+from python_agent.llm_client import LLMClientPool
+from python_agent.session_archive import ArchiveDirectory, ArchiveError, ArchiveTooLarge
 import traceback
 import logging
-import time
+import collections
+import json
 import datetime
+import itertools
+import tempfile
+import threading
+import dotenv
+
+# Settings from a .env file, read below before any AgentApp is built
+dotenv.load_dotenv()
 
 logging.basicConfig(
     format="[%(asctime)s %(levelname)s %(threadName)s %(name)s:%(funcName)s:%(lineno)s] %(message)s",
@@ -16,7 +30,30 @@ logging.basicConfig(
 
 app = Flask(__name__)
 CORS(app)
-agent_app = None
+
+# Sessions are persisted so that the app can run with several worker processes
+session_ttl = float(os.environ.get("SESSION_TTL", 7 * 24 * 3600))
+sessions = SessionManager(
+    store=SQLiteSessionStore(os.environ.get("SESSION_STORE_PATH", "./sessions.db")),
+    factory=AgentApp,
+    ttl=session_ttl,
+)
+# Session archives being imported
+archives = ArchiveDirectory(
+    os.environ.get("SESSION_ARCHIVE_DIR", "./session_archives"),
+    max_bytes=int(os.environ.get("SESSION_ARCHIVE_MAX_BYTES", 50_000_000)),
+)
+
+# Turns submitted to /jobs run on a bounded worker pool
+jobs = JobQueue(
+    max_workers=int(os.environ.get("JOB_WORKERS", 4)),
+    max_queued=int(os.environ.get("JOB_QUEUE_DEPTH", 16)),
+)
+
+
+def session_id():
+    """The session of the current request, sent by the client in the X-Session-Id header."""
+    return request.headers.get("X-Session-Id") or request.args.get("session_id") or "default"
 
 logger = logging.getLogger("council")
 logger.setLevel(logging.DEBUG)
@@ -24,9 +61,20 @@ logger.setLevel(logging.DEBUG)
 
 # Create the custom logging handler
 class MemoryHandler(logging.Handler):
-    def __init__(self):
+    """
+    Keeps the latest controller log events in a bounded ring buffer.
+
+    Every event gets a monotonically increasing id so that stream subscribers can resume from
+    the last event they received. Subscribers are woken up by a condition variable when new
+    events are published.
+    """
+
+    def __init__(self, capacity=500):
         super().__init__()
-        self.latest_log_message = ""
+        self.events = collections.deque(maxlen=capacity)
+        self.last_event_id = 0
+        self.last_reset_id = 0
+        self.condition = threading.Condition()
         self.latest_output = ""
 
     def emit(self, record):
@@ -34,50 +82,196 @@ class MemoryHandler(logging.Handler):
         current_datetime = datetime.datetime.now()
         formatted_datetime = current_datetime.strftime("%Y-%m-%d %H:%M:%S")
         if "Controller Message" in log_message:
-            self.latest_log_message += "|" + f"[{formatted_datetime}] " + log_message
+            self.publish(f"[{formatted_datetime}] " + log_message)
+
+    def publish(self, message, reset=False):
+        """Append an event and wake up subscribers. A reset event tells clients to clear their log."""
+        with self.condition:
+            self.last_event_id += 1
+            if reset:
+                self.last_reset_id = self.last_event_id
+            self.events.append((self.last_event_id, message, reset))
+            self.condition.notify_all()
+
+    def events_after(self, event_id):
+        """Return the buffered events with an id greater than event_id."""
+        with self.condition:
+            if not self.events:
+                return []
+            first_id = self.events[0][0]
+            return list(itertools.islice(self.events, max(event_id - first_id + 1, 0), None))
+
+    def wait_for_events(self, event_id, timeout):
+        """Block until there are events newer than event_id, or until the timeout expires."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.last_event_id > event_id, timeout=timeout)
+            return self.events_after(event_id)
+
+    def resume_point(self, last_event_id=None):
+        """
+        Id after which a subscriber should receive events. New subscribers start from the last reset,
+        reconnecting subscribers from the last event they received.
+        """
+        with self.condition:
+            if last_event_id is None or last_event_id > self.last_event_id:
+                return max(self.last_reset_id - 1, 0)
+            return last_event_id
 
 
 memory_handler = MemoryHandler()
 logger.addHandler(memory_handler)
 
 
-# Route to get the latest log message as an SSE stream
+def format_log_event(event_id, message, reset):
+    lines = [f"id: {event_id}"]
+    if reset:
+        lines.append("event: reset")
+    lines += [f"data: {line}" for line in message.splitlines() or [""]]
+    return "\n".join(lines) + "\n\n"
+
+
+# Route to stream the controller log events as SSE
 @app.route("/latest_log_stream")
 def get_latest_log_stream():
-    def generate_log_updates():
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID"))
+    except (TypeError, ValueError):
+        last_event_id = None
+
+    def generate_log_updates(event_id):
         while True:
-            memory_handler.latest_log_message
-            if memory_handler.latest_log_message:
-                # if "Controller Message" in memory_handler.latest_log_message:
-                # memory_handler.latest_log_message += "."
-                yield f"data: {memory_handler.latest_log_message}\n\n"
-            time.sleep(1)
+            events = memory_handler.wait_for_events(event_id, timeout=15)
+            if not events:
+                # Comment line to keep the connection alive through proxies
+                yield ": keep-alive\n\n"
+                continue
+            for event_id, message, reset in events:
+                yield format_log_event(event_id, message, reset)
+
+    return Response(
+        generate_log_updates(memory_handler.resume_point(last_event_id)),
+        content_type="text/event-stream",
+    )
 
-    return Response(generate_log_updates(), content_type="text/event-stream")
+
+@app.route("/metrics")
+def get_metrics():
+    """Latency and token metrics of all sessions, in the Prometheus text format."""
+    return Response(AgentMetrics.default().render(), content_type="text/plain; version=0.0.4")
+
+
+@app.route("/health")
+def get_health():
+    """Whether the LLM API is reachable, checked at most every 30 seconds, 503 if it is not."""
+    status = LLMClientPool.default().health()
+    return status, 503 if status["healthy"] is False else 200
 
 
 @app.route("/get_code", methods=["POST"])
 def get_code():
-    if "code" in agent_app.controller._state:
-        return agent_app.controller._state["code"], 200
-    else:
-        return "No code to display.", 200
+    with sessions.session(session_id(), save=False) as agent_app:
+        if "code" in agent_app.controller._state:
+            return agent_app.controller._state["code"], 200
+        else:
+            return "No code to display.", 200
+
+
+@app.route("/document", methods=["POST"])
+def get_document():
+    with sessions.session(session_id(), save=False) as agent_app:
+        document = agent_app.document
+        return {"revision": document.revision, "code": document.text}, 200
 
 
 @app.route("/reset", methods=["POST"])
 def reset():
-    global agent_app
-    agent_app = AgentApp()
-    agent_app.controller._state["code"] = "No code to display."
-    memory_handler.latest_log_message = "Ready."
+    sessions.reset(session_id())
+    memory_handler.publish("Ready.", reset=True)
     return "Ready!", 200
 
 
+@app.route("/session/export", methods=["GET"])
+def export_session():
+    """The session as a session archive, to be imported later with /session/import."""
+    with tempfile.TemporaryFile() as f:
+        with sessions.session(session_id(), save=False) as agent_app:
+            agent_app.export_session(f)
+        f.seek(0)
+        archive = f.read()
+    return Response(
+        archive,
+        content_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{session_id()}.session.jsonl"'},
+    )
+
+
+@app.route("/session/import", methods=["POST"])
+def import_session():
+    """
+    Replace the session with the session archive sent as the request body, of at most
+    SESSION_ARCHIVE_MAX_BYTES bytes. 400 if it is not a valid session archive, 413 if it is too large.
+    """
+    if archives.max_bytes and (request.content_length or 0) > archives.max_bytes:
+        return f"the archive is larger than {archives.max_bytes} bytes", 413
+    archives.expire(session_ttl)
+    try:
+        archive = archives.add(request.stream)
+    except ArchiveTooLarge as e:
+        return str(e), 413
+    except ArchiveError as e:
+        return str(e), 400
+    try:
+        agent_app = sessions.create()
+        agent_app.import_session(archive)
+        # Saving the session copies the data it still reads from the archive into the session store
+        sessions.replace(session_id(), agent_app)
+    except ArchiveError as e:
+        return str(e), 400
+    finally:
+        archives.remove(archive.path)
+    memory_handler.publish("Session imported.", reset=True)
+    return {"revision": agent_app.document.revision, "code": agent_app.document.text}, 200
+
+
+@app.route("/cancel", methods=["POST"])
+def cancel():
+    """
+    Cancel the turn the session is running and its queued jobs, e.g. when the user sends a new
+    message or leaves the page. Only turns running in this worker process are cancelled.
+    """
+    current_session_id = session_id()
+    cancelled_jobs = jobs.cancel(current_session_id)
+    agent_app = sessions.peek(current_session_id)
+    cancelled = agent_app is not None and agent_app.cancel()
+    if cancelled:
+        memory_handler.publish("Cancelling the current message.")
+    return {"cancelled": cancelled, "cancelled_jobs": cancelled_jobs}, 200
+
+
 @app.route("/post_code", methods=["POST"])
 def post_code():
+    """
+    Store the editor contents, sent as the `code` form field or as JSON with a `patch` against
+    `base_revision` like /handle_user_message, and start analysing them in the background.
+    """
     try:
+        if request.is_json:
+            payload = request.get_json()
+            with sessions.session(session_id()) as agent_app:
+                try:
+                    revision = agent_app.update_code(
+                        payload["base_revision"], payload.get("patch"), payload.get("checksum")
+                    )
+                except RevisionConflict as e:
+                    document = agent_app.document
+                    return {"error": str(e), "revision": document.revision, "code": document.text}, 409
+                agent_app.analyze_code()
+            return {"revision": revision}, 200
+
         code = request.form.get("code")
-        agent_app.controller._state["code"] = code
+        with sessions.session(session_id()) as agent_app:
+            agent_app.set_code(code)
+            agent_app.analyze_code()
         print("CODE POSTED")
         return "Code posted!", 200
     except Exception as e:
@@ -86,25 +280,122 @@ def post_code():
         return "Code was not posted", 500
 
 
-@app.route("/handle_user_message", methods=["POST"])
-def handle_user_message():
-    try:
-        message = request.form.get("message")
-        agent_app.interact(message)
+def run_user_message(agent_app, payload):
+    """
+    Run one turn and return the response body and status. Payloads with a `base_revision` carry the
+    editor changes as a patch and get the agent's changes back as a patch, others get the full code back.
+    """
+    if "base_revision" not in payload:
+        agent_app.interact(payload["message"])
         agent_response = agent_app.context.chatHistory.last_agent_message.message
         memory_handler.latest_output = agent_response
         code = agent_app.controller._state["code"]
-        return {"message": agent_response, "code": code}, 200
+        return {"message": agent_response, "code": code, "usage": agent_app.token_account.to_dict()}, 200
+
+    try:
+        base_revision = agent_app.update_code(
+            payload["base_revision"], payload.get("patch"), payload.get("checksum")
+        )
+    except RevisionConflict as e:
+        document = agent_app.document
+        return {"error": str(e), "revision": document.revision, "code": document.text}, 409
+
+    agent_app.interact(payload["message"])
+    agent_response = agent_app.context.chatHistory.last_agent_message.message
+    memory_handler.latest_output = agent_response
+    document = agent_app.document
+    return {
+        "message": agent_response,
+        "base_revision": base_revision,
+        "revision": document.revision,
+        "patch": document.diff_from(base_revision),
+        "checksum": checksum(document.text),
+        "usage": agent_app.token_account.to_dict(),
+    }, 200
+
+
+def user_message_payload():
+    if request.is_json:
+        return request.get_json()
+    return {"message": request.form.get("message")}
+
+
+@app.route("/handle_user_message", methods=["POST"])
+def handle_user_message():
+    try:
+        with sessions.turn(session_id()) as agent_app:
+            return run_user_message(agent_app, user_message_payload())
     except Exception as e:
         print(traceback.format_exc())
         return "Sorry, something went wrong!", 500
 
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """
+    Run a user message in the background. Takes the same payload as /handle_user_message and returns
+    a job id right away. Progress is streamed from /jobs/<job_id>/events and the result is fetched
+    from /jobs/<job_id>.
+    """
+    current_session_id = session_id()
+    payload = user_message_payload()
+
+    def run_job(job):
+        with sessions.turn(current_session_id) as agent_app:
+            unsubscribe = agent_app.events.subscribe(job.add_event)
+            try:
+                return run_user_message(agent_app, payload)
+            finally:
+                unsubscribe()
+
+    try:
+        job = jobs.submit(current_session_id, run_job)
+    except JobQueueFull as e:
+        return {"error": str(e)}, 503, {"Retry-After": "5"}
+    return {"job_id": job.id}, 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {"error": "unknown job"}, 404
+    if not job.done:
+        return {"job_id": job.id, "status": job.status}, 202
+    return job.result
+
+
+@app.route("/jobs/<job_id>/events")
+def get_job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {"error": "unknown job"}, 404
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID"))
+    except (TypeError, ValueError):
+        last_event_id = 0
+
+    def generate_job_events(after):
+        while True:
+            events, done = job.wait_for_events(after, timeout=15)
+            for event_id, event in events:
+                yield f"id: {event_id}\ndata: {json.dumps(event, default=str)}\n\n"
+                after = event_id
+            if done:
+                yield f"event: done\ndata: {json.dumps({'status': job.status})}\n\n"
+                return
+            if not events:
+                yield ": keep-alive\n\n"
+
+    return Response(generate_job_events(last_event_id), content_type="text/event-stream")
+
+
 @app.route("/revert_code", methods=['POST'])
 def revert_code():
-    code = agent_app.revert_code()
-    agent_message = agent_app.context.chatHistory.last_agent_message.message
-    return {"message": agent_message, "code": code}, 200 
+    with sessions.session(session_id()) as agent_app:
+        code = agent_app.revert_code()
+        agent_message = agent_app.context.chatHistory.last_agent_message.message
+        return {"message": agent_message, "code": code, "revision": agent_app.document.revision}, 200
 
 if __name__ == "__main__":
-    agent_app = AgentApp()
     app.run(debug=True, use_reloader=False, threaded=True)
@@ -1,16 +1,34 @@
 from python_agent.agent import AgentApp
+from python_agent.batch import DEFAULT_TIMEOUT, load_scenarios, run_batch, summarize, write_report
+from python_agent.session_archive import SessionArchive, save_archive
 import logging
 logging.basicConfig(
     format="[%(asctime)s %(levelname)s %(threadName)s %(name)s:%(funcName)s:%(lineno)s] %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S%z",
 )
 logging.getLogger("council").setLevel("INFO")
+import argparse
+import dotenv
+import json
+import os
 import time
 
-def main(test_case=None):
+# Settings from a .env file, SESSION_ARCHIVE_PATH is read before any AgentApp is built
+dotenv.load_dotenv()
+
+def new_agent_app():
     agent_app = AgentApp()
     agent_app.controller._state["code"] = None
     agent_app.controller._state["stderr"] = None
+    return agent_app
+
+def main(test_case=None, session_path=None):
+    if session_path and os.path.exists(session_path):
+        agent_app = AgentApp()
+        agent_app.import_session(SessionArchive(session_path))
+        print(f"Resumed session from {session_path}")
+    else:
+        agent_app = new_agent_app()
 
     if test_case:
         start_time = time.time()
@@ -33,30 +51,40 @@ def main(test_case=None):
             print("Agent Response Message", agent_app.context.chatHistory.last_agent_message.message)
             print("Agent Response Data", agent_app.context.chatHistory.last_agent_message.data)
 
+    if session_path:
+        save_archive(agent_app.snapshot(), session_path)
+
+def main_batch(paths, workers, timeout, report_path):
+    """Run the scenarios in `paths` in parallel and write their report to `report_path`."""
+    scenarios = load_scenarios(paths)
+    print(f"Running {len(scenarios)} scenarios with {workers} workers.")
+    start_time = time.time()
+
+    def on_result(result):
+        print(f"{result['status']:>8} {result['name']} ({len(result['turns'])} turns, {result['duration']:.1f} seconds)")
+
+    results = run_batch(scenarios, new_agent_app, workers=workers, timeout=timeout, on_result=on_result)
+    duration = time.time() - start_time
+    write_report(report_path, results, duration, workers, timeout)
+    print(json.dumps(summarize(results), indent=2))
+    print(f"Batch ran in {duration:.1f} seconds, report written to {report_path}.")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the agent on a scenario, interactively, or on a batch of scenarios.")
+    parser.add_argument("--scenario", default="scenarios/virtual_pet_cat.toml", help="scenario run when not in batch mode")
+    parser.add_argument("--interactive", action="store_true", help="chat with the agent instead of running a scenario")
+    parser.add_argument("--batch", nargs="+", metavar="PATH", help="scenario files or directories to run in parallel")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="scenarios run at the same time")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="seconds a scenario may run")
+    parser.add_argument("--report", default="batch_report.json", help="where the batch report is written")
+    args = parser.parse_args()
 
-    # test case
-    test_case = [
-        "write code to compute the distance between two vectors",
-        "please run it",
-        "intentionally edit the code to cause an error",
-        "run the code",
-        "fix the error", 
-        "execute the code please"
-    ]
-
-    test_case = [
-        "write code to compute the distance between two vectors",
-        "please run it",
-        "can we do this but have it be between a vector and a matrix with ~10 rows?",
-        "run the code",
-    ]
-
-    test_case = [
-        "I want to create a virtual pet cat in pygame",
-        "run it",
-        "make the cat look nicer - add as many visual features as you can think of!",
-        "run it"
-    ]
-
-    main(test_case)
+    if args.batch:
+        # The turns of the workers are in the report, keep their logs short
+        logging.getLogger("council").setLevel("WARNING")
+        main_batch(args.batch, args.workers, args.timeout, args.report)
+    elif args.interactive:
+        main(session_path=os.environ.get("SESSION_ARCHIVE_PATH"))
+    else:
+        test_case = load_scenarios([args.scenario])[0].messages
+        main(test_case, session_path=os.environ.get("SESSION_ARCHIVE_PATH"))
@@ -1,17 +1,9 @@
 from council.runners import Budget
-from council.contexts import AgentContext, ChatHistory
-from council.agents import Agent
+from council.contexts import AgentContext, ChatHistory, ChatMessage, ChatMessageKind
 from council.chains import Chain
-from council.llm.openai_llm import OpenAILLM
 
-import dotenv
-
-dotenv.load_dotenv()
-
-from string import Template
-import toml
 import logging
-import os
+import time
 
 logging.getLogger("council")
 
@@ -22,16 +14,57 @@ from python_agent.skills import (
     PythonErrorCorrectionSkill,
     GeneralSkill,
     DirectToUserSkill,
+    parses_as_python,
 )
 from python_agent.controller import LLMInstructController
-from python_agent.evaluator import BasicEvaluatorWithSource
+from python_agent.evaluator import IncrementalEvaluatorWithSource
+from python_agent.blob_store import BlobStore
+from python_agent.cancellation import TurnCancellation, TurnCancelled
+from python_agent.code_analysis import CodeAnalyzer
+from python_agent.code_document import CodeDocument
+from python_agent.events import AgentEvents, ObservableAgent
+from python_agent.llm_client import LLMClientPool
+from python_agent.llm_gateway import GatewayLLM
+from python_agent.model_tiers import ROLE_PRIORITIES, TieredLLM
+from python_agent.metrics import AgentMetrics
+from python_agent.prototype import AgentPrototype
+from python_agent.tracing import TurnTracer
+from python_agent.token_budget import TokenBudgetExceeded, TokenUsage
+from python_agent.session_archive import ArchiveError, LazyChatMessage, write_archive
+from python_agent.symbol_index import SymbolIndex
 
 
 class AgentApp:
-    def __init__(self, work_dir="./python_agent"):
+    def __init__(self, work_dir="./python_agent", llm=None):
+        """
+        Initialize a new instance
+
+        Parameters:
+            work_dir (str): directory containing the prompts
+            llm (LLMBase): the upstream LLM of every role, by default each role uses its own model
+        """
         self.work_dir = work_dir
+        # Prompts and configuration, loaded once per process and shared by all sessions
+        self.prototype = AgentPrototype.get(work_dir)
         self.context = AgentContext(chat_history=ChatHistory())
-        self.llm = OpenAILLM.from_env()
+        self.events = AgentEvents()
+        AgentMetrics.default().observe(self.events)
+        if self.prototype.trace_writer is not None:
+            TurnTracer(self.prototype.trace_writer).observe(self.events)
+        # LLM used by every role instead of the models configured in the environment
+        self.llm = llm
+        # Token and cost budgets of each turn and of the session, enforced on every request
+        self.token_account = self.prototype.token_account()
+        # One copy of each distinct code and output of the session, shared by all the messages carrying it
+        self.blobs = BlobStore()
+        # Cancels the running turn from another thread, see cancel
+        self.cancellation = TurnCancellation()
+        self.role_llms = {}
+        # Index of the code shared by code generation and error correction, kept warm by the code analyzer
+        self.symbol_index = SymbolIndex()
+        self.code_analyzer = CodeAnalyzer(
+            self.symbol_index, self.prototype.python_bin_dir, focus_min_lines=self.prototype.focus_min_lines
+        )
         self.load_prompts()
         self.init_skills()
         self.init_chains()
@@ -44,38 +77,41 @@ class AgentApp:
         self.controller._state["code"] = "No code to display."
         self.controller._state["stderr"] = ""
 
-    def load_prompts(self):
-        # Load prompts and prompt templates
-
-        self.code_generation_system_message = toml.load(
-            f"{self.work_dir}/prompts/python_code_generation.toml"
-        )["system"]["prompt"]
-
-        self.code_generation_prompt_template = Template(
-            toml.load(f"{self.work_dir}/prompts/python_code_generation.toml")["main"][
-                "prompt_template"
-            ]
-        )
+        # Versioned copy of the code shared with the editor
+        self.document = CodeDocument(self.controller._state["code"])
 
-        self.code_correction_system_message = toml.load(
-            f"{self.work_dir}/prompts/python_error_correction.toml"
-        )["system"]["prompt"]
-
-        self.code_correction_prompt_template = Template(
-            toml.load(f"{self.work_dir}/prompts/python_error_correction.toml")["main"][
-                "prompt_template"
-            ]
+    def role_llm(self, role, accept=None):
+        """
+        The LLM of `role`, escalating to the escalation model when `accept` rejects its answer.
+        Requests go through the process-wide LLM gateway, where the controller and short replies are
+        admitted before code generation, and the OpenAI LLMs and their connections are shared by all sessions.
+        """
+        pool = LLMClientPool.default()
+        upstream = self.llm if self.llm is not None else pool.openai_llm(self.prototype.role_models[role])
+        strong = self.llm if self.llm is not None else pool.openai_llm(self.prototype.escalation_model)
+        priority = ROLE_PRIORITIES[role]
+        llm = GatewayLLM(
+            upstream, priority, events=self.events, account=self.token_account, cancellation=self.cancellation
         )
+        if accept is not None and strong is not upstream:
+            escalation_llm = GatewayLLM(
+                strong, priority, events=self.events, account=self.token_account, cancellation=self.cancellation
+            )
+            llm = TieredLLM(llm, escalation_llm, accept=accept, events=self.events)
+        self.role_llms[role] = llm
+        return llm
 
-        self.general_system_message = toml.load(
-            f"{self.work_dir}/prompts/general.toml"
-        )["system"]["prompt"]
-
-        self.general_prompt_template = Template(
-            toml.load(f"{self.work_dir}/prompts/general.toml")["main"][
-                "prompt_template"
-            ]
-        )
+    def load_prompts(self):
+        # Prompts and prompt templates, parsed once by the prototype
+        prototype = self.prototype
+        self.code_generation_system_message = prototype.code_generation_system_message
+        self.code_generation_prompt_template = prototype.code_generation_prompt_template
+        self.code_generation_focus_prompt_template = prototype.code_generation_focus_prompt_template
+        self.code_correction_system_message = prototype.code_correction_system_message
+        self.code_correction_prompt_template = prototype.code_correction_prompt_template
+        self.code_correction_focus_prompt_template = prototype.code_correction_focus_prompt_template
+        self.general_system_message = prototype.general_system_message
+        self.general_prompt_template = prototype.general_prompt_template
 
     def init_skills(self):
         """
@@ -87,48 +123,63 @@ class AgentApp:
         Code generation.
         """
         self.code_generation_skill = PythonCodeGenerationSkill(
-            self.llm,
+            self.role_llm("code_generation", accept=parses_as_python),
             system_prompt=self.code_generation_system_message,
             main_prompt_template=self.code_generation_prompt_template,
             code_header=code_header,
+            events=self.events,
+            focus_min_lines=self.prototype.focus_min_lines,
+            cancellation=self.cancellation,
+            symbol_index=self.symbol_index,
+            focus_prompt_template=self.code_generation_focus_prompt_template,
         )
 
         """
         Validate/parse Python code block - could easily be generalized to regex pattern matching skill.
         """
-        self.parse_python_skill = ParsePythonSkill()
+        self.parse_python_skill = ParsePythonSkill(events=self.events, cancellation=self.cancellation)
 
         """
         Execute Python code locally in host environment - UNSAFE.
         """
         self.python_execution_skill = PythonExecutionSkill(
-            self.llm,
-            python_bin_dir=os.environ["PYTHON_BIN_DIR"],
+            self.role_llms["code_generation"],
+            python_bin_dir=self.prototype.python_bin_dir,
+            events=self.events,
+            cancellation=self.cancellation,
+            code_analyzer=self.code_analyzer,
         )
 
         """
         Python error correction skill.
         """
         self.error_correction_skill = PythonErrorCorrectionSkill(
-            self.llm,
+            self.role_llm("error_correction", accept=parses_as_python),
             system_prompt=self.code_correction_system_message,
             main_prompt_template=self.code_correction_prompt_template,
             code_header=code_header,
+            events=self.events,
+            focus_min_lines=self.prototype.focus_min_lines,
+            cancellation=self.cancellation,
+            symbol_index=self.symbol_index,
+            focus_prompt_template=self.code_correction_focus_prompt_template,
         )
 
         """
         A general skill for handling other things. This is LLMSkill customized with controller "iteration" support.
         """
         self.general_skill = GeneralSkill(
-            self.llm,
+            self.role_llm("general", accept=lambda response: bool(response.strip())),
             system_prompt=self.general_system_message,
             main_prompt_template=self.general_prompt_template,
+            events=self.events,
+            cancellation=self.cancellation,
         )
 
         """
         A skill that the Controller can use to just send a message to the user with no additional LLM calls.
         """
-        self.direct_to_user_skill = DirectToUserSkill()
+        self.direct_to_user_skill = DirectToUserSkill(events=self.events, cancellation=self.cancellation)
 
     def init_chains(self):
         self.code_generation_chain = Chain(
@@ -168,9 +219,22 @@ class AgentApp:
         )
 
     def init_controller(self):
+        chains = [
+            self.code_generation_chain,
+            self.code_execution_chain,
+            self.error_correction_chain,
+            self.general_chain,
+            self.direct_to_user_chain,
+        ]
         self.controller = LLMInstructController(
-            llm=self.llm,
+            llm=self.role_llm(
+                "controller",
+                accept=LLMInstructController.decision_validator(chains, self.prototype.escalation_min_score),
+            ),
             top_k_execution_plan=1,
+            events=self.events,
+            cancellation=self.cancellation,
+            max_plan_steps=self.prototype.max_plan_steps,
             hints=[
                 "When you use the 'direct_to_user' chain, don't respond with instructions, but instead respond with a message that directly addresses the user.",
                 "Whenever graphical changes are being considered, always make sure you give instructions to draw graphics 'manually' in pygame."
@@ -179,10 +243,10 @@ class AgentApp:
         )
 
     def init_evaluator(self):
-        self.evaluator = BasicEvaluatorWithSource()
+        self.evaluator = IncrementalEvaluatorWithSource(self.controller)
 
     def init_agent(self):
-        self.agent = Agent(
+        self.agent = ObservableAgent(
             controller=self.controller,
             chains=[
                 self.code_generation_chain,
@@ -192,34 +256,195 @@ class AgentApp:
                 self.direct_to_user_chain,
             ],
             evaluator=self.evaluator,
+            events=self.events,
         )
 
+    def set_code(self, code):
+        """Replace the code with the full editor contents."""
+        self.controller._state["code"] = code
+        return self.document.commit(code)
+
+    def analyze_code(self):
+        """
+        Parse, index and pre-flight check the code in the background, so that the next turn running
+        or fixing it finds the results ready. An analysis not started yet is replaced by the next call.
+        Does nothing when there is no code.
+        """
+        self.code_analyzer.submit(self.controller._state["code"])
+
+    def update_code(self, base_revision, patch, checksum=None):
+        """
+        Apply an editor patch made against `base_revision` and return the new revision.
+        Raises RevisionConflict if the code changed since `base_revision`.
+        """
+        revision = self.document.apply(base_revision, patch, checksum)
+        self.controller._state["code"] = self.document.text
+        return revision
+
     def revert_code(self):
         if len(self.state_history) > 1:
             code = self.state_history.pop()["code"]
             self.context.chatHistory.add_agent_message(
                 message="I've reverted the code as per your request.",
             )
-            return code
         elif len(self.state_history) > 0:
             self.state_history.pop()
             self.context.chatHistory.add_agent_message(
                 message="I've reverted the code as per your request.",
             )
-            return "No code to display."
+            code = "No code to display."
         else:
             self.context.chatHistory.add_agent_message(
                 message="Sorry, I couldn't revert the code any further.",
             )
-            return "No code to display."
+            code = "No code to display."
+        self.set_code(code)
+        return code
+
+    def snapshot(self):
+        """
+        Return the session state as JSON-compatible data: chat history, controller state,
+        code revisions, the code history used by revert_code and the session token usage.
+        Large strings are replaced by blob handles, and each is stored once in "blobs".
+        """
+        used = set()
+        chat_history = [self._snapshot_message(m, used) for m in self.context.chatHistory.messages]
+        return {
+            "chat_history": chat_history,
+            "controller_state": self.blobs.encode(self.controller._state, used),
+            "state_history": self.blobs.encode(self.state_history, used),
+            "document": self.blobs.encode(self.document.to_dict(), used),
+            "token_usage": self.token_account.session.to_dict(),
+            "blobs": self.blobs.blobs(used),
+        }
+
+    def _snapshot_message(self, m, used):
+        message = {"kind": m.kind.value, "message": m.message, "source": m.source, "is_error": m.is_error}
+        encoded = m.encoded(self.blobs, used) if isinstance(m, LazyChatMessage) else None
+        if encoded is not None:
+            # Not read since it was imported, it is saved as encoded in the archive
+            return message | {"data": encoded}
+        return message | {"data": self.blobs.encode(m.data, used)}
+
+    def restore(self, snapshot):
+        """Restore the session state from data returned by `snapshot`."""
+        blobs = snapshot.get("blobs", {})
+        chat_history = ChatHistory()
+        for m in snapshot["chat_history"]:
+            message = ChatMessage(
+                m["message"],
+                ChatMessageKind(m["kind"]),
+                data=self.blobs.decode(m["data"], blobs),
+                source=m["source"],
+                is_error=m["is_error"],
+            )
+            chat_history._messages.append(message)
+        snapshot = {
+            key: self.blobs.decode(value, blobs) for key, value in snapshot.items() if key not in ("blobs", "chat_history")
+        }
+        self._restore_state(chat_history, snapshot)
+
+    def export_session(self, f):
+        """Write the session state to a binary file as a session archive."""
+        write_archive(self.snapshot(), f)
+
+    def import_session(self, archive):
+        """
+        Restore the session state from a SessionArchive. The data of the chat messages, which holds
+        copies of the code and of its output, is only read from the archive when it is used.
+
+        Raises:
+            ArchiveError: if the archive is not a valid session archive
+        """
+        chat_history = ChatHistory()
+        snapshot = {}
+        for record in archive.records():
+            if record["type"] == "message":
+                chat_history._messages.append(
+                    LazyChatMessage(
+                        record["message"],
+                        ChatMessageKind(record["kind"]),
+                        archive,
+                        record["data"],
+                        source=record["source"],
+                        is_error=record["is_error"],
+                    )
+                )
+            else:
+                snapshot[record["type"]] = archive.resolve(record["value"])
+        try:
+            self._restore_state(chat_history, snapshot)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            raise ArchiveError(f"invalid session archive: {e!r}") from e
+
+    def _restore_state(self, chat_history, snapshot):
+        self.context = AgentContext(chat_history=chat_history)
+        self.controller._state = self.blobs.intern(snapshot["controller_state"])
+        self.state_history = self.blobs.intern(snapshot["state_history"])
+        self.document = CodeDocument.from_dict(self.blobs.intern(snapshot["document"]))
+        self.token_account.session = TokenUsage.from_dict(snapshot.get("token_usage", {}))
+
+    def compact(self):
+        """
+        Bound the memory of the session by its distinct content: share one copy of the code and
+        output in the controller state, and drop the chain results of past iterations, which
+        nothing reads once the turn is over.
+        """
+        for iterations in self.context.chainHistory.values():
+            del iterations[:-1]
+        del self.context.evaluationHistory[:-1]
+        state = self.controller._state
+        for key, value in state.items():
+            state[key] = self.blobs.intern(value)
+
+    def cancel(self):
+        """
+        Cancel the running turn, from another thread: its LLM request is abandoned, its sandbox
+        process group is killed, and it ends with a message saying so, leaving the code unchanged.
+        Returns False if no turn is running.
+        """
+        return self.cancellation.cancel()
 
     def interact(self, message, budget=600):
-        self.context.chatHistory.add_user_message(message)
-        state_pre = self.agent.controller._state.copy()
-        result = self.agent.execute(context=self.context, budget=Budget(budget))
-        if self.agent.controller._state["code"] != state_pre["code"]:
-            self.state_history.append(state_pre)
-        for scored_message in result.messages:
-            self.context.chatHistory.add_agent_message(
-                scored_message.message.message, scored_message.message.data
+        self.events.emit("turn_started", message=message)
+        start = time.monotonic()
+        is_error = True
+        self.cancellation.start_turn()
+        try:
+            self.token_account.start_turn()
+            self.context.chatHistory.add_user_message(message)
+            state_pre = self.agent.controller._state.copy()
+            try:
+                result = self.agent.execute(context=self.context, budget=Budget(budget))
+            except TokenBudgetExceeded as e:
+                # Raised by the controller, the skills report it in their message
+                self.context.chatHistory.add_agent_message(
+                    f"Sorry, I can't handle this message because the token budget is exhausted: {e}.",
+                    self.blobs.intern(self.agent.controller._state),
+                )
+                return
+            except TurnCancelled:
+                # Raised by the controller, the skills end with a message instead
+                pass
+            if self.cancellation.cancelled:
+                self.agent.controller._state = state_pre
+                self.context.chatHistory.add_agent_message(
+                    "I stopped working on this message because it was cancelled.",
+                    self.blobs.intern(state_pre),
+                )
+                return
+            if self.agent.controller._state["code"] != state_pre["code"]:
+                self.state_history.append(self.blobs.intern(state_pre))
+            for scored_message in result.messages:
+                self.context.chatHistory.add_agent_message(
+                    scored_message.message.message, self.blobs.intern(scored_message.message.data)
+                )
+            self.document.commit(self.agent.controller._state["code"])
+            is_error = any(m.message.is_error for m in result.messages)
+        finally:
+            cancelled = self.cancellation.cancelled
+            self.cancellation.finish_turn()
+            self.compact()
+            self.events.emit(
+                "turn_finished", is_error=is_error, cancelled=cancelled, duration=time.monotonic() - start
             )
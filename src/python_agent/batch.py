@@ -0,0 +1,287 @@
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import statistics
+import threading
+import time
+from dataclasses import dataclass
+from multiprocessing.connection import Connection, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import toml
+
+logger = logging.getLogger("council")
+
+"""
+Runs many scenarios concurrently, each in its own process with its own AgentApp.
+
+A scenario is a TOML file:
+    name = "vector_distance"        # defaults to the file name
+    timeout = 600                   # seconds, defaults to the timeout of the batch
+    code = "..."                    # code in the editor before the first message, optional
+    messages = ["write code to ...", "please run it"]
+
+Every turn reports its latency, the chains the controller selected, whether it succeeded and the
+tokens it used. A scenario running past its timeout is killed together with the programs it
+started, and keeps the turns it completed. The report is written as JSON:
+    python main.py --batch scenarios --workers 8 --report batch_report.json
+"""
+
+DEFAULT_TIMEOUT = 900
+
+# Length of the agent replies kept in the report
+REPLY_PREVIEW = 200
+
+
+@dataclass
+class BatchScenario:
+    name: str
+    path: str
+    messages: List[str]
+    code: Optional[str] = None
+    timeout: Optional[float] = None
+
+    @staticmethod
+    def from_file(path: str) -> "BatchScenario":
+        data = toml.load(path)
+        if not data.get("messages"):
+            raise ValueError(f"{path}: a scenario needs messages")
+        return BatchScenario(
+            name=data.get("name") or os.path.splitext(os.path.basename(path))[0],
+            path=path,
+            messages=list(data["messages"]),
+            code=data.get("code"),
+            timeout=data.get("timeout"),
+        )
+
+
+def load_scenarios(paths: List[str]) -> List[BatchScenario]:
+    """The scenarios in the given files, and in the .toml files of the given directories."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.toml")))
+        else:
+            files.append(path)
+    return [BatchScenario.from_file(file) for file in files]
+
+
+def run_turns(scenario: BatchScenario, agent_app, budget: float = 600) -> Iterator[Dict[str, Any]]:
+    """Send the messages of a scenario to `agent_app` and yield the report of each turn."""
+    turn: Dict[str, Any] = {}
+
+    def on_event(event):
+        if event["kind"] == "controller_decision":
+            turn["chains"].append(event["chain"])
+        elif event["kind"] == "llm_request":
+            turn["llm_requests"] += 1
+
+    unsubscribe = agent_app.events.subscribe(on_event)
+    try:
+        if scenario.code is not None:
+            agent_app.set_code(scenario.code)
+        for message in scenario.messages:
+            turn.clear()
+            turn.update(message=message, chains=[], llm_requests=0)
+            start = time.monotonic()
+            error = None
+            try:
+                agent_app.interact(message, budget=budget)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            reply = agent_app.context.chatHistory.last_agent_message
+            usage = agent_app.token_account.turn
+            yield turn | {
+                "duration": time.monotonic() - start,
+                "success": error is None and reply is not None and not reply.is_error,
+                "error": error,
+                "reply": None if reply is None else reply.message[:REPLY_PREVIEW],
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "cost": usage.cost,
+            }
+            if error is not None:
+                return
+    finally:
+        unsubscribe()
+
+
+def _run_in_process(scenario: BatchScenario, factory: Callable, budget: float, connection: Connection) -> None:
+    # Lead a process group, so that kill also kills the processes it started
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+    try:
+        agent_app = factory()
+        if hasattr(signal, "SIGTERM"):
+            # Sent by stop: cancelling the turn kills its sandbox, which runs in a process group of its own
+            def on_terminate(signum, frame):
+                # Not in the handler, which may have interrupted the turn holding the locks cancel takes
+                def cancel():
+                    agent_app.cancel()
+                    os._exit(1)
+
+                threading.Thread(target=cancel, name="cancel-scenario", daemon=True).start()
+
+            signal.signal(signal.SIGTERM, on_terminate)
+        for turn in run_turns(scenario, agent_app, budget):
+            connection.send(("turn", turn))
+        connection.send(("done", None))
+    except BaseException as e:
+        connection.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        connection.close()
+
+
+class _Running:
+    def __init__(self, scenario: BatchScenario, process, connection: Connection, timeout: float):
+        self.scenario = scenario
+        self.process = process
+        self.connection = connection
+        self.start = time.monotonic()
+        self.deadline = self.start + timeout
+        self.turns: List[Dict[str, Any]] = []
+
+    def result(self, status: str, error: Optional[str] = None) -> Dict[str, Any]:
+        if status == "completed":
+            status = "passed" if all(turn["success"] for turn in self.turns) else "failed"
+        return {
+            "name": self.scenario.name,
+            "path": self.scenario.path,
+            "status": status,
+            "error": error,
+            "duration": time.monotonic() - self.start,
+            "turns": self.turns,
+        }
+
+    def stop(self, grace: float = 5) -> None:
+        """Let the scenario cancel its turn, which kills its sandbox, then kill it."""
+        if hasattr(os, "killpg"):
+            self.process.terminate()
+            self.process.join(grace)
+        self.kill()
+
+    def kill(self) -> None:
+        """Kill the scenario and the processes it started in its process group."""
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except (ProcessLookupError, PermissionError):
+            self.process.kill()
+        self.process.join()
+
+
+def run_batch(
+    scenarios: List[BatchScenario],
+    factory: Callable,
+    workers: int = 4,
+    timeout: float = DEFAULT_TIMEOUT,
+    on_result: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Run scenarios in parallel, in at most `workers` processes at a time.
+
+    Parameters:
+        scenarios (List[BatchScenario]): the scenarios to run
+        factory (Callable): builds the AgentApp of a scenario, in its process
+        workers (int): number of scenarios run at the same time
+        timeout (float): seconds a scenario may run, unless it sets its own timeout
+        on_result (Callable): called with the result of each scenario as soon as it finishes
+
+    Returns:
+        the result of each scenario, in the order of `scenarios`
+    """
+    context = multiprocessing.get_context()
+    pending = list(enumerate(scenarios))
+    running: Dict[Connection, _Running] = {}
+    positions: Dict[Connection, int] = {}
+    results: List[Optional[Dict[str, Any]]] = [None] * len(scenarios)
+
+    def finish(connection: Connection, result: Dict[str, Any]):
+        run = running.pop(connection)
+        run.connection.close()
+        results[positions.pop(connection)] = result
+        logger.info(f"batch: {result['name']} {result['status']} in {result['duration']:.1f}s")
+        if on_result is not None:
+            on_result(result)
+
+    try:
+        while pending or running:
+            while pending and len(running) < max(workers, 1):
+                position, scenario = pending.pop(0)
+                scenario_timeout = scenario.timeout or timeout
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(
+                    target=_run_in_process,
+                    args=(scenario, factory, scenario_timeout, sender),
+                    name=f"scenario-{scenario.name}",
+                    daemon=True,
+                )
+                process.start()
+                sender.close()
+                running[receiver] = _Running(scenario, process, receiver, scenario_timeout)
+                positions[receiver] = position
+
+            next_deadline = min(run.deadline for run in running.values())
+            for connection in wait(list(running), timeout=max(next_deadline - time.monotonic(), 0)):
+                run = running[connection]
+                try:
+                    kind, value = connection.recv()
+                except EOFError:
+                    run.process.join()
+                    finish(connection, run.result("crashed", f"exit code {run.process.exitcode}"))
+                    continue
+                if kind == "turn":
+                    run.turns.append(value)
+                else:
+                    run.process.join()
+                    finish(connection, run.result("completed" if kind == "done" else "crashed", value))
+
+            now = time.monotonic()
+            for connection, run in list(running.items()):
+                if now >= run.deadline:
+                    run.stop()
+                    finish(connection, run.result("timeout", f"timed out after {run.deadline - run.start:.0f}s"))
+    finally:
+        for run in running.values():
+            run.process.terminate()
+        for run in running.values():
+            run.stop()
+    return results
+
+
+def summarize(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    turns = [turn for result in results for turn in result["turns"]]
+    durations = sorted(turn["duration"] for turn in turns)
+    statuses = [result["status"] for result in results]
+    return {
+        "scenarios": len(results),
+        "passed": statuses.count("passed"),
+        "failed": statuses.count("failed"),
+        "timeout": statuses.count("timeout"),
+        "crashed": statuses.count("crashed"),
+        "turns": len(turns),
+        "turns_succeeded": sum(1 for turn in turns if turn["success"]),
+        "turn_latency_mean": statistics.fmean(durations) if durations else None,
+        "turn_latency_p95": durations[min(int(len(durations) * 0.95), len(durations) - 1)] if durations else None,
+        "prompt_tokens": sum(turn["prompt_tokens"] for turn in turns),
+        "completion_tokens": sum(turn["completion_tokens"] for turn in turns),
+        "cost": round(sum(turn["cost"] for turn in turns), 6),
+    }
+
+
+def write_report(path: str, results: List[Dict[str, Any]], duration: float, workers: int, timeout: float) -> None:
+    report = {
+        "created": time.time(),
+        "duration": duration,
+        "workers": workers,
+        "timeout": timeout,
+        "summary": summarize(results),
+        "scenarios": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+from python_agent.replay import DEFAULT_WORK_DIR, ROLES, LatencyModel, ReplayClock, Scenario, replay_agent_app
+from python_agent.tracing import TurnTracer, span_label, walk
+
+"""
+Offline end-to-end benchmark of the agent pipeline.
+
+Replays the scenarios recorded in demo_files through AgentApp.interact, with ReplayLLM and
+ReplaySandbox standing in for the OpenAI API and the code sandbox, and reports:
+    turns/sec        turns completed per second of wall time
+    overhead/turn    time per turn not spent waiting for the simulated LLM and sandbox
+    stages           the share of that overhead spent in each span of the turn traces
+    memory/turn      growth of the memory allocated by Python per turn, measured in a separate run
+
+With the default zero latencies the throughput measures the pipeline itself. Results can be saved
+as a baseline, and later runs compared against it:
+    python -m python_agent.benchmark --save-baseline
+    python -m python_agent.benchmark --latency controller=lognormal:1.5:0.4 --latency sandbox=0.2
+"""
+
+DEFAULT_DEMO_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "demo_files")
+
+# Differences below these are measurement noise, whatever the tolerance
+MIN_DELTA_MS = 0.5
+MIN_DELTA_KB = 16.0
+
+
+def run_scenario(
+    scenario: Scenario,
+    latencies: Dict[str, LatencyModel],
+    seed: int = 0,
+    work_dir: str = DEFAULT_WORK_DIR,
+    measure_memory: bool = False,
+) -> Dict[str, Any]:
+    """Play all the turns of `scenario` in a new AgentApp and return its measurements."""
+    clock = ReplayClock(scenario, latencies, seed)
+    app = replay_agent_app(clock, work_dir)
+    traces: List[Dict[str, Any]] = []
+    TurnTracer(traces.append).observe(app.events)
+
+    memory = []
+    if measure_memory:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        for index, turn in enumerate(scenario.turns):
+            clock.turn_index = index
+            app.interact(turn.user_message)
+            if measure_memory:
+                memory.append(tracemalloc.get_traced_memory()[0])
+        elapsed = time.perf_counter() - start
+    finally:
+        if measure_memory:
+            tracemalloc.stop()
+
+    turns = len(scenario.turns)
+    result = {
+        "turns": turns,
+        "latency": {role: model.spec for role, model in sorted(latencies.items())},
+        "errors": sum(trace["error"] for trace in traces),
+        "elapsed": elapsed,
+        "turns_per_sec": turns / elapsed if elapsed > 0 else 0.0,
+        "overhead_ms_per_turn": 1000 * (elapsed - clock.total_waited) / turns,
+        "stages": stage_overhead(traces, clock, turns),
+    }
+    if len(memory) > 1:
+        result["memory_kb_per_turn"] = (memory[-1] - memory[0]) / 1024 / (len(memory) - 1)
+    return result
+
+
+def stage_overhead(traces: List[Dict[str, Any]], clock: ReplayClock, turns: int) -> Dict[str, float]:
+    """
+    Milliseconds per turn spent in each span, excluding its children. The simulated latencies are
+    subtracted from the llm and sandbox spans, leaving the overhead of the gateway and the replay.
+    """
+    totals: Dict[str, float] = {}
+    for trace in traces:
+        for _, span in walk(trace):
+            if span["duration"] is None:
+                continue
+            if span["name"] in ("llm", "sandbox"):
+                label = span["name"]
+            else:
+                label = span_label(span)
+            children = sum(child["duration"] or 0 for child in span["children"])
+            totals[label] = totals.get(label, 0.0) + span["duration"] - children
+
+    sandbox_waited = clock.waited.get("sandbox", 0.0)
+    if "llm" in totals:
+        totals["llm"] -= clock.total_waited - sandbox_waited
+    if "sandbox" in totals:
+        totals["sandbox"] -= sandbox_waited
+    return {label: 1000 * max(0.0, total) / turns for label, total in sorted(totals.items())}
+
+
+def run_benchmark(
+    scenarios: List[Scenario],
+    latencies: Dict[str, LatencyModel],
+    repeat: int = 3,
+    seed: int = 0,
+    measure_memory: bool = True,
+) -> Dict[str, Dict[str, Any]]:
+    """Measurements of each scenario, from the fastest of `repeat` runs."""
+    results = {}
+    for scenario in scenarios:
+        runs = [run_scenario(scenario, latencies, seed) for _ in range(max(1, repeat))]
+        best = min(runs, key=lambda run: run["elapsed"])
+        if measure_memory:
+            # tracemalloc slows down allocations, memory is measured in a run of its own
+            memory = run_scenario(scenario, latencies, seed, measure_memory=True).get("memory_kb_per_turn")
+            if memory is not None:
+                best["memory_kb_per_turn"] = memory
+        results[scenario.name] = best
+    return results
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float) -> List[str]:
+    """The measurements of `results` that are worse than `baseline` by more than `tolerance`."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or base.get("latency", {}) != result["latency"]:
+            # Only runs with the same simulated latencies are comparable
+            continue
+
+        def check(label: str, value: Optional[float], reference: Optional[float], min_delta: float, higher_is_better=False):
+            if value is None or reference is None:
+                return
+            if higher_is_better:
+                worse = value < reference * (1 - tolerance)
+            else:
+                worse = value > reference * (1 + tolerance) and value - reference > min_delta
+            if worse:
+                regressions.append(f"{name}: {label} {value:.2f} (baseline {reference:.2f})")
+
+        check("turns/sec", result["turns_per_sec"], base.get("turns_per_sec"), 0, higher_is_better=True)
+        check("overhead ms/turn", result["overhead_ms_per_turn"], base.get("overhead_ms_per_turn"), MIN_DELTA_MS)
+        check("memory KB/turn", result.get("memory_kb_per_turn"), base.get("memory_kb_per_turn"), MIN_DELTA_KB)
+        for stage, value in result["stages"].items():
+            check(f"{stage} ms/turn", value, base.get("stages", {}).get(stage), MIN_DELTA_MS)
+    return regressions
+
+
+def report(results: Dict[str, Dict[str, Any]]) -> None:
+    for name, result in results.items():
+        memory = result.get("memory_kb_per_turn")
+        memory = f"{memory:.1f} KB" if memory is not None else "n/a"
+        print(
+            f"{name}: {result['turns']} turns in {result['elapsed']:.2f}s, {result['turns_per_sec']:.1f} turns/sec, "
+            f"overhead {result['overhead_ms_per_turn']:.2f} ms/turn, memory {memory}/turn, {result['errors']} errors"
+        )
+        for stage, value in sorted(result["stages"].items(), key=lambda item: -item[1]):
+            print(f"    {stage:50} {value:8.2f} ms/turn")
+
+
+def parse_latencies(specs: List[str]) -> Dict[str, LatencyModel]:
+    latencies = {}
+    for spec in specs:
+        role, _, distribution = spec.partition("=")
+        roles = ROLES if role == "all" else [role]
+        if any(r not in ROLES for r in roles) or not distribution:
+            raise ValueError(f"invalid latency {spec}, expected ROLE=SPEC with ROLE in all, {', '.join(ROLES)}")
+        for r in roles:
+            latencies[r] = LatencyModel(distribution)
+    return latencies
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the agent pipeline on recorded scenarios, offline.")
+    parser.add_argument("--demos", default=DEFAULT_DEMO_DIR, help="directory of the recorded scenarios")
+    parser.add_argument("--scenario", action="append", default=[], help="only run the scenarios with these names")
+    parser.add_argument(
+        "--latency",
+        action="append",
+        default=[],
+        metavar="ROLE=SPEC",
+        help="simulated latency per role (all, " + ", ".join(ROLES) + "), e.g. controller=lognormal:1.5:0.4",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scenario, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip the memory measurement run")
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative slowdown reported as a regression")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    try:
+        latencies = parse_latencies(args.latency)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    # The sandbox is replayed and traces are collected in memory
+    os.environ.setdefault("PYTHON_BIN_DIR", os.path.dirname(sys.executable))
+    os.environ.setdefault("TRACE_PATH", "")
+
+    scenarios = Scenario.from_demos(args.demos)
+    if args.scenario:
+        scenarios = [s for s in scenarios if s.name in args.scenario]
+    if not scenarios:
+        sys.exit(f"no scenarios found in {args.demos}")
+
+    results = run_benchmark(scenarios, latencies, args.repeat, args.seed, not args.no_memory)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for name, result in results.items():
+            if name in baseline and baseline[name].get("latency", {}) != result["latency"]:
+                print(f"\n{name}: not compared, the baseline was run with other latencies")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regressions against {args.baseline}:")
+            for regression in regressions:
+                print(f"    {regression}")
+            sys.exit(1)
+        print(f"\nno regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
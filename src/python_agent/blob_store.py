@@ -0,0 +1,108 @@
+import hashlib
+import threading
+from typing import Any, Dict, Optional, Set
+
+"""
+Content-addressed storage of the large strings of a session.
+
+The code, stdout and stderr of a turn are carried in the data of every message the skills, the
+evaluator and the chat history create from it. A BlobStore keeps one copy of each distinct large
+string: messages and controller state hold the canonical string, and snapshots hold a
+{"$blob": id} handle in its place, with each blob saved once.
+"""
+
+# Strings shorter than this are cheaper to keep inline than to reference
+BLOB_MIN_SIZE = 1024
+BLOB_KEY = "$blob"
+
+
+def blob_id(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+def is_blob_ref(value: Any) -> bool:
+    return isinstance(value, dict) and len(value) == 1 and BLOB_KEY in value
+
+
+class BlobStore:
+    """The distinct large strings of a session, by content hash."""
+
+    def __init__(self, min_size: int = BLOB_MIN_SIZE):
+        """
+        Initialize a new instance
+
+        Parameters:
+            min_size (int): strings of this many characters or more are stored as blobs
+        """
+        self.min_size = min_size
+        self._blobs: Dict[str, str] = {}
+        # Blob ids of the canonical strings, by object identity, to skip hashing them again
+        self._ids: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+    def put(self, text: str) -> str:
+        """Store `text` and return its blob id."""
+        with self._lock:
+            known = self._ids.get(id(text))
+            if known is not None and self._blobs.get(known) is text:
+                return known
+            key = blob_id(text)
+            canonical = self._blobs.setdefault(key, text)
+            self._ids[id(canonical)] = key
+            return key
+
+    def get(self, key: str) -> Optional[str]:
+        return self._blobs.get(key)
+
+    def intern(self, value: Any) -> Any:
+        """`value` with its large strings replaced by the stored copy of the same content."""
+        if isinstance(value, str):
+            if len(value) < self.min_size:
+                return value
+            return self._blobs[self.put(value)]
+        if isinstance(value, dict):
+            return {key: self.intern(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.intern(item) for item in value]
+        return value
+
+    def encode(self, value: Any, used: Set[str]) -> Any:
+        """`value` with its large strings replaced by blob handles, adding the ids of the blobs to `used`."""
+        if isinstance(value, str):
+            if len(value) < self.min_size:
+                return value
+            key = self.put(value)
+            used.add(key)
+            return {BLOB_KEY: key}
+        if isinstance(value, dict):
+            return {key: self.encode(item, used) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.encode(item, used) for item in value]
+        return value
+
+    def decode(self, value: Any, blobs: Optional[Dict[str, str]] = None) -> Any:
+        """
+        `value` with its blob handles replaced by the stored strings, or by those of `blobs`.
+        Its large strings are interned, so that data saved before blobs existed is shared as well.
+        """
+        if isinstance(value, str):
+            return self.intern(value)
+        if is_blob_ref(value):
+            key = value[BLOB_KEY]
+            text = self._blobs.get(key)
+            if text is None:
+                if blobs is None or key not in blobs:
+                    raise KeyError(f"missing blob {key}")
+                text = self._blobs[self.put(blobs[key])]
+            return text
+        if isinstance(value, dict):
+            return {key: self.decode(item, blobs) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.decode(item, blobs) for item in value]
+        return value
+
+    def blobs(self, keys: Set[str]) -> Dict[str, str]:
+        return {key: self._blobs[key] for key in keys if key in self._blobs}
@@ -0,0 +1,95 @@
+import itertools
+import logging
+import threading
+from typing import Callable, Dict
+
+logger = logging.getLogger("council")
+
+"""
+Cancellation of the turn an AgentApp is running.
+
+A turn keeps an LLM slot, a worker thread and possibly a sandbox process busy until it finishes.
+AgentApp.cancel, called from another thread, e.g. by /cancel, stops it early: the controller and
+the skills check the TurnCancellation of their session before every step, the GatewayLLM stops
+waiting for its admission or its response, and the sandbox process group of the turn is killed.
+The turn then ends with a message telling the user it was cancelled and leaves the code unchanged.
+"""
+
+
+class TurnCancelled(Exception):
+    """Raised in the thread running a turn when the turn is cancelled."""
+
+
+class TurnCancellation:
+    """Cancellation of the current turn of a session, requested from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = False
+        self._cancelled = False
+        self._callbacks: Dict[int, Callable[[], None]] = {}
+        self._ids = itertools.count()
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def start_turn(self) -> None:
+        with self._lock:
+            self._running = True
+            self._cancelled = False
+            self._callbacks.clear()
+
+    def finish_turn(self) -> None:
+        with self._lock:
+            self._running = False
+            self._callbacks.clear()
+
+    def cancel(self) -> bool:
+        """
+        Cancel the current turn, and run the callbacks registered with `on_cancel`.
+
+        Returns:
+            False if no turn is running or it is already cancelled
+        """
+        with self._lock:
+            if not self._running or self._cancelled:
+                return False
+            self._cancelled = True
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("failed to run a cancellation callback")
+        return True
+
+    def check(self) -> None:
+        """Raise TurnCancelled if the current turn is cancelled."""
+        if self._cancelled:
+            raise TurnCancelled("the turn was cancelled")
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Call `callback` when the current turn is cancelled, right away if it already is.
+
+        Returns:
+            a function that removes the callback
+        """
+        with self._lock:
+            if not self._cancelled:
+                key = next(self._ids)
+                self._callbacks[key] = callback
+
+                def unregister():
+                    with self._lock:
+                        self._callbacks.pop(key, None)
+
+                return unregister
+        callback()
+        return lambda: None
@@ -0,0 +1,165 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from python_agent.preflight import preflight_check
+from python_agent.symbol_index import SymbolIndex
+
+logger = logging.getLogger("council")
+
+"""
+Analysis of the code posted by the editor, ahead of the turn that needs it.
+
+Parsing, indexing and the static pre-flight check of the code used to wait for the next message.
+When the editor posts code, a CodeAnalyzer now runs them in the background: once the editor has
+been quiet for CODE_ANALYSIS_DELAY seconds, on one of CODE_ANALYSIS_WORKERS threads shared by all
+sessions. Code posted again before its analysis starts replaces it, and an analysis still running
+stops between steps when newer code was posted.
+
+The results land where the turn looks for them: the SymbolIndex shared by the code generation and
+error correction skills, and the diagnostics of the analyzer, which the execution skill hands to the
+sandbox instead of checking the same code again. The first check also lists the modules installed in
+the sandbox. "Run it" and "fix it" then find them ready.
+"""
+
+
+class AnalysisScheduler:
+    """Runs the task of a key on a background thread once the key was not submitted again for `delay` seconds."""
+
+    _default: Optional["AnalysisScheduler"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, delay: float = 0.5, workers: int = 2):
+        """
+        Initialize a new instance
+
+        Parameters:
+            delay (float): seconds without a new submission of a key before its task runs
+            workers (int): number of tasks run at the same time
+        """
+        self.delay = delay
+        self._workers = max(workers, 1)
+        self._condition = threading.Condition()
+        self._pending: Dict[Any, Tuple[float, Callable[[], None]]] = {}
+        self._running: Set[Any] = set()
+        self._threads: List[threading.Thread] = []
+        self._pid: Optional[int] = None
+
+    @staticmethod
+    def default() -> "AnalysisScheduler":
+        """The scheduler shared by all sessions of the process, configured from the environment."""
+        with AnalysisScheduler._default_lock:
+            if AnalysisScheduler._default is None:
+                AnalysisScheduler._default = AnalysisScheduler(
+                    delay=float(os.environ.get("CODE_ANALYSIS_DELAY", 0.5)),
+                    workers=int(os.environ.get("CODE_ANALYSIS_WORKERS", 2)),
+                )
+            return AnalysisScheduler._default
+
+    def submit(self, key: Any, task: Callable[[], None]) -> None:
+        """Run `task` after the delay, in place of the task of `key` still waiting, if any."""
+        with self._condition:
+            self._pending[key] = (time.monotonic() + self.delay, task)
+            self._start_workers()
+            self._condition.notify_all()
+
+    def _start_workers(self) -> None:
+        # Threads don't survive a fork, start them again in a forked worker process
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._threads = []
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(target=self._work, name=f"code-analysis-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self) -> Tuple[Any, Callable[[], None]]:
+        """The next task due, once it is, skipping keys whose previous task is still running."""
+        with self._condition:
+            while True:
+                due = [(at, key) for key, (at, _) in self._pending.items() if key not in self._running]
+                if not due:
+                    self._condition.wait()
+                    continue
+                at, key = min(due, key=lambda item: item[0])
+                delay = at - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                _, task = self._pending.pop(key)
+                self._running.add(key)
+                return key, task
+
+    def _work(self) -> None:
+        while True:
+            key, task = self._next()
+            try:
+                task()
+            except Exception:
+                logger.exception("code analysis failed")
+            finally:
+                with self._condition:
+                    self._running.discard(key)
+                    self._condition.notify_all()
+
+
+class CodeAnalyzer:
+    """The background analysis of the code of a session."""
+
+    def __init__(
+        self,
+        symbol_index: SymbolIndex,
+        sandbox_path: Optional[str],
+        focus_min_lines: int = 0,
+        scheduler: Optional[AnalysisScheduler] = None,
+    ):
+        """
+        Initialize a new instance
+
+        Parameters:
+            symbol_index (SymbolIndex): the index used by the skills of the session
+            sandbox_path (str): the sandbox `bin` directory, whose modules the pre-flight check knows
+            focus_min_lines (int): code of this many lines or more is indexed, 0 to never index it
+            scheduler (AnalysisScheduler): runs the analyses, by default the one of the process
+        """
+        self.symbol_index = symbol_index
+        self.sandbox_path = sandbox_path
+        self.focus_min_lines = focus_min_lines
+        self._scheduler = scheduler or AnalysisScheduler.default()
+        self._submitted: Optional[str] = None
+        # The code analysed last and its pre-flight diagnostics
+        self._diagnostics: Optional[Tuple[str, List[str]]] = None
+
+    def submit(self, code: Optional[str]) -> None:
+        """Analyse `code` in the background, instead of the code submitted before it. Empty code is not analysed."""
+        self._submitted = code
+        if not code:
+            return
+        self._scheduler.submit(self, lambda: self._analyze(code))
+
+    def diagnostics(self, code: str) -> Optional[List[str]]:
+        """The pre-flight diagnostics of `code` if it is the code analysed last, None otherwise."""
+        analysed = self._diagnostics
+        if analysed is None or analysed[0] != code:
+            return None
+        return analysed[1]
+
+    def _superseded(self, code: str) -> bool:
+        return self._submitted is not code
+
+    def _analyze(self, code: str) -> None:
+        if self._superseded(code):
+            return
+        start = time.monotonic()
+        if self.focus_min_lines and code.count("\n") + 1 >= self.focus_min_lines:
+            self.symbol_index.update(code)
+            if self._superseded(code):
+                return
+        diagnostics = preflight_check(code, self.sandbox_path)
+        self._diagnostics = (code, diagnostics)
+        logger.debug(
+            f"code analysis: {code.count(chr(10)) + 1} lines, {len(diagnostics)} diagnostics"
+            f" in {time.monotonic() - start:.3f}s"
+        )
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+"""
+A versioned code document shared by the editor and the server.
+
+Edits are exchanged as line patches against a revision both sides know about:
+    {"start": first replaced line, "end": line after the last replaced line, "lines": new lines}
+Lines are split on newline characters only, so the same patch applies identically in Python and JavaScript.
+"""
+
+
+class RevisionConflict(Exception):
+    """Raised when a patch doesn't apply to the current revision of the document."""
+
+
+def checksum(text: str) -> str:
+    """32-bit FNV-1a hash of the UTF-8 encoded text, as lowercase hex (mirrors `checksum` in app.js)."""
+    h = 0x811C9DC5
+    for b in text.encode("utf-8"):
+        h ^= b
+        h = (h * 0x01000193) & 0xFFFFFFFF
+    return format(h, "x")
+
+
+def make_patch(old: str, new: str) -> Dict:
+    """Build the smallest single-range line patch that turns `old` into `new`."""
+    old_lines = old.split("\n")
+    new_lines = new.split("\n")
+
+    start = 0
+    max_start = min(len(old_lines), len(new_lines))
+    while start < max_start and old_lines[start] == new_lines[start]:
+        start += 1
+
+    old_end = len(old_lines)
+    new_end = len(new_lines)
+    while old_end > start and new_end > start and old_lines[old_end - 1] == new_lines[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+
+    return {"start": start, "end": old_end, "lines": new_lines[start:new_end]}
+
+
+def apply_patch(text: str, patch: Dict) -> str:
+    """Apply a patch built by `make_patch` to `text`."""
+    lines = text.split("\n")
+    start, end = patch["start"], patch["end"]
+    if not 0 <= start <= end <= len(lines):
+        raise RevisionConflict(f"patch range {start}:{end} is outside of the document ({len(lines)} lines)")
+    lines[start:end] = patch["lines"]
+    return "\n".join(lines)
+
+
+class CodeDocument:
+    """
+    The server copy of the code in the editor, with a revision number that increases on every change.
+
+    A few recent revisions are kept so that replies can be sent as patches from the revision the client has.
+    """
+
+    def __init__(self, text: str = "", history_size: int = 32):
+        self._history_size = history_size
+        self._revision = 0
+        self._text = text
+        self._history: "OrderedDict[int, str]" = OrderedDict({0: text})
+
+    @property
+    def revision(self) -> int:
+        return self._revision
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    def commit(self, text: Optional[str]) -> int:
+        """Replace the whole document, creating a new revision if the text changed."""
+        text = text if text is not None else ""
+        if text != self._text:
+            self._revision += 1
+            self._text = text
+            self._history[self._revision] = text
+            while len(self._history) > self._history_size:
+                self._history.popitem(last=False)
+        return self._revision
+
+    def apply(self, base_revision: int, patch: Optional[Dict], expected_checksum: Optional[str] = None) -> int:
+        """
+        Apply a client patch made against `base_revision` and return the new revision.
+
+        Raises:
+            RevisionConflict: if the document changed since `base_revision`, or if the result doesn't match the
+                checksum computed by the client
+        """
+        if base_revision != self._revision:
+            raise RevisionConflict(f"patch is based on revision {base_revision}, document is at {self._revision}")
+        if patch is None:
+            return self._revision
+
+        text = apply_patch(self._text, patch)
+        if expected_checksum is not None and checksum(text) != expected_checksum:
+            raise RevisionConflict("document checksum doesn't match after applying the patch")
+        return self.commit(text)
+
+    def diff_from(self, revision: int) -> Optional[Dict]:
+        """Patch from `revision` to the current revision, or None if that revision is no longer known."""
+        text = self._history.get(revision)
+        if text is None:
+            return None
+        return make_patch(text, self._text)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize the document and its history to JSON-compatible data."""
+        return {
+            "revision": self._revision,
+            "history": [[revision, text] for revision, text in self._history.items()],
+        }
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any], history_size: int = 32) -> "CodeDocument":
+        document = CodeDocument(history_size=history_size)
+        document._history = OrderedDict((revision, text) for revision, text in data["history"])
+        document._revision = data["revision"]
+        document._text = document._history[document._revision]
+        return document
@@ -1,7 +1,11 @@
 from contextlib import contextmanager
+import os
+import signal
 import subprocess
 import sys
 
+from python_agent.preflight import preflight_check
+
 """
 Instructions to set up code sandbox.
 1. cd to 'this' directory
@@ -36,13 +40,58 @@ def sandbox_environment(sandbox_path):
         sys.modules = original_sys_modules
 
 
-def run_code_in_sandbox(code, sandbox_path):
+def kill_process_group(process):
+    """Kill `process` and the processes it started, e.g. a pygame window."""
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        process.kill()
+
+
+def run_code_in_sandbox(code, sandbox_path, preflight=True, cancellation=None, diagnostics=None):
+    if preflight:
+        # Fail fast on errors that can be found without starting a process. `diagnostics` are those
+        # of the code analysis, when it already checked this code
+        if diagnostics is None:
+            diagnostics = preflight_check(code, sandbox_path)
+        if diagnostics:
+            print("Pre-flight check failed, not starting execution.")
+            return {
+                "code": code,
+                "returncode": 1,
+                "stdout": "",
+                "stderr": "Pre-flight check failed:\n" + "\n".join(diagnostics),
+            }
+
+    if cancellation is not None:
+        cancellation.check()
+
     with sandbox_environment(sandbox_path):
         print("Starting execution...")
-        execution = subprocess.run([f"{sandbox_path}/python", "-c", code], capture_output=True)
+        # In its own process group, which is killed when the turn is cancelled
+        process = subprocess.Popen(
+            [f"{sandbox_path}/python", "-c", code],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        unregister = cancellation.on_cancel(lambda: kill_process_group(process)) if cancellation is not None else None
+        try:
+            stdout, stderr = process.communicate()
+        except BaseException:
+            kill_process_group(process)
+            raise
+        finally:
+            if unregister is not None:
+                unregister()
+        if cancellation is not None:
+            cancellation.check()
         return {
             "code": code,
-            "returncode": execution.returncode,
-            "stdout": execution.stdout.decode(),
-            "stderr": execution.stderr.decode(),
+            "returncode": process.returncode,
+            "stdout": stdout.decode(),
+            "stderr": stderr.decode(),
         }
@@ -1,11 +1,13 @@
 import logging
+import re
+import time
 from string import Template
-from typing import List, Tuple
+from typing import Callable, List, Optional, Tuple
 
 from council.contexts import (
     AgentContext,
-    ScoredChatMessage,
     ChatMessage,
+    ScoredChatMessage,
 )
 
 from council.chains import Chain
@@ -14,8 +16,16 @@ from council.utils import Option
 from council.runners import Budget
 from council.controllers import ControllerBase, ExecutionUnit
 
+from python_agent.cancellation import TurnCancellation
+from python_agent.events import AgentEvents
+from python_agent.llm_gateway import count_prompt_tokens, count_text_tokens, prompt_allowance
+from python_agent.plan import PlanStep, final_steps
+
 logger = logging.getLogger("council")
 
+# Numbering or bullets the LLM may put in front of the lines of a plan
+_LINE_PREFIX = re.compile(r"^\s*(?:\d+[.)]|[-*])\s*")
+
 class LLMInstructController(ControllerBase):
     """
     A LLM controller that also generates instructions for the chains it selects. 
@@ -29,6 +39,9 @@ class LLMInstructController(ControllerBase):
         hints: List[str] = "",
         response_threshold: float = 0,
         top_k_execution_plan: int = 10000,
+        events: Optional[AgentEvents] = None,
+        cancellation: Optional[TurnCancellation] = None,
+        max_plan_steps: int = 1,
     ):
         """
         Initialize a new instance
@@ -38,20 +51,41 @@ class LLMInstructController(ControllerBase):
             hints (List(str)): Application-specific hints to pass to the LLM (e.g. ["If the user is asking for a recipe, always ask the 'Recipes' chain for something extra spicy."])
             response_threshold (float): a minimum threshold to select a response from its score
             top_k_execution_plan (int): maximum number of execution plan returned
+            events (AgentEvents): where plan and controller_decision events are published
+            cancellation (TurnCancellation): stops planning when the turn is cancelled, by raising TurnCancelled
+            max_plan_steps (int): maximum number of chains run in sequence from a single decision, 1 for one chain
         """
         self._llm = llm
         self._hints = hints
         self._response_threshold = response_threshold
         self._top_k = top_k_execution_plan
+        self._events = events or AgentEvents()
+        self._cancellation = cancellation
+        self._max_plan_steps = max_plan_steps
 
         # Controller State
         self._state = {
             "iteration": 0
         }
 
+        # The PlanSteps returned by the last call to get_plan
+        self._dispatched: List[PlanStep] = []
+
+    @property
+    def dispatched_units(self) -> List[str]:
+        """
+        Names of the ExecutionUnits dispatched in the current iteration whose result is the outcome of
+        their plan: the last step that ran of a multi-step plan
+        """
+        return [step.name for step in final_steps(self._dispatched)]
+
     def get_plan(
         self, context: AgentContext, chains: List[Chain], budget: Budget
     ) -> List[ExecutionUnit]:
+        if self._cancellation is not None:
+            self._cancellation.check()
+        start = time.monotonic()
+        self._events.emit("plan_started")
         chain_details = "\n ".join(
             [f"name: {c.name}, description: {c.description}" for c in chains]
         )
@@ -71,7 +105,7 @@ class LLMInstructController(ControllerBase):
         Read the following Chain details given as name and a description (name: {name}, description: {description})
         $chain_details
 
-        - Select exactly one chain, assign a score out of 10 based on your confidence, and give the chain instructions that will best address the USER MESSAGE
+        - Select exactly one chain, assign a score out of 10 based on your confidence, and give the chain instructions that will best address the USER MESSAGE$plan_instructions
         - You will answer with {name};{integer score between 0 and 10};{natural language message or instructions for the selected chain on a single line}
         - You must ensure that your generated instructions are all on a single line
         - When no category is relevant, you will answer exactly with 'unknown'
@@ -91,20 +125,57 @@ class LLMInstructController(ControllerBase):
         # Controller Decision (formatted precisely as {name};{integer score between 0 and 10};{natural language message or instructions for the selected chain on a single line})
         """)
 
-        main_prompt = main_prompt_template.substitute(
-            chain_details=chain_details,
-            hints='\n'.join(self._hints),
-            controller_state=self._state,
-            conversation_history='\n'.join(conversation_history),
-            user_message=conversation_history[-1]
-        )
+        plan_instructions = ""
+        if self._max_plan_steps > 1:
+            plan_instructions = (
+                "\n        - When the USER MESSAGE asks for several things done in order, such as writing code and then"
+                f" running it, you may instead select up to {self._max_plan_steps} chains, answering with one line per"
+                " chain in the order they must run. Each chain continues from the result of the one before it, and the"
+                " chains after a failing one are skipped"
+            )
 
-        messages = [
-            LLMMessage.system_message(system_message),
-            LLMMessage.user_message(main_prompt),
-        ]
+        def build_messages(history: List[str]) -> List[LLMMessage]:
+            main_prompt = main_prompt_template.substitute(
+                chain_details=chain_details,
+                plan_instructions=plan_instructions,
+                hints='\n'.join(self._hints),
+                controller_state=self._state,
+                conversation_history='\n'.join(history),
+                user_message=conversation_history[-1]
+            )
+            return [
+                LLMMessage.system_message(system_message),
+                LLMMessage.user_message(main_prompt),
+            ]
+
+        messages = build_messages(conversation_history)
+        allowance = prompt_allowance(self._llm)
+        if allowance is not None:
+            total = count_prompt_tokens(self._llm, messages)
+            if total > allowance:
+                # Drop the oldest messages of the conversation until the prompt fits in the token budget,
+                # counting the tokens of each message once
+                def count_line(line: str) -> int:
+                    return count_text_tokens(self._llm, line + "\n")
+
+                total += count_line(f"[{len(conversation_history)} earlier messages omitted]")
+                dropped = 0
+                while total > allowance and dropped < len(conversation_history) - 1:
+                    total -= count_line(conversation_history[dropped])
+                    dropped += 1
+                if dropped > 0:
+                    history = [f"[{dropped} earlier messages omitted]"] + conversation_history[dropped:]
+                    messages = build_messages(history)
 
-        response = self._llm.post_chat_request(messages).first_choice
+        # Every plan_started is closed, also when the request fails, so that the turn can be traced
+        is_error = True
+        try:
+            response = self._llm.post_chat_request(messages).first_choice
+            is_error = False
+        finally:
+            if is_error:
+                self._dispatched = []
+                self._events.emit("plan_finished", units=0, is_error=True, duration=time.monotonic() - start)
         logger.debug(f"llm response: {response}")
 
         parsed = [self.parse_line(line, chains) for line in response.strip().splitlines()]
@@ -114,57 +185,91 @@ class LLMInstructController(ControllerBase):
             if r.is_some() and r.unwrap()[1] > self._response_threshold
         ]
         if (filtered is None) or (len(filtered) == 0):
+            self._dispatched = []
+            self._events.emit("plan_finished", units=0, is_error=False, duration=time.monotonic() - start)
             return []
 
-        filtered.sort(key=lambda item: item[1], reverse=True)
-        result = []
-        for chain, score, instructions in filtered:
-            if chain is not None:
-                exec_unit = ExecutionUnit(
+        data = self._state | {"iteration": self._state["iteration"]}
+        if self._max_plan_steps > 1 and len(filtered) > 1:
+            # The lines are the steps of a plan, in the order they run
+            decisions = filtered[: self._max_plan_steps]
+            result = []
+            previous = None
+            for position, (chain, score, instructions) in enumerate(decisions, start=1):
+                previous = PlanStep(
                     chain,
                     budget,
-                    initial_state=ChatMessage.chain(
-                        message=instructions,
-                        data=self._state | {"iteration": self._state["iteration"]},
-                    ),
-                    name=f"{chain.name};{score}",
+                    instructions,
+                    data,
+                    name=f"{chain.name};{score};step {position}/{len(decisions)}",
+                    previous=previous,
                 )
-                result.append(exec_unit)
-                logger.info(f"Controller Message: {chain.name};{score};{instructions}")
+                result.append(previous)
+        else:
+            # The lines are alternatives, the best ones run
+            filtered.sort(key=lambda item: item[1], reverse=True)
+            decisions = filtered[: self._top_k]
+            result = [
+                PlanStep(chain, budget, instructions, data, name=f"{chain.name};{score}")
+                for chain, score, instructions in decisions
+            ]
+        for chain, score, instructions in decisions:
+            logger.info(f"Controller Message: {chain.name};{score};{instructions}")
 
-        controller_result = result[: self._top_k]
-        return controller_result
+        duration = time.monotonic() - start
+        self._events.emit("plan_finished", units=len(result), is_error=False, duration=duration)
+        for chain, score, instructions in decisions:
+            self._events.emit(
+                "controller_decision", chain=chain.name, score=score, instructions=instructions, duration=duration
+            )
+        self._dispatched = result
+        return result
+
+    @staticmethod
+    def decision_validator(chains: List[Chain], min_score: int = 0) -> Callable[[str], bool]:
+        """
+        A function telling whether an LLM response holds a decision for one of `chains` scored at least `min_score`.
+        """
+
+        def accept(response: str) -> bool:
+            for line in response.strip().splitlines():
+                parsed = LLMInstructController.parse_line(line, chains)
+                if parsed.is_some() and parsed.unwrap()[1] >= min_score:
+                    return True
+            return False
+
+        return accept
 
     @staticmethod
     def parse_line(line: str, chains: List[Chain]) -> Option[Tuple[Chain, int, str]]:
         result: Option[Tuple[Chain, int, str]] = Option.none()
         try:
-            (name, score, instructions) = line.split(";", 3)
+            (name, score, instructions) = _LINE_PREFIX.sub("", line).split(";", 3)
             chain = next(filter(lambda item: item.name == name, chains))
             result = Option.some((chain, int(score), instructions))
         finally:
             return result
 
     def select_responses(self, context: AgentContext) -> List[ScoredChatMessage]:
-        
-        # Get the "last" results from each chain
-        all_eval_results = context.last_evaluator_iteration()
-
-        # Only include results from the current iteration
-        current_iteration_results = []
-        for scored_result in all_eval_results:
-            message = scored_result.message
-            logger.debug(f"eval result from iteration {message.data['iteration']}: {message}, {message.data}")
-            if isinstance(message.data, dict):
-                if message.data["iteration"] == self._state["iteration"]:
-                    current_iteration_results.append(scored_result)
-
-        # Sort the results based on the Evaluator's score
-        current_iteration_results = sorted(current_iteration_results, key=lambda x: x.score, reverse=True)
-        logger.debug(f"select_responses result at iteration {self._state['iteration']}: {current_iteration_results}")
-
-        # Get the top result
-        scored_message = current_iteration_results[0]
+
+        # Get the ranked results from the evaluator - the best result comes first
+        all_eval_results = context.last_evaluator_iteration() or []
+        scored_message = all_eval_results[0] if all_eval_results else None
+        if scored_message is not None and not self._is_current_iteration(scored_message):
+            # The evaluator also scored chains from previous iterations, fall back to the first current one
+            logger.debug(f"select_responses: top result is not from iteration {self._state['iteration']}")
+            scored_message = next(filter(self._is_current_iteration, all_eval_results), None)
+        if scored_message is None:
+            # End the turn with an error rather than planning again until the budget runs out
+            logger.warning(f"select_responses: no result from iteration {self._state['iteration']}")
+            self._state["iteration"] += 1
+            message = ChatMessage.agent(
+                "Sorry, the chains selected for this message did not return a result.",
+                data=self._state.copy(),
+                is_error=True,
+            )
+            return [ScoredChatMessage(message, 0)]
+
         logger.debug(f"scored message: {scored_message.message.message}")
         logger.debug(f"scored message data: {scored_message.message.data}")
 
@@ -176,4 +281,7 @@ class LLMInstructController(ControllerBase):
 
         # Return only the top result
         return [scored_message]
-    
+
+    def _is_current_iteration(self, scored_result: ScoredChatMessage) -> bool:
+        data = scored_result.message.data
+        return isinstance(data, dict) and data.get("iteration") == self._state["iteration"]
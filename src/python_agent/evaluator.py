@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 from council.contexts import (
     AgentContext,
@@ -28,4 +28,49 @@ class BasicEvaluatorWithSource(EvaluatorBase):
                     score,
                 )
             )
-        return result
+        # Rank the results so that the best one is always first
+        return sorted(result, key=lambda x: x.score, reverse=True)
+
+
+class IncrementalEvaluatorWithSource(EvaluatorBase):
+    """
+    A BasicEvaluatorWithSource that only scores the ExecutionUnits dispatched in the current iteration.
+
+    The names of the dispatched units are read from the controller, so the cost of an iteration depends on
+    what ran in it rather than on how many chains have run over the whole session.
+    """
+
+    def __init__(self, controller):
+        """
+        Initialize a new instance
+
+        Parameters:
+            controller (LLMInstructController): the controller whose `dispatched_units` are evaluated
+        """
+        self._controller = controller
+
+    def execute(self, context: AgentContext, budget: Budget) -> List[ScoredChatMessage]:
+        best: Optional[ScoredChatMessage] = None
+        others = []
+        for unit_name in self._controller.dispatched_units:
+            chain_history = context.chainHistory.get(unit_name)
+            if not chain_history or len(chain_history[-1].messages) == 0:
+                continue
+            chain_result = chain_history[-1].messages[-1]
+            score = 1 if chain_result.is_kind_skill and chain_result.is_ok else 0
+            scored_message = ScoredChatMessage(
+                ChatMessage.agent(chain_result.message,
+                                  chain_result.data,
+                                  source=chain_result.source,
+                                  is_error=chain_result.is_error),
+                score,
+            )
+            if best is None or score > best.score:
+                if best is not None:
+                    others.append(best)
+                best = scored_message
+            else:
+                others.append(scored_message)
+
+        # The winning result is always first
+        return [] if best is None else [best, *others]
@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+from council.agents import Agent
+from council.contexts import AgentContext
+from council.controllers import ExecutionUnit
+from council.runners import Budget
+
+from python_agent.plan import PlanStep
+
+logger = logging.getLogger("council")
+
+"""
+Progress events published while an AgentApp handles a turn.
+
+Event kinds and their data:
+    turn_started         message
+    plan_started
+    plan_finished        units, is_error, duration
+    controller_decision  chain, score, instructions, duration
+    chain_started        chain, unit
+    chain_skipped        chain, unit
+    skill_started        skill
+    llm_request          prompt_tokens, completion_tokens, duration, is_error
+    escalated
+    skill_finished       skill, is_error, duration
+    sandbox_exited       returncode, stdout_size, stderr_size, duration
+    chain_finished       chain, unit, duration
+    turn_finished        is_error, cancelled, duration
+
+Every event also carries its `kind`, a `timestamp`, and the `chain` and `skill` being executed, if any.
+"""
+
+Event = Dict[str, Any]
+
+
+class AgentEvents:
+    """Publishes the progress events of an AgentApp to its subscribers."""
+
+    def __init__(self):
+        self._subscribers: List[Callable[[Event], None]] = []
+        self._lock = threading.Lock()
+        self.current_chain = None
+        self.current_skill = None
+
+    def subscribe(self, callback: Callable[[Event], None]) -> Callable[[], None]:
+        """
+        Call `callback` with every event published from now on.
+
+        Returns:
+            a function that removes the subscription
+        """
+        with self._lock:
+            self._subscribers = [*self._subscribers, callback]
+
+        def unsubscribe():
+            with self._lock:
+                self._subscribers = [s for s in self._subscribers if s is not callback]
+
+        return unsubscribe
+
+    def emit(self, kind: str, **data: Any) -> None:
+        event = {
+            "kind": kind,
+            "timestamp": time.time(),
+            "chain": self.current_chain,
+            "skill": self.current_skill,
+            **data,
+        }
+        for callback in self._subscribers:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception(f"failed to deliver event {kind}")
+
+
+class ObservableAgent(Agent):
+    """
+    An Agent that publishes chain_started and chain_finished events around each ExecutionUnit.
+    The steps of a plan following a failed step are skipped.
+    """
+
+    def __init__(self, *args, events: AgentEvents, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.events = events
+
+    def _execute_unit(self, context: AgentContext, unit: ExecutionUnit) -> Budget:
+        self.events.current_chain = unit.chain.name
+        if isinstance(unit, PlanStep) and not unit.runnable:
+            logger.info(f"skipping {unit.name}, the previous step of the plan did not succeed")
+            self.events.emit("chain_skipped", unit=unit.name)
+            self.events.current_chain = None
+            return unit.budget
+        self.events.emit("chain_started", unit=unit.name)
+        start = time.monotonic()
+        try:
+            budget = super()._execute_unit(context, unit)
+            if isinstance(unit, PlanStep):
+                unit.record(context)
+            return budget
+        finally:
+            self.events.emit("chain_finished", unit=unit.name, duration=time.monotonic() - start)
+            self.events.current_chain = None
@@ -0,0 +1,165 @@
+import collections
+import itertools
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+"""
+Background execution of agent turns.
+
+A Job records the progress events of one turn and its final result. Jobs run on a bounded
+worker pool; when the pool and its queue are full, submissions are rejected so that callers
+can back off instead of piling up server threads. The jobs of a session run one after the
+other: a job waits for the previous job of its session before it is given to a worker, so
+that no worker waits for the turn of another.
+"""
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+class Job:
+    """The progress events and the result of one background turn."""
+
+    def __init__(self, session_id: str):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.status = "queued"
+        self.result: Optional[Tuple[Any, int]] = None
+        self.finished_at: Optional[float] = None
+        self.cancelled = False
+        self._events: List[Tuple[int, Dict]] = []
+        self._ids = itertools.count(1)
+        self._condition = threading.Condition()
+
+    def add_event(self, event: Dict) -> None:
+        with self._condition:
+            self._events.append((next(self._ids), event))
+            self._condition.notify_all()
+
+    def finish(self, status: str, result: Tuple[Any, int]) -> None:
+        with self._condition:
+            self.status = status
+            self.result = result
+            self.finished_at = time.monotonic()
+            self._condition.notify_all()
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def wait_for_events(self, after: int, timeout: float) -> Tuple[List[Tuple[int, Dict]], bool]:
+        """
+        Block until there are events with an id greater than `after`, or until the job is done.
+
+        Returns:
+            the new events and whether the job is done
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._events) > after or self.done, timeout=timeout)
+            return self._events[after:], self.done
+
+
+class JobQueue:
+    """Runs jobs on a fixed number of worker threads, with a bounded number of queued jobs."""
+
+    def __init__(self, max_workers: int = 4, max_queued: int = 16, retention: float = 600):
+        """
+        Initialize a new instance
+
+        Parameters:
+            max_workers (int): number of turns run concurrently
+            max_queued (int): number of jobs waiting for a worker before new jobs are rejected
+            retention (float): seconds a finished job is kept for its result to be fetched
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._capacity = max_workers + max_queued
+        self._retention = retention
+        self._jobs: Dict[str, Job] = {}
+        # The jobs waiting for the job of their session that was given to a worker, by session
+        self._waiting: Dict[str, Deque[Tuple[Job, Callable[[Job], Tuple[Any, int]]]]] = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        """Number of jobs queued or running."""
+        return self._pending
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def submit(self, session_id: str, fn: Callable[[Job], Tuple[Any, int]]) -> Job:
+        """
+        Run `fn(job)` on a worker, after the jobs of the session submitted before it.
+        `fn` returns the response body and HTTP status of the turn.
+
+        Raises:
+            JobQueueFull: if too many jobs are queued or running
+        """
+        with self._lock:
+            self._prune()
+            if self._pending >= self._capacity:
+                raise JobQueueFull(f"{self._pending} jobs are already queued or running")
+            self._pending += 1
+            job = Job(session_id)
+            self._jobs[job.id] = job
+            waiting = self._waiting.get(session_id)
+            if waiting is not None:
+                waiting.append((job, fn))
+                return job
+            self._waiting[session_id] = collections.deque()
+
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def cancel(self, session_id: str) -> int:
+        """Cancel the jobs of a session still waiting for a worker, and return their number."""
+        with self._lock:
+            queued = [job for job in self._jobs.values() if job.session_id == session_id and job.status == "queued"]
+            for job in queued:
+                job.cancelled = True
+            waiting = self._waiting.get(session_id)
+            dropped = [job for job, _ in waiting] if waiting else []
+            if waiting:
+                waiting.clear()
+            self._pending -= len(dropped)
+        for job in dropped:
+            job.finish("cancelled", ({"error": "the job was cancelled"}, 409))
+        return len(queued)
+
+    def _run(self, job: Job, fn: Callable[[Job], Tuple[Any, int]]) -> None:
+        with self._lock:
+            if not job.cancelled:
+                job.status = "running"
+        try:
+            if job.cancelled:
+                job.finish("cancelled", ({"error": "the job was cancelled"}, 409))
+                return
+            body, status = fn(job)
+            job.finish("done", (body, status))
+        except Exception as e:
+            job.finish("failed", ({"error": str(e)}, 500))
+        finally:
+            with self._lock:
+                self._pending -= 1
+                waiting = self._waiting[job.session_id]
+                following = waiting.popleft() if waiting else None
+                if following is None:
+                    del self._waiting[job.session_id]
+            if following is not None:
+                self._executor.submit(self._run, *following)
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.done and now - job.finished_at > self._retention
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+from council.llm import OpenAIChatCompletionsModel, OpenAILLMConfiguration, OpenAITokenCounter
+
+logger = logging.getLogger("council")
+
+"""
+Process-wide HTTP client for the OpenAI API.
+
+council's OpenAILLM opens a new httpx.Client, and so a new TCP and TLS connection, for every
+request. LLMClientPool keeps one keep-alive connection pool for the whole process instead, shared
+by the LLMs of every session, and builds each LLM once so that resets and new sessions reuse it.
+
+/health checks that the API is reachable, at most once every HEALTH_CHECK_MAX_AGE seconds. A background
+health check can also call the API every LLM_HEALTH_CHECK_INTERVAL seconds, which keeps a connection
+warm between turns; it is off by default.
+"""
+
+OPENAI_API_URL = "https://api.openai.com/v1"
+# Seconds the result of a health check is reported by /health before the API is checked again
+HEALTH_CHECK_MAX_AGE = 30
+
+
+class LLMClientPool:
+    """A keep-alive connection pool to the OpenAI API, and the LLMs using it."""
+
+    _default: Optional["LLMClientPool"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        keepalive_expiry: float = 60,
+        health_check_interval: float = 0,
+        connect_retries: int = 2,
+    ):
+        """
+        Initialize a new instance
+
+        Parameters:
+            pool_size (int): maximum number of connections open at the same time
+            keepalive_expiry (float): seconds an idle connection is kept open
+            health_check_interval (float): seconds between health checks, 0 to disable them
+            connect_retries (int): number of times a failed connection attempt is retried
+        """
+        self._pool_size = pool_size
+        self._keepalive_expiry = keepalive_expiry
+        self._health_check_interval = health_check_interval
+        self._connect_retries = connect_retries
+        self._lock = threading.Lock()
+        self._client: Optional[httpx.Client] = None
+        self._client_pid: Optional[int] = None
+        self._llms: Dict[Optional[str], OpenAIChatCompletionsModel] = {}
+        self._authorization: Optional[str] = None
+        self._health_thread: Optional[threading.Thread] = None
+        self._check_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.healthy: Optional[bool] = None
+        self.last_check: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    @staticmethod
+    def default() -> "LLMClientPool":
+        """The pool shared by all sessions of the process, configured from the environment."""
+        with LLMClientPool._default_lock:
+            if LLMClientPool._default is None:
+                LLMClientPool._default = LLMClientPool(
+                    pool_size=int(os.environ.get("LLM_POOL_SIZE", 10)),
+                    keepalive_expiry=float(os.environ.get("LLM_KEEPALIVE_EXPIRY", 60)),
+                    health_check_interval=float(os.environ.get("LLM_HEALTH_CHECK_INTERVAL", 0)),
+                )
+            return LLMClientPool._default
+
+    @property
+    def client(self) -> httpx.Client:
+        """The pooled client, created on first use and again in a forked worker process."""
+        with self._lock:
+            if self._client is None or self._client_pid != os.getpid():
+                self._client = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=self._pool_size,
+                        max_keepalive_connections=self._pool_size,
+                        keepalive_expiry=self._keepalive_expiry,
+                    ),
+                    transport=httpx.HTTPTransport(retries=self._connect_retries),
+                )
+                self._client_pid = os.getpid()
+            return self._client
+
+    def openai_llm(self, model: Optional[str] = None) -> OpenAIChatCompletionsModel:
+        """The OpenAI LLM configured from the environment, built once per model and sent through the pool."""
+        with self._lock:
+            llm = self._llms.get(model)
+            if llm is None:
+                config = OpenAILLMConfiguration.from_env(model=model)
+                timeout = httpx.Timeout(config.timeout, connect=10)
+                authorization = config.authorization
+
+                def post_request(payload: Dict[str, Any]) -> httpx.Response:
+                    return self.client.post(
+                        f"{OPENAI_API_URL}/chat/completions",
+                        headers={"Authorization": authorization, "Content-Type": "application/json"},
+                        json=payload,
+                        timeout=timeout,
+                    )
+
+                llm = OpenAIChatCompletionsModel(
+                    config,
+                    post_request,
+                    token_counter=OpenAITokenCounter.from_model(config.model.unwrap_or("")),
+                )
+                self._llms[model] = llm
+                self._authorization = authorization
+        self._start_health_checks()
+        return llm
+
+    def check_health(self) -> bool:
+        """Call the API once and record whether it answered."""
+        start = time.monotonic()
+        was_healthy = self.healthy
+        authorization = self._authorization
+        if authorization is None and os.environ.get("OPENAI_API_KEY"):
+            authorization = f"Bearer {os.environ['OPENAI_API_KEY']}"
+        if authorization is None:
+            self.healthy = False
+            self.last_error = "OPENAI_API_KEY is not set"
+        else:
+            try:
+                response = self.client.get(
+                    f"{OPENAI_API_URL}/models", headers={"Authorization": authorization}, timeout=10
+                )
+                self.healthy = response.status_code == httpx.codes.OK
+                self.last_error = None if self.healthy else f"status {response.status_code}"
+            except httpx.HTTPError as e:
+                self.healthy = False
+                self.last_error = f"{type(e).__name__}: {e}"
+        self.last_check = time.time()
+        if not self.healthy and was_healthy is not False:
+            # Logged when the API stops answering, not at every check until it answers again
+            logger.warning(f"llm client pool: health check failed: {self.last_error}")
+        logger.debug(f"llm client pool: health check took {time.monotonic() - start:.3f}s")
+        return self.healthy
+
+    def health(self, max_age: float = HEALTH_CHECK_MAX_AGE) -> Dict[str, Any]:
+        """The status of the API, checked again if the last check is older than `max_age` seconds."""
+        with self._check_lock:
+            if self.last_check is None or time.time() - self.last_check > max_age:
+                self.check_health()
+        return self.status()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "healthy": self.healthy,
+            "last_check": self.last_check,
+            "last_error": self.last_error,
+            "pool_size": self._pool_size,
+        }
+
+    def close(self) -> None:
+        self._stopped.set()
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def _start_health_checks(self) -> None:
+        if self._health_check_interval <= 0:
+            return
+        with self._lock:
+            if self._health_thread is not None and self._health_thread.is_alive():
+                return
+            self._health_thread = threading.Thread(
+                target=self._run_health_checks, name="llm-health-check", daemon=True
+            )
+            self._health_thread.start()
+
+    def _run_health_checks(self) -> None:
+        while not self._stopped.is_set():
+            self.check_health()
+            self._stopped.wait(self._health_check_interval)
@@ -0,0 +1,372 @@
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from enum import IntEnum
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from council.llm import LLMBase, LLMMessage, LLMResult
+
+from python_agent.cancellation import TurnCancellation, TurnCancelled
+from python_agent.events import AgentEvents
+from python_agent.token_budget import TokenAccount
+
+logger = logging.getLogger("council")
+
+"""
+Process-wide admission control for LLM requests.
+
+Every LLM call made by the controller and the skills of every session goes through a single
+LLMGateway, which:
+- limits the number of requests in flight and the tokens sent per minute
+- admits waiting requests by priority, so interactive calls overtake bulk code generation
+- coalesces identical concurrent requests into a single upstream call
+- stops waiting for a request of a cancelled turn
+
+httpx can't interrupt a request blocked on the response from another thread, so the request of a
+cancelled turn is left to finish on its own thread. It keeps its slot and its connection until
+then, so that abandoned requests still count against the limits, and the tokens of its response
+are charged when it arrives. Identical requests waiting for it get its response.
+"""
+
+
+class Priority(IntEnum):
+    """Admission priority of an LLM request, lower values are admitted first."""
+
+    INTERACTIVE = 0
+    BULK = 1
+
+
+class LLMGateway:
+    """Admits LLM requests under global concurrency and tokens-per-minute limits."""
+
+    _default: Optional["LLMGateway"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_in_flight: int = 8, tokens_per_minute: int = 0):
+        """
+        Initialize a new instance
+
+        Parameters:
+            max_in_flight (int): maximum number of requests sent upstream at the same time
+            tokens_per_minute (int): maximum number of tokens sent upstream in any 60 seconds window, 0 for no limit
+        """
+        self._max_in_flight = max_in_flight
+        self._tokens_per_minute = tokens_per_minute
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting: List[Tuple[int, int]] = []
+        self._tickets = itertools.count()
+        self._window: deque = deque()
+        self._pending: Dict[str, Future] = {}
+        self.coalesced = 0
+
+    @staticmethod
+    def default() -> "LLMGateway":
+        """The gateway shared by all sessions of the process, configured from the environment."""
+        with LLMGateway._default_lock:
+            if LLMGateway._default is None:
+                LLMGateway._default = LLMGateway(
+                    max_in_flight=int(os.environ.get("LLM_MAX_IN_FLIGHT", 8)),
+                    tokens_per_minute=int(os.environ.get("LLM_TOKENS_PER_MINUTE", 0)),
+                )
+            return LLMGateway._default
+
+    def post_chat_request(
+        self,
+        llm: LLMBase,
+        messages: List[LLMMessage],
+        priority: Priority = Priority.BULK,
+        prompt_tokens: Optional[int] = None,
+        cancellation: Optional[TurnCancellation] = None,
+        on_abandoned: Optional[Callable[[LLMResult], None]] = None,
+        **kwargs: Any,
+    ) -> LLMResult:
+        """
+        Send a chat request to `llm` once admitted. If an identical request is already in flight,
+        wait for its result instead of sending another one.
+        `prompt_tokens` is the size of the request if the caller already counted it.
+        Raises TurnCancelled as soon as `cancellation` is cancelled. The request then still runs
+        to its end, and `on_abandoned` is called with its result if it succeeds.
+        """
+        key = self._request_key(llm, messages, kwargs)
+        while True:
+            with self._condition:
+                future = self._pending.get(key)
+                leader = future is None
+                if leader:
+                    future = Future()
+                    self._pending[key] = future
+                else:
+                    self.coalesced += 1
+            if leader:
+                break
+
+            logger.debug("llm gateway: coalesced identical request")
+            try:
+                return _wait(future, cancellation)
+            except TurnCancelled:
+                if cancellation is not None and cancellation.cancelled:
+                    raise
+                # The turn of the session that sent the request was cancelled before it was admitted
+                logger.debug("llm gateway: coalesced request cancelled by its sender, sending it again")
+
+        # The request is forgotten before its waiters wake up, so that they send it again if its turn was
+        # cancelled before it was admitted
+        estimate = prompt_tokens if prompt_tokens is not None else self.count_tokens(llm, messages)
+        try:
+            entry = self._acquire(priority, estimate, cancellation)
+        except BaseException as e:
+            self._forget(key)
+            future.set_exception(e)
+            raise
+
+        def send():
+            self._send(llm, messages, key, entry, estimate, future, **kwargs)
+
+        if cancellation is None:
+            send()
+            return future.result()
+        # Wait on another thread's request, to give up on it when the turn is cancelled
+        threading.Thread(target=send, name="llm-request", daemon=True).start()
+        try:
+            return _wait(future, cancellation)
+        except TurnCancelled:
+            logger.debug("llm gateway: request abandoned, it keeps its slot until it finishes")
+            if on_abandoned is not None:
+
+                def finished(request: Future):
+                    if request.exception() is None:
+                        on_abandoned(request.result())
+
+                future.add_done_callback(finished)
+            raise
+
+    def _forget(self, key: str) -> None:
+        with self._condition:
+            del self._pending[key]
+
+    def _send(
+        self,
+        llm: LLMBase,
+        messages: List[LLMMessage],
+        key: str,
+        entry: List,
+        estimate: int,
+        future: Future,
+        **kwargs: Any,
+    ) -> None:
+        """Send an admitted request, then free its slot with the tokens it used and complete `future`."""
+        try:
+            result = llm.post_chat_request(messages, **kwargs)
+        except BaseException as e:
+            self._release(entry, estimate)
+            self._forget(key)
+            future.set_exception(e)
+            return
+        consumed = sum(c.value for c in result.consumptions if c.unit == "token")
+        self._release(entry, consumed if consumed > 0 else estimate)
+        self._forget(key)
+        future.set_result(result)
+
+    def _acquire(self, priority: Priority, tokens: int, cancellation: Optional[TurnCancellation] = None) -> List:
+        unregister = cancellation.on_cancel(self._wake_up) if cancellation is not None else None
+        try:
+            return self._admit(priority, tokens, cancellation)
+        finally:
+            if unregister is not None:
+                unregister()
+
+    def _wake_up(self) -> None:
+        with self._condition:
+            self._condition.notify_all()
+
+    def _admit(self, priority: Priority, tokens: int, cancellation: Optional[TurnCancellation]) -> List:
+        with self._condition:
+            ticket = (int(priority), next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    if cancellation is not None:
+                        cancellation.check()
+                    if self._waiting[0] == ticket and self._in_flight < self._max_in_flight:
+                        delay = self._rate_limit_delay(tokens)
+                        if delay <= 0:
+                            break
+                        self._condition.wait(timeout=delay)
+                    else:
+                        self._condition.wait()
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+
+            heapq.heappop(self._waiting)
+            self._in_flight += 1
+            entry = [time.monotonic(), tokens]
+            self._window.append(entry)
+            # The next request in line may be admitted too
+            self._condition.notify_all()
+            return entry
+
+    def _release(self, entry: List, tokens: int) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            entry[1] = tokens
+            self._condition.notify_all()
+
+    def _rate_limit_delay(self, tokens: int) -> float:
+        """Seconds to wait before `tokens` more tokens fit in the last minute's budget."""
+        if self._tokens_per_minute <= 0:
+            return 0
+        now = time.monotonic()
+        while self._window and now - self._window[0][0] >= 60:
+            self._window.popleft()
+        used = sum(t for _, t in self._window)
+        if used + tokens <= self._tokens_per_minute or not self._window:
+            return 0
+        return 60 - (now - self._window[0][0])
+
+    @staticmethod
+    def count_tokens(llm: LLMBase, messages: List[LLMMessage]) -> int:
+        """Number of tokens in `messages`, counted with the token counter of `llm` or estimated from their length."""
+        token_counter = getattr(llm, "_token_counter", None)
+        if token_counter is not None:
+            return token_counter.count_messages_token(messages=messages)
+        return sum(len(m.content) for m in messages) // 4
+
+    @staticmethod
+    def _request_key(llm: LLMBase, messages: List[LLMMessage], kwargs: Dict[str, Any]) -> str:
+        config = getattr(llm, "config", None)
+        model = getattr(config, "model", None)
+        payload = json.dumps(
+            {
+                "llm": type(llm).__name__,
+                "model": str(model.unwrap_or("") if hasattr(model, "unwrap_or") else model),
+                "messages": [[m.role.value, m.content] for m in messages],
+                "kwargs": kwargs,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class GatewayLLM(LLMBase):
+    """
+    An LLMBase that sends its requests to an upstream LLM through an LLMGateway, with a given priority.
+    Publishes an llm_request event for every request, and charges it to a TokenAccount if given.
+    Requests are abandoned when the TurnCancellation, if given, is cancelled, and charged when they finish.
+    """
+
+    def __init__(
+        self,
+        llm: LLMBase,
+        priority: Priority,
+        gateway: Optional[LLMGateway] = None,
+        events: Optional[AgentEvents] = None,
+        account: Optional[TokenAccount] = None,
+        cancellation: Optional[TurnCancellation] = None,
+    ):
+        super().__init__()
+        self._llm = llm
+        self._priority = priority
+        self._gateway = gateway or LLMGateway.default()
+        self._events = events or AgentEvents()
+        self.account = account
+        self.cancellation = cancellation
+
+    @property
+    def upstream(self) -> LLMBase:
+        return self._llm
+
+    def _charge(self, prompt_tokens: int, result: LLMResult) -> int:
+        """Record the usage of a request in the TokenAccount, also of one abandoned by a cancelled turn."""
+        completion_tokens = _completion_tokens(result, prompt_tokens)
+        if self.account is not None:
+            self.account.record(prompt_tokens, completion_tokens)
+        return completion_tokens
+
+    def _post_chat_request(self, messages: List[LLMMessage], **kwargs: Any) -> LLMResult:
+        if self.cancellation is not None:
+            self.cancellation.check()
+        prompt_tokens = LLMGateway.count_tokens(self._llm, messages)
+        if self.account is not None:
+            # Raises TokenBudgetExceeded before anything is sent
+            max_completion_tokens = self.account.check(prompt_tokens)
+            if max_completion_tokens is not None:
+                kwargs["max_tokens"] = min(kwargs.get("max_tokens", max_completion_tokens), max_completion_tokens)
+        start = time.monotonic()
+        completion_tokens = 0
+        is_error = True
+        try:
+            result = self._gateway.post_chat_request(
+                self._llm,
+                messages,
+                self._priority,
+                prompt_tokens=prompt_tokens,
+                cancellation=self.cancellation,
+                on_abandoned=lambda late: self._charge(prompt_tokens, late),
+                **kwargs,
+            )
+            completion_tokens = self._charge(prompt_tokens, result)
+            is_error = False
+            return result
+        finally:
+            self._events.emit(
+                "llm_request",
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                duration=time.monotonic() - start,
+                is_error=is_error,
+            )
+
+
+def _completion_tokens(result: LLMResult, prompt_tokens: int) -> int:
+    total_tokens = sum(c.value for c in result.consumptions if c.unit == "token")
+    if total_tokens > prompt_tokens:
+        return total_tokens - prompt_tokens
+    return sum(len(choice) for choice in result.choices) // 4
+
+
+def _wait(future: Future, cancellation: Optional[TurnCancellation]) -> Any:
+    """The result of `future`, or TurnCancelled as soon as `cancellation` is cancelled."""
+    if cancellation is None:
+        return future.result()
+    done = threading.Event()
+    future.add_done_callback(lambda _: done.set())
+    unregister = cancellation.on_cancel(done.set)
+    try:
+        done.wait()
+    finally:
+        unregister()
+    if not future.done():
+        cancellation.check()
+    return future.result()
+
+
+def prompt_allowance(llm: LLMBase) -> Optional[int]:
+    """Prompt tokens `llm` can still send within its token budget, None if unlimited."""
+    account = getattr(llm, "account", None)
+    return account.remaining_prompt_tokens() if account is not None else None
+
+
+def count_prompt_tokens(llm: LLMBase, messages: List[LLMMessage]) -> int:
+    """Number of tokens in `messages`, counted like `llm` does before sending them."""
+    while hasattr(llm, "upstream"):
+        llm = llm.upstream
+    return LLMGateway.count_tokens(llm, messages)
+
+
+def count_text_tokens(llm: LLMBase, text: str) -> int:
+    """Number of tokens `text` adds to a message sent to `llm`."""
+    return count_prompt_tokens(llm, [LLMMessage.user_message(text)]) - count_prompt_tokens(
+        llm, [LLMMessage.user_message("")]
+    )
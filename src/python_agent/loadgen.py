@@ -0,0 +1,338 @@
+import argparse
+import http.client
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from python_agent.benchmark import DEFAULT_DEMO_DIR, parse_latencies
+from python_agent.replay import ReplayClock, Scenario, replay_agent_app
+from python_agent.tracing import percentile
+
+"""
+HTTP load generator for the Flask app.
+
+Simulates concurrent browser sessions making the same calls as app.js against a local server
+whose sessions answer with ReplayLLM and ReplaySandbox. Each simulated user:
+    subscribes to /latest_log_stream
+    POSTs /reset
+    then for each turn POSTs /post_code and /handle_user_message with the next message of a
+    recorded scenario, and every few turns /revert_code
+
+The report gives the latency percentiles and error rate of each endpoint, and the RSS of the
+server process over time:
+    python -m python_agent.loadgen --users 20 --turns 10 --latency all=lognormal:0.5:0.4
+
+The server is started on a free port with a throwaway session store, unless --url points to a
+running one (--server-pid then gives the process to sample).
+"""
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..")
+
+
+class Stats:
+    """Latencies and errors per endpoint, shared by all the simulated users."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.log_events = 0
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, duration: float, ok: bool) -> None:
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(duration)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def log_event(self) -> None:
+        with self._lock:
+            self.log_events += 1
+
+
+class SimulatedUser:
+    """One browser session replaying the messages of a scenario."""
+
+    def __init__(self, url: str, scenario: Scenario, turns: int, revert_every: int, think_time: float, stats: Stats):
+        self.url = url.rstrip("/")
+        self.scenario = scenario
+        self.turns = turns
+        self.revert_every = revert_every
+        self.think_time = think_time
+        self.stats = stats
+        self.session_id = uuid.uuid4().hex
+        self.code = ""
+        self._stream: Optional[http.client.HTTPConnection] = None
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        stream = threading.Thread(target=self.follow_log_stream, daemon=True)
+        stream.start()
+        try:
+            self.post("/reset")
+            for turn in range(self.turns):
+                message = self.scenario.turns[turn % len(self.scenario.turns)].user_message
+                self.post("/post_code", {"code": self.code})
+                result = self.post("/handle_user_message", {"message": message})
+                if result is not None:
+                    self.code = result.get("code") or ""
+                if self.revert_every and (turn + 1) % self.revert_every == 0:
+                    result = self.post("/revert_code")
+                    if result is not None:
+                        self.code = result.get("code") or ""
+                if self.think_time:
+                    time.sleep(self.think_time)
+        finally:
+            self.stop_log_stream()
+
+    def post(self, path: str, form: Optional[Dict[str, str]] = None) -> Optional[Dict]:
+        """POST a form like app.js, record its latency, and return the JSON response if any."""
+        request = urllib.request.Request(
+            self.url + path,
+            data=urllib.parse.urlencode(form or {}).encode("utf-8"),
+            headers={"Content-Type": "application/x-www-form-urlencoded", "X-Session-Id": self.session_id},
+            method="POST",
+        )
+        start = time.monotonic()
+        ok = False
+        try:
+            with urllib.request.urlopen(request, timeout=600) as response:
+                body = response.read()
+                ok = True
+            if response.headers.get_content_type() == "application/json":
+                return json.loads(body)
+            return None
+        except (urllib.error.URLError, OSError, ValueError):
+            return None
+        finally:
+            self.stats.record(path, time.monotonic() - start, ok)
+
+    def follow_log_stream(self) -> None:
+        parsed = urllib.parse.urlsplit(self.url)
+        start = time.monotonic()
+        try:
+            self._stream = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=30)
+            self._stream.request("GET", "/latest_log_stream", headers={"X-Session-Id": self.session_id})
+            response = self._stream.getresponse()
+            self.stats.record("/latest_log_stream", time.monotonic() - start, response.status == 200)
+            for line in response:
+                if line.startswith(b"data:"):
+                    self.stats.log_event()
+        except (OSError, http.client.HTTPException):
+            if not self._stopped.is_set():
+                self.stats.record("/latest_log_stream", time.monotonic() - start, False)
+
+    def stop_log_stream(self) -> None:
+        self._stopped.set()
+        if self._stream is not None and self._stream.sock is not None:
+            try:
+                self._stream.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._stream.close()
+
+
+def rss_kb(pid: int) -> Optional[int]:
+    """Resident set size of a process in KB, or None if it can't be read."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        output = subprocess.run(["ps", "-o", "rss=", "-p", str(pid)], capture_output=True, text=True).stdout
+        return int(output.strip())
+    except (OSError, ValueError):
+        return None
+
+
+class RSSMonitor:
+    """Samples the RSS of a process at a fixed interval, in a background thread."""
+
+    def __init__(self, pid: int, interval: float):
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[Tuple[float, int]] = []
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._start = time.monotonic()
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        rss = rss_kb(self.pid)
+        if rss is not None:
+            self.samples.append((time.monotonic() - self._start, rss))
+
+    def _run(self) -> None:
+        while True:
+            rss = rss_kb(self.pid)
+            if rss is not None:
+                self.samples.append((time.monotonic() - self._start, rss))
+            if self._stopped.wait(self.interval):
+                return
+
+
+def start_server(args) -> Tuple[subprocess.Popen, str]:
+    """Start the app with replayed sessions on a free port and wait until it answers."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    env = dict(os.environ)
+    directory = tempfile.mkdtemp(prefix="loadgen-")
+    env.setdefault("SESSION_STORE_PATH", os.path.join(directory, "sessions.db"))
+    env.setdefault("SESSION_ARCHIVE_DIR", os.path.join(directory, "session_archives"))
+    env.setdefault("PYTHON_BIN_DIR", os.path.dirname(sys.executable))
+    env.setdefault("TRACE_PATH", "")
+    command = [sys.executable, "-m", "python_agent.loadgen", "serve", "--port", str(port), "--demos", args.demos]
+    command += ["--scenario", args.scenario] if args.scenario else []
+    command += [f"--latency={spec}" for spec in args.latency]
+    log = open(args.server_log, "ab") if args.server_log else subprocess.DEVNULL
+    server = subprocess.Popen(command, cwd=SRC_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"the server exited with status {server.returncode}")
+        try:
+            urllib.request.urlopen(url + "/metrics", timeout=1).read()
+            return server, url
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit("the server did not start within 60 seconds")
+
+
+def serve(args) -> None:
+    """Run the app with sessions answered by ReplayLLM and ReplaySandbox."""
+    import app as server
+    from python_agent.session_store import SessionManager, SQLiteSessionStore
+
+    scenario = load_scenario(args.demos, args.scenario)
+    latencies = parse_latencies(args.latency)
+    seeds = itertools.count()
+
+    def factory():
+        return replay_agent_app(ReplayClock(scenario, latencies, seed=next(seeds), cycle=True))
+
+    server.sessions = SessionManager(store=SQLiteSessionStore(os.environ["SESSION_STORE_PATH"]), factory=factory)
+    server.app.run(host="127.0.0.1", port=args.port, threaded=True)
+
+
+def load_scenario(demos: str, name: Optional[str]) -> Scenario:
+    scenarios = Scenario.from_demos(demos)
+    if name:
+        scenarios = [s for s in scenarios if s.name == name]
+    if not scenarios:
+        sys.exit(f"no scenario {name or ''} found in {demos}")
+    return scenarios[0]
+
+
+def report(stats: Stats, elapsed: float, samples: List[Tuple[float, int]], users: int) -> None:
+    total = sum(len(values) for values in stats.latencies.values())
+    errors = sum(stats.errors.values())
+    print(f"{users} users, {total} requests in {elapsed:.1f}s, {total / elapsed:.1f} requests/sec, {errors} errors")
+    print(f"{'endpoint':22} {'count':>6} {'errors':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for endpoint, values in sorted(stats.latencies.items()):
+        failed = stats.errors.get(endpoint, 0)
+        print(
+            f"{endpoint:22} {len(values):6} {100 * failed / len(values):6.1f}% "
+            f"{1000 * percentile(values, 0.5):8.1f} {1000 * percentile(values, 0.9):8.1f} "
+            f"{1000 * percentile(values, 0.99):8.1f} {1000 * max(values):8.1f}"
+        )
+    print(f"{stats.log_events} log stream events received")
+
+    if samples:
+        print("\nserver RSS")
+        step = max(1, len(samples) // 20)
+        for t, rss in samples[::step]:
+            print(f"    {t:7.1f}s {rss / 1024:8.1f} MB")
+        peak = max(rss for _, rss in samples)
+        print(f"    start {samples[0][1] / 1024:.1f} MB, peak {peak / 1024:.1f} MB, end {samples[-1][1] / 1024:.1f} MB")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Load test the app with simulated browser sessions.")
+    parser.add_argument("command", nargs="?", choices=["run", "serve"], default="run")
+    parser.add_argument("--users", type=int, default=10, help="number of concurrent sessions")
+    parser.add_argument("--turns", type=int, default=10, help="user messages sent by each session")
+    parser.add_argument("--ramp-up", type=float, default=0, help="seconds over which the sessions are started")
+    parser.add_argument("--think-time", type=float, default=0, help="seconds between the turns of a session")
+    parser.add_argument("--revert-every", type=int, default=5, help="revert the code every N turns, 0 never")
+    parser.add_argument("--demos", default=DEFAULT_DEMO_DIR, help="directory of the recorded scenarios")
+    parser.add_argument("--scenario", help="name of the scenario replayed, the first one by default")
+    parser.add_argument(
+        "--latency", action="append", default=[], metavar="ROLE=SPEC", help="simulated latency, as in the benchmark"
+    )
+    parser.add_argument("--url", help="load test a running server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="process of the --url server to sample the RSS of")
+    parser.add_argument("--server-log", help="file receiving the output of the started server")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="seconds between RSS samples")
+    parser.add_argument("--port", type=int, default=5000, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    try:
+        parse_latencies(args.latency)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    if args.command == "serve":
+        serve(args)
+        return
+
+    scenario = load_scenario(args.demos, args.scenario)
+    server = None
+    if args.url:
+        url, pid = args.url, args.server_pid
+    else:
+        server, url = start_server(args)
+        pid = server.pid
+
+    monitor = RSSMonitor(pid, args.sample_interval) if pid else None
+    stats = Stats()
+    users = [
+        SimulatedUser(url, scenario, args.turns, args.revert_every, args.think_time, stats) for _ in range(args.users)
+    ]
+    threads = [threading.Thread(target=user.run, daemon=True) for user in users]
+    try:
+        if monitor:
+            monitor.start()
+        start = time.monotonic()
+        for i, thread in enumerate(threads):
+            thread.start()
+            if args.ramp_up and i < len(threads) - 1:
+                time.sleep(args.ramp_up / len(threads))
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+    finally:
+        if monitor:
+            monitor.stop()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report(stats, elapsed, monitor.samples if monitor else [], len(users))
+    if sum(stats.errors.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
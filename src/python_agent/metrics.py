@@ -0,0 +1,166 @@
+import bisect
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from python_agent.events import AgentEvents, Event
+
+"""
+Latency and token metrics for the agent pipeline, rendered in the Prometheus text exposition format.
+
+AgentMetrics subscribes to the AgentEvents of every AgentApp in the process and aggregates them
+by chain and skill.
+"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = [str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values]
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Sequence[str] = (), value: float = 1) -> None:
+        key = tuple(str(label) for label in labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket (+Inf last), sum]
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Sequence[str], value: float) -> None:
+        key = tuple(str(label) for label in labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.label_names + ("le",)
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip([*self.buckets, "+Inf"], counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(names, (*key, bound))} {cumulative}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {total[0]}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class AgentMetrics:
+    """Aggregates the events of AgentApps into latency histograms and token counters."""
+
+    _default: Optional["AgentMetrics"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        self.turn_seconds = Histogram(
+            "agent_turn_seconds", "Duration of AgentApp.interact.", ["status"]
+        )
+        self.plan_seconds = Histogram(
+            "agent_plan_seconds", "Duration of the controller get_plan, including its LLM call."
+        )
+        self.skill_seconds = Histogram(
+            "agent_skill_seconds", "Duration of skill executions.", ["chain", "skill", "status"]
+        )
+        self.llm_seconds = Histogram(
+            "agent_llm_request_seconds", "Duration of LLM requests.", ["chain", "skill"]
+        )
+        self.llm_prompt_tokens = Counter(
+            "agent_llm_prompt_tokens_total", "Prompt tokens sent to the LLM.", ["chain", "skill"]
+        )
+        self.llm_completion_tokens = Counter(
+            "agent_llm_completion_tokens_total", "Completion tokens received from the LLM.", ["chain", "skill"]
+        )
+        self.llm_escalations = Counter(
+            "agent_llm_escalations_total", "Requests escalated to the stronger model.", ["chain", "skill"]
+        )
+        self.sandbox_seconds = Histogram(
+            "agent_sandbox_seconds", "Duration of sandbox runs.", ["chain", "status"]
+        )
+        self._metrics = [
+            self.turn_seconds,
+            self.plan_seconds,
+            self.skill_seconds,
+            self.llm_seconds,
+            self.llm_prompt_tokens,
+            self.llm_completion_tokens,
+            self.llm_escalations,
+            self.sandbox_seconds,
+        ]
+
+    @staticmethod
+    def default() -> "AgentMetrics":
+        """The metrics shared by all sessions of the process."""
+        with AgentMetrics._default_lock:
+            if AgentMetrics._default is None:
+                AgentMetrics._default = AgentMetrics()
+            return AgentMetrics._default
+
+    def observe(self, events: AgentEvents) -> None:
+        """Record the events of an AgentApp."""
+        events.subscribe(self.record)
+
+    def record(self, event: Event) -> None:
+        kind = event["kind"]
+        chain = event.get("chain") or ""
+        if kind == "turn_finished":
+            status = "cancelled" if event.get("cancelled") else _status(event["is_error"])
+            self.turn_seconds.observe([status], event["duration"])
+        elif kind == "plan_finished":
+            self.plan_seconds.observe([], event["duration"])
+        elif kind == "skill_finished":
+            self.skill_seconds.observe([chain, event["skill"], _status(event["is_error"])], event["duration"])
+        elif kind == "llm_request":
+            caller = event.get("skill") or "controller"
+            self.llm_seconds.observe([chain, caller], event["duration"])
+            self.llm_prompt_tokens.inc([chain, caller], event["prompt_tokens"])
+            self.llm_completion_tokens.inc([chain, caller], event["completion_tokens"])
+        elif kind == "escalated":
+            self.llm_escalations.inc([chain, event.get("skill") or "controller"])
+        elif kind == "sandbox_exited":
+            self.sandbox_seconds.observe([chain, _status(event["returncode"] != 0)], event["duration"])
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+def _status(is_error: bool) -> str:
+    return "error" if is_error else "ok"
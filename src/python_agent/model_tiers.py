@@ -0,0 +1,91 @@
+import os
+from typing import Any, Callable, List, Optional
+
+from council.llm import LLMBase, LLMMessage, LLMResult
+
+from python_agent.events import AgentEvents
+from python_agent.llm_gateway import Priority
+
+"""
+Per-role model configuration.
+
+Each role of the agent can use its own model, so that the latency sensitive routing decision and
+short replies use a fast model while code is written by a strong one:
+    controller         CONTROLLER_LLM_MODEL
+    general            GENERAL_LLM_MODEL
+    code_generation    CODE_GENERATION_LLM_MODEL
+    error_correction   ERROR_CORRECTION_LLM_MODEL
+Roles without a model use OPENAI_LLM_MODEL.
+
+A TieredLLM escalates a request to ESCALATION_LLM_MODEL (by default OPENAI_LLM_MODEL) when the
+answer of the role's model is rejected by a validator, e.g. a controller decision that does not
+parse or scores below ESCALATION_MIN_SCORE, or code that does not parse.
+"""
+
+ROLES = ("controller", "general", "code_generation", "error_correction")
+
+ROLE_PRIORITIES = {
+    "controller": Priority.INTERACTIVE,
+    "general": Priority.INTERACTIVE,
+    "code_generation": Priority.BULK,
+    "error_correction": Priority.BULK,
+}
+
+
+def role_model(role: str) -> Optional[str]:
+    """The model configured for `role`, None for the default model."""
+    return os.environ.get(f"{role.upper()}_LLM_MODEL") or None
+
+
+def escalation_model() -> Optional[str]:
+    """The model requests are escalated to, None for the default model."""
+    return os.environ.get("ESCALATION_LLM_MODEL") or None
+
+
+def escalation_min_score() -> int:
+    """Controller decisions scored below this are escalated."""
+    return int(os.environ.get("ESCALATION_MIN_SCORE", 5))
+
+
+class TieredLLM(LLMBase):
+    """
+    An LLMBase sending requests to a fast LLM first, and again to a stronger LLM when the answer
+    is rejected by `accept`. Publishes an escalated event for every escalation.
+    """
+
+    def __init__(
+        self,
+        llm: LLMBase,
+        escalation_llm: Optional[LLMBase] = None,
+        accept: Optional[Callable[[str], bool]] = None,
+        events: Optional[AgentEvents] = None,
+    ):
+        """
+        Initialize a new instance
+
+        Parameters:
+            llm (LLMBase): the LLM answering first
+            escalation_llm (LLMBase): the LLM answering when `accept` rejects the first answer, None to never escalate
+            accept (Callable[[str], bool]): whether the first choice of an answer is good enough
+            events (AgentEvents): where escalated events are published
+        """
+        super().__init__()
+        self._llm = llm
+        self._escalation_llm = escalation_llm
+        self._accept = accept
+        self._events = events or AgentEvents()
+
+    @property
+    def upstream(self) -> LLMBase:
+        return self._llm
+
+    @property
+    def account(self):
+        return getattr(self._llm, "account", None)
+
+    def _post_chat_request(self, messages: List[LLMMessage], **kwargs: Any) -> LLMResult:
+        result = self._llm.post_chat_request(messages, **kwargs)
+        if self._escalation_llm is None or self._accept is None or self._accept(result.first_choice):
+            return result
+        self._events.emit("escalated")
+        return self._escalation_llm.post_chat_request(messages, **kwargs)
@@ -0,0 +1,75 @@
+import os
+from typing import Any, Dict, List, Optional
+
+from council.chains import Chain
+from council.contexts import AgentContext, ChatMessage
+from council.controllers import ExecutionUnit
+from council.runners import Budget
+
+"""
+Multi-step plans: several chains run in sequence from a single controller decision.
+
+"Write the code and run it" used to take a controller call and a turn per chain. The controller
+can now answer with one line per chain, in the order they must run. Each PlanStep starts from the
+state the step before it ended with, so that the code generated by one step is run by the next,
+and the steps after a failed or skipped step are skipped. The result of the plan is the result of
+its last step that ran.
+
+The number of steps of a plan is limited by CONTROLLER_MAX_PLAN_STEPS, 1 to select one chain only.
+"""
+
+
+def max_plan_steps() -> int:
+    return max(int(os.environ.get("CONTROLLER_MAX_PLAN_STEPS", 3)), 1)
+
+
+class PlanStep(ExecutionUnit):
+    """An ExecutionUnit that starts from the result of the previous step of its plan, if any."""
+
+    def __init__(
+        self,
+        chain: Chain,
+        budget: Budget,
+        instructions: str,
+        data: Dict[str, Any],
+        name: str,
+        previous: Optional["PlanStep"] = None,
+    ):
+        """
+        Initialize a new instance
+
+        Parameters:
+            chain (Chain): the chain to execute
+            budget (Budget): the budget of the execution
+            instructions (str): the instructions of the controller for the chain
+            data (Dict[str, Any]): the controller state the first step starts from
+            name (str): a name unique in the plan
+            previous (PlanStep): the step running before this one
+        """
+        super().__init__(chain, budget, name=name)
+        self.instructions = instructions
+        self.previous = previous
+        self._data = data
+        self.result: Optional[ChatMessage] = None
+
+    @property
+    def runnable(self) -> bool:
+        """Whether the step runs: the first step always does, the others after a successful step."""
+        return self.previous is None or (self.previous.result is not None and self.previous.result.is_ok)
+
+    @property
+    def initial_state(self) -> ChatMessage:
+        data = self._data if self.previous is None else self.previous.result.data
+        return ChatMessage.chain(message=self.instructions, data=data)
+
+    def record(self, context: AgentContext) -> None:
+        """Keep the last message of the chain, once it ran, for the next step to start from."""
+        history = context.chainHistory.get(self.name)
+        if history and history[-1].messages:
+            self.result = history[-1].messages[-1]
+
+
+def final_steps(steps: List[PlanStep]) -> List[PlanStep]:
+    """The steps that ran and were not followed by another step: the outcome of each plan."""
+    continued = {id(step.previous) for step in steps if step.result is not None and step.previous is not None}
+    return [step for step in steps if step.result is not None and id(step) not in continued]
@@ -0,0 +1,267 @@
+import ast
+import builtins
+import json
+import logging
+import subprocess
+from functools import lru_cache
+from typing import FrozenSet, List, Optional, Set, Tuple
+
+logger = logging.getLogger("council")
+
+"""
+Static checks run on generated code before a sandbox process is spawned.
+Each check reports diagnostics formatted like the interpreter's own errors so
+that the error correction chain can treat them exactly like a real `stderr`.
+"""
+
+# Calls the code generation prompt forbids and that would hang the sandbox.
+BANNED_CALLS = {
+    "input": "the sandbox has no standard input; print your message instead",
+    "breakpoint": "the sandbox is not interactive",
+}
+
+# Names the interpreter defines in every module without an explicit binding.
+MODULE_NAMES = {
+    "__name__",
+    "__file__",
+    "__doc__",
+    "__builtins__",
+    "__spec__",
+    "__loader__",
+    "__package__",
+    "__annotations__",
+}
+
+INDEX_SCRIPT = (
+    "import json, pkgutil, sys;"
+    "names = set(sys.builtin_module_names);"
+    "names.update(m.name for m in pkgutil.iter_modules());"
+    "print(json.dumps(sorted(names)))"
+)
+
+
+@lru_cache(maxsize=None)
+def installed_modules(sandbox_path: str) -> Optional[FrozenSet[str]]:
+    """
+    Return the top-level module names importable from the sandbox interpreter.
+
+    The index is built once per sandbox and cached for the life of the process.
+    Returns None when the index can't be built, in which case imports aren't checked.
+    """
+    try:
+        execution = subprocess.run(
+            [f"{sandbox_path}/python", "-c", INDEX_SCRIPT],
+            capture_output=True,
+            timeout=60,
+        )
+        if execution.returncode != 0:
+            logger.warning(f"preflight: failed to index sandbox modules: {execution.stderr.decode()}")
+            return None
+        return frozenset(json.loads(execution.stdout.decode()))
+    except Exception as e:
+        logger.warning(f"preflight: failed to index sandbox modules: {e}")
+        return None
+
+
+class _NameCollector(ast.NodeVisitor):
+    """Collects every name bound anywhere in a module and every name loaded."""
+
+    def __init__(self):
+        self.bound: Set[str] = set()
+        self.loaded: List[ast.Name] = []
+        self.star_import = False
+
+    def visit_Name(self, node: ast.Name):
+        if isinstance(node.ctx, ast.Load):
+            self.loaded.append(node)
+        else:
+            self.bound.add(node.id)
+
+    def _visit_def(self, node):
+        self.bound.add(node.name)
+        self.generic_visit(node)
+
+    visit_FunctionDef = _visit_def
+    visit_AsyncFunctionDef = _visit_def
+    visit_ClassDef = _visit_def
+
+    def visit_arg(self, node: ast.arg):
+        self.bound.add(node.arg)
+        self.generic_visit(node)
+
+    def visit_Import(self, node: ast.Import):
+        for alias in node.names:
+            self.bound.add(alias.asname or alias.name.split(".")[0])
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        for alias in node.names:
+            if alias.name == "*":
+                self.star_import = True
+            else:
+                self.bound.add(alias.asname or alias.name)
+
+    def visit_ExceptHandler(self, node: ast.ExceptHandler):
+        if node.name:
+            self.bound.add(node.name)
+        self.generic_visit(node)
+
+    def visit_Global(self, node: ast.Global):
+        self.bound.update(node.names)
+
+    def visit_Nonlocal(self, node: ast.Nonlocal):
+        self.bound.update(node.names)
+
+    def visit_MatchAs(self, node: ast.MatchAs):
+        if node.name:
+            self.bound.add(node.name)
+        self.generic_visit(node)
+
+    def visit_MatchStar(self, node: ast.MatchStar):
+        if node.name:
+            self.bound.add(node.name)
+
+    def visit_MatchMapping(self, node: ast.MatchMapping):
+        if node.rest:
+            self.bound.add(node.rest)
+        self.generic_visit(node)
+
+
+def _diagnostic(node: ast.AST, error: str) -> Tuple[int, int, str]:
+    line = getattr(node, "lineno", 0)
+    col = getattr(node, "col_offset", 0)
+    return (line, col, f'File "<string>", line {line}, column {col + 1}\n{error}')
+
+
+def check_undefined_names(tree: ast.AST) -> List[Tuple[int, int, str]]:
+    """
+    Report names that are loaded but never bound in the module.
+
+    Scopes are flattened: a name bound anywhere counts as bound everywhere, so
+    this only reports names that can't possibly resolve at runtime.
+    """
+    collector = _NameCollector()
+    collector.visit(tree)
+    if collector.star_import:
+        return []
+
+    known = collector.bound | set(dir(builtins)) | MODULE_NAMES
+    reported = set()
+    diagnostics = []
+    for node in collector.loaded:
+        if node.id in known or node.id in reported:
+            continue
+        reported.add(node.id)
+        diagnostics.append(
+            _diagnostic(node, f"NameError: name '{node.id}' is not defined")
+        )
+    return diagnostics
+
+
+# Handlers that make an import in their `try` body optional: `except ImportError: ...`, and the
+# handlers of its base classes, which catch a failed import as well
+IMPORT_ERRORS = {"ImportError", "ModuleNotFoundError", "Exception", "BaseException"}
+TRY_NODES = (ast.Try, ast.TryStar) if hasattr(ast, "TryStar") else (ast.Try,)
+
+
+def _catches_import_error(handler: ast.ExceptHandler) -> bool:
+    if handler.type is None:
+        return True
+    types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+    return any(isinstance(t, ast.Name) and t.id in IMPORT_ERRORS for t in types)
+
+
+def _guarded_imports(tree: ast.AST) -> Set[ast.AST]:
+    """Import statements in the body of a `try` whose handlers catch a failed import."""
+    guarded = set()
+    for node in ast.walk(tree):
+        if isinstance(node, TRY_NODES) and any(_catches_import_error(h) for h in node.handlers):
+            for statement in node.body:
+                guarded.update(
+                    child for child in ast.walk(statement) if isinstance(child, (ast.Import, ast.ImportFrom))
+                )
+    return guarded
+
+
+def check_imports(tree: ast.AST, available: FrozenSet[str]) -> List[Tuple[int, int, str]]:
+    """Report absolute imports of modules that aren't installed in the sandbox, unless a failed import is handled."""
+    guarded = _guarded_imports(tree)
+    diagnostics = []
+    for node in ast.walk(tree):
+        if node in guarded:
+            continue
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            modules = [node.module]
+        else:
+            continue
+        for module in modules:
+            top_level = module.split(".")[0]
+            if top_level not in available:
+                diagnostics.append(
+                    _diagnostic(
+                        node,
+                        f"ModuleNotFoundError: No module named '{top_level}' "
+                        "(not installed in the code sandbox)",
+                    )
+                )
+    return diagnostics
+
+
+def check_banned_calls(tree: ast.AST) -> List[Tuple[int, int, str]]:
+    """Report calls to functions that must not be used in the sandbox."""
+    diagnostics = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        if isinstance(func, ast.Name):
+            name = func.id
+        elif (
+            isinstance(func, ast.Attribute)
+            and isinstance(func.value, ast.Name)
+            and func.value.id == "builtins"
+        ):
+            name = func.attr
+        else:
+            continue
+        if name in BANNED_CALLS:
+            diagnostics.append(
+                _diagnostic(
+                    node, f"RuntimeError: call to '{name}()' is not allowed: {BANNED_CALLS[name]}"
+                )
+            )
+    return diagnostics
+
+
+def preflight_check(code: str, sandbox_path: Optional[str] = None) -> List[str]:
+    """
+    Statically check code before it is run in the sandbox.
+
+    Parameters:
+        code (str): the Python source to check
+        sandbox_path (str): the sandbox `bin` directory, used to check imports. Imports aren't checked if None.
+
+    Returns:
+        List[str]: diagnostics in source order, empty if the code passed every check
+    """
+    return list(_preflight_check(code, sandbox_path))
+
+
+# Code is usually checked when it is posted by the editor, and again when it is run
+@lru_cache(maxsize=32)
+def _preflight_check(code: str, sandbox_path: Optional[str]) -> Tuple[str, ...]:
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return (f'File "<string>", line {e.lineno}, column {e.offset}\nSyntaxError: {e.msg}',)
+
+    diagnostics = check_undefined_names(tree) + check_banned_calls(tree)
+
+    if sandbox_path is not None:
+        available = installed_modules(sandbox_path)
+        if available is not None:
+            diagnostics += check_imports(tree, available)
+
+    diagnostics.sort(key=lambda item: (item[0], item[1]))
+    return tuple(message for _, _, message in diagnostics)
@@ -0,0 +1,88 @@
+import os
+import threading
+from string import Template
+from typing import Dict, Optional
+
+from python_agent.model_tiers import ROLES, escalation_min_score, escalation_model, role_model
+from python_agent.plan import max_plan_steps
+from python_agent.symbol_index import code_focus_min_lines
+from python_agent.token_budget import TokenAccount, TokenLimits
+from python_agent.tracing import JsonlTraceWriter
+
+"""
+The part of an AgentApp that is the same for every session of a process.
+
+Building an AgentApp used to parse the prompt files and read the configuration from the
+environment again for every session, which was most of the cost of /reset and of a new session.
+An AgentPrototype does it once per prompt directory; the AgentApps built from it share its
+prompts, templates and configuration, and only create the objects holding session state.
+Prototypes are immutable: changes to the prompt files or the environment apply to new processes.
+The .env file is loaded by the first prototype, the entry points reading settings before that load it
+themselves.
+"""
+
+
+class AgentPrototype:
+    """Prompts and configuration shared by the AgentApps of a process."""
+
+    _prototypes: Dict[str, "AgentPrototype"] = {}
+    _prototypes_lock = threading.Lock()
+
+    def __init__(self, work_dir: str):
+        """
+        Initialize a new instance
+
+        Parameters:
+            work_dir (str): directory containing the prompts
+        """
+        # Only needed here, once per process
+        import dotenv
+        import toml
+
+        # Settings from a .env file, for those not set in the environment
+        dotenv.load_dotenv()
+        self.work_dir = work_dir
+        code_generation = toml.load(f"{work_dir}/prompts/python_code_generation.toml")
+        code_correction = toml.load(f"{work_dir}/prompts/python_error_correction.toml")
+        general = toml.load(f"{work_dir}/prompts/general.toml")
+
+        self.code_generation_system_message: str = code_generation["system"]["prompt"]
+        self.code_generation_prompt_template = Template(code_generation["main"]["prompt_template"])
+        self.code_generation_focus_prompt_template = Template(code_generation["focus"]["prompt_template"])
+        self.code_correction_system_message: str = code_correction["system"]["prompt"]
+        self.code_correction_prompt_template = Template(code_correction["main"]["prompt_template"])
+        self.code_correction_focus_prompt_template = Template(code_correction["focus"]["prompt_template"])
+        self.general_system_message: str = general["system"]["prompt"]
+        self.general_prompt_template = Template(general["main"]["prompt_template"])
+
+        self.python_bin_dir = os.environ["PYTHON_BIN_DIR"]
+        self.focus_min_lines = code_focus_min_lines()
+        self.role_models: Dict[str, Optional[str]] = {role: role_model(role) for role in ROLES}
+        self.escalation_model = escalation_model()
+        self.escalation_min_score = escalation_min_score()
+        self.max_plan_steps = max_plan_steps()
+        self.trace_writer = JsonlTraceWriter.from_env()
+
+        self._turn_limits = TokenLimits.from_env("TURN")
+        self._session_limits = TokenLimits.from_env("SESSION")
+        self._prompt_price_per_1k = float(os.environ.get("LLM_PROMPT_PRICE_PER_1K", 0))
+        self._completion_price_per_1k = float(os.environ.get("LLM_COMPLETION_PRICE_PER_1K", 0))
+
+    @staticmethod
+    def get(work_dir: str) -> "AgentPrototype":
+        """The prototype of the prompts in `work_dir`, built on first use."""
+        key = os.path.abspath(work_dir)
+        with AgentPrototype._prototypes_lock:
+            prototype = AgentPrototype._prototypes.get(key)
+            if prototype is None:
+                prototype = AgentPrototype._prototypes[key] = AgentPrototype(work_dir)
+            return prototype
+
+    def token_account(self) -> TokenAccount:
+        """A new TokenAccount with the limits and prices of the environment."""
+        return TokenAccount(
+            turn_limits=self._turn_limits,
+            session_limits=self._session_limits,
+            prompt_price_per_1k=self._prompt_price_per_1k,
+            completion_price_per_1k=self._completion_price_per_1k,
+        )
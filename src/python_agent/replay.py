@@ -0,0 +1,241 @@
+import math
+import os
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from council.llm import LLMBase, LLMMessage, LLMResult
+from council.runners import Consumption
+
+from python_agent.agent import AgentApp
+from python_agent.cancellation import TurnCancellation
+
+"""
+A deterministic stand-in for the OpenAI LLM and the code sandbox, replaying recorded sessions.
+
+A Scenario is a recorded session: the user messages, the controller decision and the agent
+reply of each turn, and the code the session ended with. Scenarios are loaded from the
+`chat_history.txt` and `controller_messages.txt` files of a demo directory.
+
+ReplayLLM answers each request from the scenario depending on who sent it:
+    controller        the recorded controller decision of the current turn
+    code_generation   the recorded code, in a python code block
+    error_correction  the recorded code, in a python code block
+    general           the recorded agent reply of the current turn
+and ReplaySandbox returns the recorded standard output instead of running the code.
+Both wait for a delay sampled from a LatencyModel, with a seeded random generator.
+
+The current turn is set by the caller, or follows the controller requests when the clock cycles
+through the scenario, e.g. in a server answering unscripted clients.
+"""
+
+DEFAULT_WORK_DIR = os.path.dirname(__file__)
+
+ROLES = ("controller", "code_generation", "error_correction", "general", "sandbox")
+
+USER_PREFIX = "👤 "
+AGENT_PREFIX = "🤖 "
+CONTROLLER_LINE = re.compile(r"^\[[^\]]*\] Controller Message: (.*)$")
+EXECUTION_OUTPUT = "The code executed successfully with standard output: "
+
+
+class LatencyModel:
+    """
+    A distribution of delays, in seconds, parsed from a spec:
+        0.5                   always 0.5
+        uniform:LOW:HIGH      uniformly distributed between LOW and HIGH
+        normal:MEAN:STDDEV    normally distributed, never below 0
+        lognormal:MEDIAN:SIGMA  log-normally distributed, the usual shape of LLM latencies
+    """
+
+    def __init__(self, spec: str = "0"):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        try:
+            if not params:
+                self._kind, self._params = "fixed", [float(kind)]
+            else:
+                self._kind, self._params = kind, [float(p) for p in params.split(":")]
+        except ValueError:
+            raise ValueError(f"invalid latency spec: {spec}")
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}.get(self._kind)
+        if expected != len(self._params):
+            raise ValueError(f"invalid latency spec: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        if self._kind == "fixed":
+            return self._params[0]
+        if self._kind == "uniform":
+            return rng.uniform(*self._params)
+        if self._kind == "normal":
+            return max(0.0, rng.gauss(*self._params))
+        median, sigma = self._params
+        return rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+
+
+@dataclass
+class Turn:
+    user_message: str
+    controller: str
+    reply: str
+
+
+@dataclass
+class Scenario:
+    name: str
+    turns: List[Turn]
+    code: str = ""
+
+    @staticmethod
+    def from_demo(path: str) -> "Scenario":
+        """
+        Load the scenario recorded in a demo directory: its chat_history.txt, controller_messages.txt
+        and the Python file holding the final code, if any.
+        """
+        users, replies = [], []
+        with open(os.path.join(path, "chat_history.txt"), encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line.startswith(USER_PREFIX):
+                    users.append(line[len(USER_PREFIX):])
+                    replies.append("")
+                elif line.startswith(AGENT_PREFIX) and replies:
+                    replies[-1] = line[len(AGENT_PREFIX):]
+                elif replies:
+                    # Multi-line agent reply
+                    replies[-1] += "\n" + line
+
+        decisions = []
+        with open(os.path.join(path, "controller_messages.txt"), encoding="utf-8") as f:
+            for line in f:
+                match = CONTROLLER_LINE.match(line.rstrip("\n"))
+                if match:
+                    decisions.append(match.group(1))
+
+        turns = []
+        for i, (user_message, reply) in enumerate(zip(users, replies)):
+            # Turns without a recorded decision are answered directly
+            controller = decisions[i] if i < len(decisions) else f"direct_to_user;10;{reply}"
+            turns.append(Turn(user_message, controller, reply))
+
+        code = ""
+        sources = sorted(name for name in os.listdir(path) if name.endswith(".py"))
+        if sources:
+            with open(os.path.join(path, sources[0]), encoding="utf-8") as f:
+                code = f.read()
+
+        return Scenario(name=os.path.basename(os.path.normpath(path)), turns=turns, code=code)
+
+    @staticmethod
+    def from_demos(root: str) -> List["Scenario"]:
+        """Load the scenarios of all the demo directories in `root`."""
+        return [
+            Scenario.from_demo(os.path.join(root, name))
+            for name in sorted(os.listdir(root))
+            if os.path.isfile(os.path.join(root, name, "chat_history.txt"))
+        ]
+
+
+def request_role(messages: List[LLMMessage]) -> str:
+    """The role of the component that sent `messages`, recognized from its system prompt."""
+    system = messages[0].content if messages else ""
+    if "Controller module" in system:
+        return "controller"
+    if "debugger" in system:
+        return "error_correction"
+    if "expert-level Python coder" in system:
+        return "code_generation"
+    return "general"
+
+
+@dataclass
+class ReplayClock:
+    """The current turn of a scenario replay and the simulated time spent waiting, per role."""
+
+    scenario: Scenario
+    latencies: Dict[str, LatencyModel] = field(default_factory=dict)
+    seed: int = 0
+    turn_index: int = 0
+    # Move to the next turn on every controller request, starting over after the last one
+    cycle: bool = False
+    waited: Dict[str, float] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self._rng = random.Random(self.seed)
+        self._lock = threading.Lock()
+
+    @property
+    def turn(self) -> Turn:
+        return self.scenario.turns[self.turn_index]
+
+    def wait(self, role: str) -> None:
+        latency = self.latencies.get(role)
+        if latency is None:
+            return
+        with self._lock:
+            delay = latency.sample(self._rng)
+            self.waited[role] = self.waited.get(role, 0.0) + delay
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def total_waited(self) -> float:
+        return sum(self.waited.values())
+
+
+class ReplayLLM(LLMBase):
+    """An LLMBase answering from a recorded scenario, after a simulated latency."""
+
+    def __init__(self, clock: ReplayClock):
+        super().__init__()
+        self.clock = clock
+        self.requests: Dict[str, int] = {}
+
+    def _post_chat_request(self, messages: List[LLMMessage], **kwargs: Any) -> LLMResult:
+        role = request_role(messages)
+        self.requests[role] = self.requests.get(role, 0) + 1
+        if role == "controller" and self.clock.cycle:
+            self.clock.turn_index = (self.requests[role] - 1) % len(self.clock.scenario.turns)
+        self.clock.wait(role)
+
+        turn = self.clock.turn
+        if role == "controller":
+            response = turn.controller
+        elif role in ("code_generation", "error_correction"):
+            response = f"```python\n{self.clock.scenario.code}\n```"
+        else:
+            response = turn.reply
+
+        tokens = (sum(len(m.content) for m in messages) + len(response)) // 4
+        return LLMResult(choices=[response], consumptions=[Consumption(tokens, "token", "replay:total_tokens")])
+
+
+class ReplaySandbox:
+    """A stand-in for run_code_in_sandbox returning the output recorded for the current turn."""
+
+    def __init__(self, clock: ReplayClock):
+        self.clock = clock
+
+    def __call__(
+        self,
+        code: str,
+        sandbox_path: Optional[str] = None,
+        cancellation: Optional[TurnCancellation] = None,
+        diagnostics: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        self.clock.wait("sandbox")
+        if cancellation is not None:
+            cancellation.check()
+        reply = self.clock.turn.reply
+        stdout = reply[len(EXECUTION_OUTPUT):] if reply.startswith(EXECUTION_OUTPUT) else ""
+        return {"code": code, "returncode": 0, "stdout": stdout, "stderr": ""}
+
+
+def replay_agent_app(clock: ReplayClock, work_dir: str = DEFAULT_WORK_DIR) -> AgentApp:
+    """An AgentApp whose LLM and sandbox replay the scenario of `clock`."""
+    app = AgentApp(work_dir=work_dir, llm=ReplayLLM(clock))
+    app.python_execution_skill.runner = ReplaySandbox(clock)
+    return app
@@ -0,0 +1,346 @@
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Set
+
+from council.contexts import ChatMessage, ChatMessageKind
+
+from python_agent.blob_store import BLOB_KEY, BLOB_MIN_SIZE, BlobStore, blob_id, is_blob_ref
+
+"""
+Session archives: a compact, streamable JSON lines encoding of an AgentApp snapshot.
+
+An archive holds one record per line:
+    {"type": "header", "format": "python-agent-session", "version": 1, "created": ..., "messages": n}
+    {"type": "controller_state", "value": ...}
+    {"type": "state_history", "value": ...}
+    {"type": "document", "value": ...}
+    {"type": "token_usage", "value": ...}
+    {"type": "message", "kind": ..., "message": ..., "source": ..., "is_error": ..., "data": ...}   (one per message)
+    {"type": "blob", "id": ..., "value": ...}                                                     (one per blob)
+    {"type": "index", "blobs": {id: [offset, length]}}
+
+Strings of BLOB_MIN_SIZE characters or more, such as code and program output, are written once as
+blob records and replaced by {"$blob": id} where they appear, so the many copies of the code in a
+session take the space of one. Blobs come after everything else and the last line indexes them, so
+a reader can load the session without reading them and fetch each blob when it is needed.
+
+The messages of a session imported from an archive keep their data encoded until it is used.
+Snapshots copy the blobs that data references into the session, so the archive file is only read
+until the session is saved. The web app stores the archives it receives in an ArchiveDirectory.
+"""
+
+FORMAT = "python-agent-session"
+FORMAT_VERSION = 1
+
+
+# Fields of the records before the blobs, with their types
+RECORD_FIELDS = {
+    "controller_state": {"value": dict},
+    "state_history": {"value": list},
+    "document": {"value": dict},
+    "token_usage": {"value": dict},
+    "message": {"kind": str, "message": str, "source": (str, type(None)), "is_error": bool},
+}
+REQUIRED_RECORDS = ("controller_state", "state_history", "document")
+MESSAGE_KINDS = {kind.value for kind in ChatMessageKind}
+
+
+class ArchiveError(Exception):
+    """Raised when a file is not a session archive."""
+
+
+class ArchiveTooLarge(ArchiveError):
+    """Raised when an archive is larger than allowed."""
+
+
+def _encode(value: Any, blobs: Dict[str, str]) -> Any:
+    if isinstance(value, str) and len(value) >= BLOB_MIN_SIZE:
+        key = blob_id(value)
+        blobs[key] = value
+        return {BLOB_KEY: key}
+    if isinstance(value, dict):
+        return {key: _encode(item, blobs) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item, blobs) for item in value]
+    return value
+
+
+def _write_line(f: BinaryIO, record: Dict[str, Any]) -> int:
+    line = json.dumps(record, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8") + b"\n"
+    f.write(line)
+    return len(line)
+
+
+def _blob_refs(value: Any) -> Iterator[str]:
+    """The ids of the blobs `value` references, without decoding it."""
+    if is_blob_ref(value):
+        yield value[BLOB_KEY]
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _blob_refs(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _blob_refs(item)
+
+
+def _check_record(record: Dict[str, Any]) -> None:
+    fields = RECORD_FIELDS.get(record.get("type"))
+    if fields is None:
+        raise ArchiveError(f"unknown session archive record {str(record.get('type'))[:100]!r}")
+    for name, kind in fields.items():
+        if not isinstance(record.get(name), kind):
+            raise ArchiveError(f"invalid field {name!r} in a {record['type']} record")
+    if record["type"] == "message":
+        if "data" not in record:
+            raise ArchiveError("invalid field 'data' in a message record")
+        if record["kind"] not in MESSAGE_KINDS:
+            raise ArchiveError(f"invalid message kind {record['kind'][:100]!r}")
+
+
+def write_archive(snapshot: Dict[str, Any], f: BinaryIO) -> None:
+    """Write a snapshot returned by AgentApp.snapshot to a binary file."""
+    # The snapshot has its large strings in blobs already, they are kept as they are
+    blobs: Dict[str, str] = dict(snapshot.get("blobs", {}))
+    offset = _write_line(
+        f,
+        {
+            "type": "header",
+            "format": FORMAT,
+            "version": FORMAT_VERSION,
+            "created": time.time(),
+            "messages": len(snapshot["chat_history"]),
+        },
+    )
+    for key in ("controller_state", "state_history", "document", "token_usage"):
+        if key in snapshot:
+            offset += _write_line(f, {"type": key, "value": _encode(snapshot[key], blobs)})
+    for m in snapshot["chat_history"]:
+        offset += _write_line(f, {"type": "message", **m, "data": _encode(m["data"], blobs)})
+
+    index = {}
+    for key, text in blobs.items():
+        length = _write_line(f, {"type": "blob", "id": key, "value": text})
+        index[key] = [offset, length]
+        offset += length
+    _write_line(f, {"type": "index", "blobs": index})
+
+
+def save_archive(snapshot: Dict[str, Any], path: str) -> None:
+    """Write a snapshot to `path`, replacing it atomically."""
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        write_archive(snapshot, f)
+    os.replace(temporary, path)
+
+
+class SessionArchive:
+    """
+    A session archive file, read lazily: records are streamed from the start of the file and blobs
+    are read on demand from their offset.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.header = self._parse(f.readline())
+            if self.header.get("type") != "header" or self.header.get("format") != FORMAT:
+                raise ArchiveError(f"{path} is not a session archive")
+            if self.header.get("version", 0) > FORMAT_VERSION:
+                raise ArchiveError(f"{path} has an unsupported version {self.header['version']}")
+            index = self._parse(self._last_line(f))
+        if index.get("type") != "index" or not isinstance(index.get("blobs"), dict):
+            raise ArchiveError(f"{path} is truncated")
+        self._index: Dict[str, list] = index["blobs"]
+        self._blobs: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse(line: bytes) -> Dict[str, Any]:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if not isinstance(record, dict):
+            raise ArchiveError("invalid session archive record")
+        return record
+
+    @staticmethod
+    def _last_line(f: BinaryIO, chunk_size: int = 65536) -> bytes:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        position = end
+        data = b""
+        while position > 0:
+            position = max(0, position - chunk_size)
+            f.seek(position)
+            data = f.read(end - position)
+            newline = data.rfind(b"\n", 0, len(data) - 1)
+            if newline >= 0:
+                return data[newline + 1:]
+        return data
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        """
+        The records before the blobs, in order, still referencing their blobs.
+
+        Raises:
+            ArchiveError: if a record is not valid, or if one of REQUIRED_RECORDS is missing
+        """
+        missing = set(REQUIRED_RECORDS)
+        with open(self.path, "rb") as f:
+            f.readline()
+            for line in f:
+                record = self._parse(line)
+                if record.get("type") in ("blob", "index"):
+                    break
+                _check_record(record)
+                missing.discard(record["type"])
+                yield record
+        if missing:
+            raise ArchiveError(f"{self.path} has no {', '.join(sorted(missing))} record")
+
+    def blob(self, key: str) -> str:
+        with self._lock:
+            text = self._blobs.get(key)
+        if text is not None:
+            return text
+        if key not in self._index:
+            raise ArchiveError(f"missing blob {key}")
+        try:
+            offset, length = self._index[key]
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                text = self._parse(f.read(length))["value"]
+        except OSError as e:
+            raise ArchiveError(f"blob {key} can't be read from {self.path}: {e}") from e
+        except (KeyError, TypeError, ValueError) as e:
+            raise ArchiveError(f"invalid blob {key}") from e
+        if not isinstance(text, str):
+            raise ArchiveError(f"invalid blob {key}")
+        with self._lock:
+            self._blobs[key] = text
+        return text
+
+    def resolve(self, value: Any) -> Any:
+        """`value` with its blob references replaced by their content."""
+        if isinstance(value, dict):
+            if is_blob_ref(value):
+                return self.blob(value[BLOB_KEY])
+            return {key: self.resolve(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(item) for item in value]
+        return value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """The full snapshot, with all its blobs read."""
+        snapshot: Dict[str, Any] = {"chat_history": []}
+        for record in self.records():
+            if record["type"] == "message":
+                message = {k: v for k, v in record.items() if k != "type"}
+                message["data"] = self.resolve(message["data"])
+                snapshot["chat_history"].append(message)
+            else:
+                snapshot[record["type"]] = self.resolve(record["value"])
+        return snapshot
+
+
+class LazyChatMessage(ChatMessage):
+    """A ChatMessage restored from an archive, whose data is read from the archive when first used."""
+
+    def __init__(
+        self, message: str, kind: ChatMessageKind, archive: SessionArchive, data: Any, source: str, is_error: bool
+    ):
+        super().__init__(message, kind, data=None, source=source, is_error=is_error)
+        self._archive = archive
+        self._encoded_data = data
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def data(self) -> Any:
+        with self._lock:
+            if not self._loaded:
+                self._data = self._archive.resolve(self._encoded_data)
+                self._archive = None
+                self._encoded_data = None
+                self._loaded = True
+        return self._data
+
+    def encoded(self, blobs: BlobStore, used: Set[str]) -> Optional[Any]:
+        """
+        The data of the message as encoded in the archive while it was not read, None once it was.
+        The blobs it references are read from the archive into `blobs`, and their ids added to `used`.
+        """
+        with self._lock:
+            if self._loaded:
+                return None
+            archive, data = self._archive, self._encoded_data
+        for key in _blob_refs(data):
+            # Read even when `blobs` has it, so that the message can be read once the archive is gone
+            text = archive.blob(key)
+            if blobs.get(key) is None and blobs.put(text) != key:
+                raise ArchiveError(f"blob {key} does not match its content")
+            used.add(key)
+        return data
+
+
+class ArchiveDirectory:
+    """The session archives received by the web app, kept until the sessions imported from them are saved."""
+
+    def __init__(self, path: str, max_bytes: int = 0):
+        """
+        Initialize a new instance
+
+        Parameters:
+            path (str): the directory the archives are stored in
+            max_bytes (int): the largest archive accepted, 0 for no limit
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, stream: BinaryIO, chunk_size: int = 65536) -> SessionArchive:
+        """
+        Store the archive read from `stream`.
+
+        Raises:
+            ArchiveTooLarge: if the archive is larger than `max_bytes`
+            ArchiveError: if it is not a session archive
+        """
+        path = os.path.join(self.path, f"{uuid.uuid4().hex}.session.jsonl")
+        try:
+            size = 0
+            with open(path, "wb") as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if self.max_bytes and size > self.max_bytes:
+                        raise ArchiveTooLarge(f"the archive is larger than {self.max_bytes} bytes")
+                    f.write(chunk)
+            return SessionArchive(path)
+        except ArchiveError:
+            self.remove(path)
+            raise
+
+    def remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def expire(self, max_age: float) -> None:
+        """Delete the archives no session used in the last `max_age` seconds."""
+        if max_age <= 0:
+            return
+        limit = time.time() - max_age
+        for entry in os.scandir(self.path):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < limit:
+                    os.remove(entry.path)
+            except OSError:
+                pass
@@ -0,0 +1,396 @@
+import abc
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("council")
+
+"""
+Session state kept outside of the process, so that the Flask app can run with several workers
+and survive restarts.
+
+A session snapshot is a JSON-serializable dict produced by `AgentApp.snapshot()`. Every save
+bumps the session version, which is how a worker notices that its cached copy is stale. While the
+generation of the store is unchanged, no other worker wrote to it and the cached copies are current.
+The large strings of a snapshot are in its "blobs", which are stored apart and written only once.
+Sessions not saved for SESSION_TTL seconds are deleted.
+"""
+
+
+class SessionStore(abc.ABC):
+    """Persistent storage for session snapshots."""
+
+    @abc.abstractmethod
+    def version(self, session_id: str) -> Optional[int]:
+        """Return the current version of a session, or None if it doesn't exist."""
+        pass
+
+    @abc.abstractmethod
+    def load(self, session_id: str) -> Optional[Tuple[int, Dict]]:
+        """Return the version and snapshot of a session, or None if it doesn't exist."""
+        pass
+
+    @abc.abstractmethod
+    def save(self, session_id: str, snapshot: Dict) -> int:
+        """Store a snapshot and return the new version of the session."""
+        pass
+
+    @abc.abstractmethod
+    def delete(self, session_id: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def expire(self, max_age: float) -> List[str]:
+        """Delete the sessions not saved in the last `max_age` seconds and return their ids."""
+        pass
+
+    def generation(self) -> Optional[int]:
+        """A value that changes whenever another process changes the store, or None if the store can't tell."""
+        return None
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Stores sessions as JSON in a local SQLite database. Safe to share between threads and processes on the same host.
+    """
+
+    def __init__(self, path: str = "./sessions.db", timeout: float = 30):
+        self._path = path
+        self._timeout = timeout
+        # The writes of the process go through one connection, whose data_version changes
+        # only when another process writes
+        self._writer: Optional[sqlite3.Connection] = None
+        self._writer_pid: Optional[int] = None
+        self._writer_lock = threading.Lock()
+        with closing(self._connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    updated_at REAL NOT NULL,
+                    snapshot TEXT NOT NULL
+                )
+                """
+            )
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS blobs (
+                    session_id TEXT NOT NULL,
+                    blob_id TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    PRIMARY KEY (session_id, blob_id)
+                )
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._path, timeout=self._timeout)
+
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        """The writer connection, in a transaction, for one thread at a time."""
+        with self._writer_lock:
+            # A connection doesn't survive a fork, open it again in a forked worker process
+            if self._writer_pid != os.getpid():
+                self._writer = sqlite3.connect(self._path, timeout=self._timeout, check_same_thread=False)
+                self._writer_pid = os.getpid()
+            with self._writer:
+                yield self._writer
+
+    def generation(self) -> Optional[int]:
+        with self._write() as connection:
+            return connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def version(self, session_id: str) -> Optional[int]:
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                "SELECT version FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def load(self, session_id: str) -> Optional[Tuple[int, Dict]]:
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                "SELECT version, snapshot FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            snapshot = json.loads(row[1])
+            blob_ids = snapshot.pop("blob_ids", None)
+            if blob_ids is not None:
+                snapshot["blobs"] = dict(
+                    connection.execute(
+                        "SELECT blob_id, content FROM blobs WHERE session_id = ? AND blob_id IN (SELECT value FROM json_each(?))",
+                        (session_id, json.dumps(blob_ids)),
+                    ).fetchall()
+                )
+        return row[0], snapshot
+
+    def save(self, session_id: str, snapshot: Dict) -> int:
+        blobs = snapshot.get("blobs", {})
+        payload = json.dumps(
+            {key: value for key, value in snapshot.items() if key != "blobs"} | {"blob_ids": list(blobs)},
+            default=str,
+        )
+        with self._write() as connection:
+            stored = {
+                row[0] for row in connection.execute("SELECT blob_id FROM blobs WHERE session_id = ?", (session_id,))
+            }
+            connection.executemany(
+                "INSERT OR IGNORE INTO blobs (session_id, blob_id, content) VALUES (?, ?, ?)",
+                [(session_id, key, text) for key, text in blobs.items() if key not in stored],
+            )
+            unused = stored - set(blobs)
+            if unused:
+                connection.executemany(
+                    "DELETE FROM blobs WHERE session_id = ? AND blob_id = ?", [(session_id, key) for key in unused]
+                )
+            connection.execute(
+                """
+                INSERT INTO sessions (session_id, version, updated_at, snapshot) VALUES (?, 1, ?, ?)
+                ON CONFLICT(session_id) DO UPDATE SET
+                    version = version + 1, updated_at = excluded.updated_at, snapshot = excluded.snapshot
+                """,
+                (session_id, time.time(), payload),
+            )
+            row = connection.execute(
+                "SELECT version FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return row[0]
+
+    def delete(self, session_id: str) -> None:
+        with self._write() as connection:
+            connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            connection.execute("DELETE FROM blobs WHERE session_id = ?", (session_id,))
+
+    def expire(self, max_age: float) -> List[str]:
+        with self._write() as connection:
+            expired = [
+                row[0]
+                for row in connection.execute(
+                    "SELECT session_id FROM sessions WHERE updated_at < ?", (time.time() - max_age,)
+                )
+            ]
+            connection.executemany("DELETE FROM sessions WHERE session_id = ?", [(key,) for key in expired])
+            connection.executemany("DELETE FROM blobs WHERE session_id = ?", [(key,) for key in expired])
+        return expired
+
+
+class _SessionLock:
+    """The locks of a session, and the number of requests holding or waiting for them."""
+
+    def __init__(self):
+        # Held to load, change and save the AgentApp, for as long as a request but not a turn takes
+        self.state = threading.Lock()
+        # Held for the whole turn, turns of a session run one at a time
+        self.turn = threading.Lock()
+        self.users = 0
+
+
+class _CachedSession:
+    def __init__(self, version: int, agent_app, generation: Optional[int]):
+        self.version = version
+        self.agent_app = agent_app
+        # The generation of the store at which `version` was known to be current
+        self.generation = generation
+
+
+class SessionManager:
+    """
+    Keeps recently used sessions in memory and rehydrates the others from a SessionStore on first use.
+
+    Requests for the same session are serialized within a process, except that a turn holds the
+    session only to load it and to save it: the requests reading or editing the session while a
+    turn runs change the AgentApp of the turn, and are saved with it. Across processes the last
+    write wins. Sessions not saved for `ttl` seconds are deleted from the store.
+    """
+
+    def __init__(self, store: SessionStore, factory: Callable, capacity: int = 64, ttl: float = 7 * 24 * 3600):
+        """
+        Initialize a new instance
+
+        Parameters:
+            store (SessionStore): where sessions are persisted
+            factory (Callable): builds a new AgentApp
+            capacity (int): maximum number of sessions kept in memory
+            ttl (float): seconds after its last save a session is deleted, 0 to keep sessions forever
+        """
+        self._store = store
+        self._factory = factory
+        self._capacity = capacity
+        self._ttl = ttl
+        self._next_expiry = 0.0
+        self._cache: "OrderedDict[str, _CachedSession]" = OrderedDict()
+        # The AgentApps running a turn, which are saved when the turn ends
+        self._running: Dict[str, object] = {}
+        self._locks: Dict[str, _SessionLock] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _session_lock(self, session_id: str) -> Iterator[_SessionLock]:
+        with self._lock:
+            lock = self._locks.get(session_id)
+            if lock is None:
+                lock = self._locks[session_id] = _SessionLock()
+            lock.users += 1
+        try:
+            yield lock
+        finally:
+            with self._lock:
+                lock.users -= 1
+                if session_id not in self._cache:
+                    self._drop_lock(session_id)
+
+    def _drop_lock(self, session_id: str) -> None:
+        # Called with self._lock held: the lock of a session goes with its cache entry, once unused
+        lock = self._locks.get(session_id)
+        if lock is not None and lock.users == 0:
+            del self._locks[session_id]
+
+    def _cache_put(self, session_id: str, version: int, agent_app, generation: Optional[int]) -> None:
+        with self._lock:
+            self._cache[session_id] = _CachedSession(version, agent_app, generation)
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self._capacity:
+                evicted, _ = self._cache.popitem(last=False)
+                self._drop_lock(evicted)
+
+    def _cache_drop(self, session_id: str) -> None:
+        with self._lock:
+            self._cache.pop(session_id, None)
+            self._drop_lock(session_id)
+
+    def _expire(self) -> None:
+        """Delete the sessions of the store that expired, at most once every tenth of the TTL."""
+        if self._ttl <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_expiry:
+                return
+            self._next_expiry = now + self._ttl / 10
+        expired = self._store.expire(self._ttl)
+        for session_id in expired:
+            self._cache_drop(session_id)
+        if expired:
+            logger.info(f"expired {len(expired)} sessions")
+
+    def _get(self, session_id: str):
+        with self._lock:
+            running = self._running.get(session_id)
+            if running is not None:
+                # Saved when its turn ends
+                return running
+            cached = self._cache.get(session_id)
+            if cached is not None:
+                self._cache.move_to_end(session_id)
+
+        # Read before the version, so that a write after the version was read changes it
+        generation = self._store.generation()
+        if cached is not None and generation is not None and cached.generation == generation:
+            return cached.agent_app
+        version = self._store.version(session_id)
+        if cached is not None and cached.version == version:
+            cached.generation = generation
+            return cached.agent_app
+
+        # The session is unknown to this process, or another process updated it
+        loaded = self._store.load(session_id)
+        agent_app = self._factory()
+        if loaded is None:
+            version = self._store.save(session_id, agent_app.snapshot())
+        else:
+            version, snapshot = loaded
+            agent_app.restore(snapshot)
+            logger.debug(f"session {session_id} rehydrated at version {version}")
+        self._cache_put(session_id, version, agent_app, generation)
+        return agent_app
+
+    def _save(self, session_id: str, agent_app) -> None:
+        generation = self._store.generation()
+        version = self._store.save(session_id, agent_app.snapshot())
+        self._cache_put(session_id, version, agent_app, generation)
+
+    def _is_running(self, session_id: str, agent_app) -> bool:
+        with self._lock:
+            return self._running.get(session_id) is agent_app
+
+    @contextmanager
+    def session(self, session_id: str, save: bool = True) -> Iterator:
+        """
+        Context manager giving exclusive access to the AgentApp of a session, except for its turn.
+        The session is saved on exit unless `save` is False, the block raised an exception, or a turn
+        is running, which saves it when it ends.
+        """
+        self._expire()
+        with self._session_lock(session_id) as lock, lock.state:
+            agent_app = self._get(session_id)
+            running = self._is_running(session_id, agent_app)
+            try:
+                yield agent_app
+            except BaseException:
+                # The AgentApp may be left half way through a change, the next request reloads the saved session
+                if not running:
+                    self._cache_drop(session_id)
+                raise
+            if save and not running:
+                self._save(session_id, agent_app)
+
+    @contextmanager
+    def turn(self, session_id: str) -> Iterator:
+        """
+        Context manager running a turn on the AgentApp of a session, after the turn of the session already
+        running, if any. The session is saved on exit unless the block raised an exception.
+        """
+        self._expire()
+        with self._session_lock(session_id) as lock, lock.turn:
+            with lock.state:
+                agent_app = self._get(session_id)
+                with self._lock:
+                    self._running[session_id] = agent_app
+            try:
+                yield agent_app
+            except BaseException:
+                with lock.state:
+                    with self._lock:
+                        del self._running[session_id]
+                    self._cache_drop(session_id)
+                raise
+            with lock.state:
+                with self._lock:
+                    del self._running[session_id]
+                self._save(session_id, agent_app)
+
+    def peek(self, session_id: str):
+        """The AgentApp of a session if this process has it in memory, without waiting for the request using it."""
+        with self._lock:
+            running = self._running.get(session_id)
+            if running is not None:
+                return running
+            cached = self._cache.get(session_id)
+        return None if cached is None else cached.agent_app
+
+    def reset(self, session_id: str):
+        """Replace a session with a new AgentApp, once its turn ended."""
+        with self._session_lock(session_id) as lock, lock.turn, lock.state:
+            agent_app = self._factory()
+            self._save(session_id, agent_app)
+            return agent_app
+
+    def create(self):
+        """A new AgentApp, built like the AgentApps of the sessions."""
+        return self._factory()
+
+    def replace(self, session_id: str, agent_app):
+        """Replace a session with the given AgentApp, e.g. one restored from an archive, once its turn ended."""
+        with self._session_lock(session_id) as lock, lock.turn, lock.state:
+            self._save(session_id, agent_app)
+            return agent_app
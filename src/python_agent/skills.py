@@ -3,18 +3,136 @@ from council.contexts import ChatMessage, ChainContext
 from council.runners import Budget
 from council.llm import LLMBase, LLMMessage
 
+from python_agent.cancellation import TurnCancellation, TurnCancelled
+from python_agent.code_analysis import CodeAnalyzer
 from python_agent.code_sandbox import run_code_in_sandbox
+from python_agent.events import AgentEvents
+from python_agent.llm_gateway import count_prompt_tokens, count_text_tokens, prompt_allowance
+from python_agent.symbol_index import FocusedView, SpliceError, SymbolIndex
+from python_agent.token_budget import TokenBudgetExceeded, truncate_to_tokens
 
 import ast
 import logging
 import re
+import time
 from string import Template
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional
 
 logger = logging.getLogger("council")
 
+# Controller state entries left out of prompts when the token budget is short
+LARGE_STATE_KEYS = ("code", "stdout", "stderr")
+# Tokens of the end of the errors error correction keeps, however short the token budget
+MIN_ERROR_TOKENS = 200
+
+# Sent back with an answer whose regions can't be spliced into the code
+SPLICE_RETRY_MESSAGE = (
+    "Your answer can't be applied: {error}. Answer again with only the regions you change, each between "
+    "its '# region N' and '# endregion N' lines, in a single ```python``` code block."
+)
+
+
+def parses_as_python(text: str) -> bool:
+    """Whether `text` is Python code, or ends with a Python code block, as ParsePythonSkill expects."""
+    try:
+        ast.parse(text)
+        return True
+    except (SyntaxError, ValueError):
+        pass
+    matches = re.findall(r"```python\s+(.*?)\s+```", text, re.DOTALL)
+    if not matches:
+        return False
+    try:
+        ast.parse(matches[-1])
+        return True
+    except (SyntaxError, ValueError):
+        return False
+
+
+def fits(llm: LLMBase, messages: List[LLMMessage]) -> bool:
+    """Whether `messages` fit in the prompt tokens `llm` can still send."""
+    allowance = prompt_allowance(llm)
+    return allowance is None or count_prompt_tokens(llm, messages) <= allowance
+
+
+def focused_view(
+    index: SymbolIndex, code: Optional[str], min_lines: int, text: str, errors: str = ""
+) -> Optional[FocusedView]:
+    """A view of `code` showing only the parts relevant to the task, None to send the whole code."""
+    if not min_lines or not code or code.count("\n") + 1 < min_lines:
+        return None
+    with index.lock:
+        if not index.update(code):
+            return None
+        return index.focus(text, errors)
+
+
+def splice_answer(llm: LLMBase, view: FocusedView, messages: List[LLMMessage], name: str) -> Optional[str]:
+    """
+    The code of `view` with the regions the LLM answers to `messages` spliced in. An answer that can't be
+    spliced is sent back once with the reason, None if the second answer can't be spliced either.
+    """
+    for _ in range(2):
+        llm_response = llm.post_chat_request(messages=messages).first_choice
+        logger.debug(f"{name}, edited regions: {llm_response}")
+        try:
+            return view.splice(llm_response)
+        except SpliceError as e:
+            logger.warning(f"{name}, the answer can't be spliced: {e}")
+            messages = messages + [
+                LLMMessage.assistant_message(llm_response),
+                LLMMessage.user_message(SPLICE_RETRY_MESSAGE.format(error=e)),
+            ]
+    return None
+
+
+class ObservableSkillBase(SkillBase):
+    """
+    A SkillBase that publishes skill_started and skill_finished events.
+    A skill whose LLM request exceeds the token budget, or whose turn is cancelled, ends with an error
+    message instead of raising.
+    """
 
-class PythonCodeGenerationSkill(SkillBase):
+    def __init__(
+        self, name: str, events: Optional[AgentEvents] = None, cancellation: Optional[TurnCancellation] = None
+    ):
+        super().__init__(name=name)
+        self.events = events or AgentEvents()
+        self.cancellation = cancellation
+
+    def execute_skill(self, context: ChainContext, budget: Budget) -> ChatMessage:
+        self.events.current_skill = self.name
+        self.events.emit("skill_started")
+        start = time.monotonic()
+        is_error = True
+        try:
+            if self.cancellation is not None:
+                self.cancellation.check()
+            message = super().execute_skill(context, budget)
+            is_error = message.is_error
+            return message
+        except TokenBudgetExceeded as e:
+            logger.warning(f"{self.name}, token budget exceeded: {e}")
+            return ChatMessage.skill(
+                source=self.name,
+                message=f"I stopped before sending another request to the LLM because the token budget is exhausted: {e}.",
+                data=context.last_message.data,
+                is_error=True,
+            )
+        except TurnCancelled:
+            logger.info(f"{self.name}, turn cancelled")
+            return ChatMessage.skill(
+                source=self.name,
+                message="I stopped because the turn was cancelled.",
+                data=context.last_message.data,
+                is_error=True,
+            )
+        finally:
+            self.events.emit("skill_finished", is_error=is_error, duration=time.monotonic() - start)
+            self.events.current_skill = None
+
+
+class PythonCodeGenerationSkill(ObservableSkillBase):
     """General Python code generation skill."""
 
     def __init__(
@@ -23,44 +141,81 @@ class PythonCodeGenerationSkill(SkillBase):
         system_prompt: str,
         main_prompt_template: Template,
         code_header: str,
+        events: Optional[AgentEvents] = None,
+        focus_min_lines: int = 0,
+        cancellation: Optional[TurnCancellation] = None,
+        symbol_index: Optional[SymbolIndex] = None,
+        focus_prompt_template: Optional[Template] = None,
     ):
-        """Build a new PythonCodeGenerationSkill."""
+        """
+        Build a new PythonCodeGenerationSkill. Code of `focus_min_lines` lines or more is sent as an outline,
+        built from `symbol_index`, with `focus_prompt_template`.
+        """
 
-        super().__init__(name="PythonCodeGenerationSkill")
+        super().__init__(name="PythonCodeGenerationSkill", events=events, cancellation=cancellation)
         self.llm = llm
         self.system_prompt = LLMMessage.system_message(system_prompt)
         self.main_prompt_template = main_prompt_template
+        self.focus_prompt_template = focus_prompt_template
         self.code_header = code_header
+        self.focus_min_lines = focus_min_lines if focus_prompt_template is not None else 0
+        self.symbol_index = symbol_index or SymbolIndex()
 
     def execute(self, context: ChainContext, _budget: Budget) -> ChatMessage:
         """Execute `PythonCodeGenerationSkill`."""
 
-        prompt = self.main_prompt_template.substitute(
+        code = context.last_message.data["code"]
+        text = f"{context.last_message.message}\n{context.last_user_message.message}"
+        view = focused_view(self.symbol_index, code, self.focus_min_lines, text)
+        if (
+            view is None
+            and self.focus_prompt_template is not None
+            and not fits(self.llm, self.build_messages(context, code, self.main_prompt_template))
+        ):
+            # The whole code does not fit in the token budget, send the parts of it the task needs
+            view = focused_view(self.symbol_index, code, 1, text)
+            if view is not None:
+                logger.info(f"{self.name}, the code does not fit in the token budget, sending an outline")
+        llm_response = None
+        if view is not None:
+            logger.debug(f"{self.name}, sending {view.region_lines} of {len(view.lines)} lines of code")
+            messages = self.build_messages(context, view.render(), self.focus_prompt_template)
+            llm_response = splice_answer(self.llm, view, messages, self.name)
+            if llm_response is None:
+                # Never take the answer for the whole program, it was written from the outline. The whole
+                # code is sent instead, and is refused by the token budget if it does not fit
+                logger.warning(f"{self.name}, the edited regions can't be spliced, sending the whole code")
+        if llm_response is None:
+            llm_response = self.generate(context, code, self.main_prompt_template)
+
+        return ChatMessage.skill(
+            source=self.name,
+            message="I've edited code for you and placed the result in the 'data' field.",
+            data=context.last_message.data | {"code": llm_response},
+        )
+
+    def generate(self, context: ChainContext, existing_code: str, template: Template) -> str:
+        messages_to_llm = self.build_messages(context, existing_code, template)
+        llm_response = self.llm.post_chat_request(messages=messages_to_llm).first_choice
+        logger.debug(f"{self.name}, generated code: {llm_response}")
+        return llm_response
+
+    def build_messages(self, context: ChainContext, existing_code: str, template: Template) -> List[LLMMessage]:
+        prompt = template.substitute(
             code_header=self.code_header,
-            existing_code=context.last_message.data["code"],
+            existing_code=existing_code,
             user_message=context.last_user_message.message,
             task=context.last_message.message,
         )
-
-        messages_to_llm = [
+        return [
             self.system_prompt,
             LLMMessage.assistant_message(prompt),
         ]
 
-        llm_response = self.llm.post_chat_request(messages=messages_to_llm).first_choice
-
-        logger.debug(f"{self.name}, generated code: {llm_response}")
-
-        return ChatMessage.skill(
-            source=self.name,
-            message="I've edited code for you and placed the result in the 'data' field.",
-            data=context.last_message.data | {"code": llm_response},
-        )
-
 
-class ParsePythonSkill(SkillBase):
-    def __init__(self):
-        super().__init__(name="ParsePythonSkill")
+class ParsePythonSkill(ObservableSkillBase):
+    def __init__(self, events: Optional[AgentEvents] = None, cancellation: Optional[TurnCancellation] = None):
+        super().__init__(name="ParsePythonSkill", events=events, cancellation=cancellation)
 
     def execute(self, context: ChainContext, budget: Budget) -> ChatMessage:
         # Get the code
@@ -98,19 +253,27 @@ class ParsePythonSkill(SkillBase):
             )
 
 
-class PythonErrorCorrectionSkill(SkillBase):
+class PythonErrorCorrectionSkill(ObservableSkillBase):
     def __init__(
         self,
         llm: LLMBase,
         system_prompt: str,
         main_prompt_template: Template,
         code_header: str,
+        events: Optional[AgentEvents] = None,
+        focus_min_lines: int = 0,
+        cancellation: Optional[TurnCancellation] = None,
+        symbol_index: Optional[SymbolIndex] = None,
+        focus_prompt_template: Optional[Template] = None,
     ):
-        super().__init__(name="PythonErrorCorrectionSkill")
+        super().__init__(name="PythonErrorCorrectionSkill", events=events, cancellation=cancellation)
         self.llm = llm
         self.system_prompt = system_prompt
         self.main_prompt_template = main_prompt_template
+        self.focus_prompt_template = focus_prompt_template
         self.code_header = code_header
+        self.focus_min_lines = focus_min_lines if focus_prompt_template is not None else 0
+        self.symbol_index = symbol_index or SymbolIndex()
 
     def execute(
         self, context: ChainContext, budget: Budget, num_retries=3
@@ -126,24 +289,23 @@ class PythonErrorCorrectionSkill(SkillBase):
         code = context.last_message.data["code"]
 
         # Get the error(s)
-        errors = context.last_message.data["stderr"]
+        errors = context.last_message.data["stderr"] or ""
 
-        prompt = self.main_prompt_template.substitute(
-            task=task,
-            existing_code=code,
-            code_header=self.code_header,
-            errors=errors,
-            user_message=context.last_user_message.message,
+        # Send only the parts of a long program the task and the traceback point to
+        view = focused_view(
+            self.symbol_index, code, self.focus_min_lines, f"{task}\n{context.last_user_message.message}", errors
         )
-        logger.debug(f"{self.name}, prompt {prompt}")
-
-        messages_to_llm = [
-            LLMMessage.system_message(self.system_prompt),
-            LLMMessage.assistant_message(prompt),
-        ]
-
-        llm_response = self.llm.post_chat_request(messages=messages_to_llm).first_choice
-        logger.debug(f"{self.name}, corrected code: {llm_response}")
+        llm_response = None
+        if view is not None:
+            logger.debug(f"{self.name}, sending {view.region_lines} of {len(view.lines)} lines of code")
+            messages = self.fit_messages(context, task, view.render(), errors, self.focus_prompt_template)
+            llm_response = splice_answer(self.llm, view, messages, self.name)
+            if llm_response is None:
+                # Never take the answer for the whole program, it was written from the outline. The whole
+                # code is sent instead, and is refused by the token budget if it does not fit
+                logger.warning(f"{self.name}, the corrected regions can't be spliced, sending the whole code")
+        if llm_response is None:
+            llm_response = self.correct(context, task, code, errors, self.main_prompt_template)
 
         # Run the code and return the resulting message
         data = context.last_message.data | {
@@ -159,15 +321,67 @@ class PythonErrorCorrectionSkill(SkillBase):
             is_error=False,
         )
 
-class PythonExecutionSkill(SkillBase):
+    def correct(self, context: ChainContext, task: str, code: str, errors: str, template: Template) -> str:
+        messages_to_llm = self.fit_messages(context, task, code, errors, template)
+        llm_response = self.llm.post_chat_request(messages=messages_to_llm).first_choice
+        logger.debug(f"{self.name}, corrected code: {llm_response}")
+        return llm_response
+
+    def fit_messages(
+        self, context: ChainContext, task: str, code: str, errors: str, template: Template
+    ) -> List[LLMMessage]:
+        """The messages asking to correct `errors`, cut down to the prompt tokens the LLM can still send."""
+        messages_to_llm = self.build_messages(context, task, code, errors, template)
+        allowance = prompt_allowance(self.llm)
+        if allowance is not None and errors:
+            # Keep the end of the errors, where the traceback points to the failure, and at least
+            # MIN_ERROR_TOKENS of it: a prompt that still doesn't fit is refused by the token budget
+            excess = count_prompt_tokens(self.llm, messages_to_llm) - allowance
+            error_tokens = count_text_tokens(self.llm, errors) if excess > 0 else 0
+            while excess > 0 and error_tokens > MIN_ERROR_TOKENS:
+                error_tokens = max(error_tokens - excess, MIN_ERROR_TOKENS)
+                errors = truncate_to_tokens(
+                    errors, error_tokens, keep_end=True, count_tokens=lambda text: count_text_tokens(self.llm, text)
+                )
+                messages_to_llm = self.build_messages(context, task, code, errors, template)
+                excess = count_prompt_tokens(self.llm, messages_to_llm) - allowance
+        logger.debug(f"{self.name}, prompt {messages_to_llm[-1].content}")
+        return messages_to_llm
+
+    def build_messages(
+        self, context: ChainContext, task: str, code: str, errors: str, template: Optional[Template] = None
+    ) -> List[LLMMessage]:
+        prompt = (template or self.main_prompt_template).substitute(
+            task=task,
+            existing_code=code,
+            code_header=self.code_header,
+            errors=errors,
+            user_message=context.last_user_message.message,
+        )
+        return [
+            LLMMessage.system_message(self.system_prompt),
+            LLMMessage.assistant_message(prompt),
+        ]
+
+class PythonExecutionSkill(ObservableSkillBase):
     def __init__(
         self,
         llm: LLMBase,
         python_bin_dir: str,
+        events: Optional[AgentEvents] = None,
+        runner: Callable[..., Dict] = run_code_in_sandbox,
+        cancellation: Optional[TurnCancellation] = None,
+        code_analyzer: Optional[CodeAnalyzer] = None,
     ):
-        super().__init__(name="PythonExecutionSkill")
+        super().__init__(name="PythonExecutionSkill", events=events, cancellation=cancellation)
         self.llm = llm
         self.python_bin_dir = python_bin_dir
+        # Runs the code and returns its returncode, stdout and stderr, like run_code_in_sandbox,
+        # kills it when its `cancellation` keyword argument is cancelled, and takes the known
+        # pre-flight `diagnostics` of the code
+        self.runner = runner
+        # The background analysis of the code of the session, whose diagnostics are reused
+        self.code_analyzer = code_analyzer
 
     def execute(self, context: ChainContext, budget: Budget) -> ChatMessage:
         """
@@ -208,7 +422,18 @@ class PythonExecutionSkill(SkillBase):
 
         try:
             # Run the Python file as a subprocess
-            exec_result = run_code_in_sandbox(code, self.python_bin_dir)
+            start = time.monotonic()
+            diagnostics = self.code_analyzer.diagnostics(code) if self.code_analyzer is not None else None
+            exec_result = self.runner(
+                code, self.python_bin_dir, cancellation=self.cancellation, diagnostics=diagnostics
+            )
+            self.events.emit(
+                "sandbox_exited",
+                returncode=exec_result["returncode"],
+                stdout_size=len(exec_result["stdout"]),
+                stderr_size=len(exec_result["stderr"]),
+                duration=time.monotonic() - start,
+            )
 
             data = data | {
                 "code": code,
@@ -234,6 +459,8 @@ class PythonExecutionSkill(SkillBase):
                     data=data,
                     is_error=True,
                 )
+        except TurnCancelled:
+            raise
         except Exception as e:
             data = data | {
                 "code": code,
@@ -250,18 +477,20 @@ class PythonExecutionSkill(SkillBase):
             )
 
 
-class GeneralSkill(SkillBase):
+class GeneralSkill(ObservableSkillBase):
     """Respond to questions using plain LLM call."""
 
     def __init__(
         self,
         llm: LLMBase,
         system_prompt: str,
-        main_prompt_template: Template
+        main_prompt_template: Template,
+        events: Optional[AgentEvents] = None,
+        cancellation: Optional[TurnCancellation] = None,
     ):
         """Build a new GeneralSkill."""
 
-        super().__init__(name="GeneralSkill")
+        super().__init__(name="GeneralSkill", events=events, cancellation=cancellation)
         self.llm = llm
         self.system_prompt = LLMMessage.system_message(system_prompt)
         self.main_prompt_template = main_prompt_template
@@ -269,12 +498,12 @@ class GeneralSkill(SkillBase):
     def execute(self, context: ChainContext, _budget: Budget) -> ChatMessage:
         """Execute `GeneralSkill`."""
 
-        prompt = self.main_prompt_template.substitute(
-            controller_state=context.last_message.data,
-            controller_instructions=context.last_message.message
-        )
-
-        messages_to_llm = [self.system_prompt, LLMMessage.assistant_message(prompt)]
+        messages_to_llm = self.build_messages(context.last_message.data, context.last_message.message)
+        allowance = prompt_allowance(self.llm)
+        if allowance is not None and count_prompt_tokens(self.llm, messages_to_llm) > allowance:
+            # The code and its output are the bulk of the state, answer without them
+            state = {k: v for k, v in context.last_message.data.items() if k not in LARGE_STATE_KEYS}
+            messages_to_llm = self.build_messages(state, context.last_message.message)
 
         llm_response = self.llm.post_chat_request(messages=messages_to_llm).first_choice
 
@@ -286,15 +515,24 @@ class GeneralSkill(SkillBase):
             data=context.last_message.data,
         )
 
-class DirectToUserSkill(SkillBase):
+    def build_messages(self, controller_state: Dict, instructions: str) -> List[LLMMessage]:
+        prompt = self.main_prompt_template.substitute(
+            controller_state=controller_state,
+            controller_instructions=instructions,
+        )
+        return [self.system_prompt, LLMMessage.assistant_message(prompt)]
+
+class DirectToUserSkill(ObservableSkillBase):
     """Just send a message to the user."""
 
     def __init__(
         self,
+        events: Optional[AgentEvents] = None,
+        cancellation: Optional[TurnCancellation] = None,
     ):
         """Build a new DirectToUserSkill."""
 
-        super().__init__(name="DirectToUserSkill")
+        super().__init__(name="DirectToUserSkill", events=events, cancellation=cancellation)
 
     def execute(self, context: ChainContext, _budget: Budget) -> ChatMessage:
         """Execute `DirectToUserSkill`."""
@@ -0,0 +1,438 @@
+import ast
+import dataclasses
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger("council")
+
+"""
+A symbol index of the code being edited, used to send the LLM only the parts of a long program
+that a task is about.
+
+The code is split into units: top-level functions, methods, and runs of other statements at the
+module or class level. The index records the names each unit defines and references. For a task
+and its errors, the units it mentions by name, those holding the lines of a traceback, and those
+referencing a mentioned name become regions shown in full; the rest of the program is shown as an
+outline of signatures. The LLM answers with the regions it changed, which are spliced back into
+the code locally.
+
+Programs shorter than CODE_FOCUS_MIN_LINES lines (default 100, 0 to never focus) are sent whole.
+"""
+
+# Selections covering more of the code than this are not worth focusing on
+MAX_FOCUS_RATIO = 0.6
+
+# Statements up to this many lines are shown in full in the outline
+OUTLINE_STATEMENT_LINES = 3
+
+NEW_REGION = "new"
+
+FOCUS_INSTRUCTIONS = """\
+# OUTLINE: hidden lines are replaced by "# ... lines N-M" and the regions relevant to the task
+# by "# (region N: ..., shown below)". The regions are shown in full after the outline."""
+
+# The regions of an answer. The placeholders of the regions in the outline don't match, so that an
+# answer repeating the outline still splices the regions shown in full
+_REGION_PATTERN = re.compile(
+    r"^#\s*region (\w+)\b(?![^\n]*shown below)[^\n]*\n(.*?)^#\s*endregion \1[ \t]*$", re.MULTILINE | re.DOTALL
+)
+_CODE_BLOCK_PATTERN = re.compile(r"```python\s+(.*?)\s+```", re.DOTALL)
+# Frames of the program in tracebacks, it runs with `python -c`
+_LINE_PATTERN = re.compile(r'File "<string>", line (\d+)')
+_WORD_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def code_focus_min_lines() -> int:
+    """Programs with fewer lines than this are sent to the LLM whole."""
+    return int(os.environ.get("CODE_FOCUS_MIN_LINES", 100))
+
+
+@dataclass(frozen=True)
+class CodeUnit:
+    """A function, a method, or a run of other statements, with the names it defines and references."""
+
+    name: str
+    kind: str
+    start: int
+    end: int
+    indent: int
+    outline: Tuple[int, ...]
+    defines: Set[str] = field(default_factory=set)
+    references: Set[str] = field(default_factory=set)
+    scope: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start + 1
+
+    def shifted(self, delta: int) -> "CodeUnit":
+        return dataclasses.replace(
+            self,
+            start=self.start + delta,
+            end=self.end + delta,
+            outline=tuple(line + delta for line in self.outline),
+        )
+
+
+class _ReferenceCollector(ast.NodeVisitor):
+    def __init__(self):
+        self.references: Set[str] = set()
+
+    def visit_Name(self, node: ast.Name):
+        if isinstance(node.ctx, ast.Load):
+            self.references.add(node.id)
+
+    def visit_Attribute(self, node: ast.Attribute):
+        self.references.add(node.attr)
+        self.generic_visit(node)
+
+
+def _references(nodes: List[ast.AST]) -> Set[str]:
+    collector = _ReferenceCollector()
+    for node in nodes:
+        collector.visit(node)
+    return collector.references
+
+
+def _defines(nodes: List[ast.stmt]) -> Set[str]:
+    names = set()
+    for node in nodes:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update((alias.asname or alias.name).split(".")[0] for alias in node.names)
+        else:
+            for child in ast.walk(node):
+                if isinstance(child, ast.Name) and not isinstance(child.ctx, ast.Load):
+                    names.add(child.id)
+                elif isinstance(child, ast.Attribute) and not isinstance(child.ctx, ast.Load):
+                    names.add(child.attr)
+    return names
+
+
+def _mentioned(name: str, words: Set[str]) -> bool:
+    """Whether a symbol is named in a text made of `words`, as is or as the words of its snake or camel case name."""
+    if len(name) < 3:
+        return False
+    if name.lower() in words:
+        return True
+    parts = [part.lower() for part in re.findall(r"[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])", name)]
+    return len(parts) > 1 and all(part in words for part in parts)
+
+
+def _start(node: ast.stmt) -> int:
+    decorators = getattr(node, "decorator_list", [])
+    return min([node.lineno] + [d.lineno for d in decorators])
+
+
+class SymbolIndex:
+    """
+    The units and symbols of a program, kept up to date with `update`.
+
+    Updates re-analyse only the top-level statements whose source changed, the units of the others
+    are reused and moved to their new lines.
+    """
+
+    def __init__(self):
+        self.code: Optional[str] = None
+        self.lines: List[str] = []
+        self.units: List[CodeUnit] = []
+        self.symbols: Dict[str, List[CodeUnit]] = {}
+        self.references: Dict[str, List[CodeUnit]] = {}
+        self.classes: Dict[str, List[CodeUnit]] = {}
+        self._cache: Dict[str, Tuple[int, List[CodeUnit]]] = {}
+        # Held by updates, and by readers that need the index of a given code, e.g. while code is analysed in the background
+        self.lock = threading.RLock()
+
+    def update(self, code: str) -> bool:
+        """Index `code`, returns False if it does not parse."""
+        with self.lock:
+            return self._update(code)
+
+    def _update(self, code: str) -> bool:
+        if code == self.code:
+            return bool(self.units)
+        self.code = code
+        self.lines = code.splitlines()
+        try:
+            tree = ast.parse(code)
+        except (SyntaxError, ValueError):
+            self.units, self.symbols, self.references, self.classes = [], {}, {}, {}
+            return False
+
+        cache, units = {}, []
+        for group in self._groups(tree.body):
+            start, end = _start(group[0]), group[-1].end_lineno
+            source = "\n".join(self.lines[start - 1 : end])
+            cached = self._cache.get(source)
+            if cached is None:
+                cached = (start, self._units(group, None, 0))
+            cache[source] = cached
+            units += [unit.shifted(start - cached[0]) for unit in cached[1]]
+        self._cache = cache
+        self.units = units
+
+        self.symbols, self.references, self.classes = {}, {}, {}
+        for unit in units:
+            for name in unit.defines:
+                self.symbols.setdefault(name, []).append(unit)
+            for name in unit.references:
+                self.references.setdefault(name, []).append(unit)
+            if unit.scope is not None:
+                self.classes.setdefault(unit.scope, []).append(unit)
+        return True
+
+    @staticmethod
+    def _groups(body: List[ast.stmt]) -> List[List[ast.stmt]]:
+        """Definitions on their own, and paragraphs of other statements, not separated by blank lines or comments."""
+        groups: List[List[ast.stmt]] = []
+        definitions = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+        for node in body:
+            previous = groups[-1][-1] if groups else None
+            if (
+                previous is not None
+                and not isinstance(node, definitions)
+                and not isinstance(previous, definitions)
+                and _start(node) == previous.end_lineno + 1
+            ):
+                groups[-1].append(node)
+            else:
+                groups.append([node])
+        return groups
+
+    def _units(self, group: List[ast.stmt], scope: Optional[str], indent: int) -> List[CodeUnit]:
+        node = group[0]
+        if isinstance(node, ast.ClassDef) and node.body[0].lineno == node.lineno:
+            return [
+                CodeUnit(
+                    name=node.name if scope is None else f"{scope}.{node.name}",
+                    kind="class",
+                    start=_start(node),
+                    end=node.end_lineno,
+                    indent=indent,
+                    outline=tuple(range(_start(node), node.end_lineno + 1)),
+                    defines={node.name},
+                    references=_references([node]),
+                    scope=scope,
+                )
+            ]
+        if isinstance(node, ast.ClassDef):
+            units = [
+                CodeUnit(
+                    name=node.name,
+                    kind="class",
+                    start=_start(node),
+                    end=node.body[0].lineno - 1,
+                    indent=indent,
+                    outline=tuple(range(_start(node), node.body[0].lineno)),
+                    defines={node.name},
+                    references=_references(node.bases + node.keywords + node.decorator_list),
+                    scope=scope,
+                )
+            ]
+            for members in self._groups(node.body):
+                units += self._units(members, node.name, node.body[0].col_offset)
+            return units
+
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            body = node.body
+            # The signature, and the docstring if any
+            outline_end = max(body[0].lineno - 1, node.lineno)
+            if isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) and len(body) > 1:
+                outline_end = body[0].end_lineno
+            return [
+                CodeUnit(
+                    name=node.name if scope is None else f"{scope}.{node.name}",
+                    kind="function" if scope is None else "method",
+                    start=_start(node),
+                    end=node.end_lineno,
+                    indent=indent,
+                    outline=tuple(range(_start(node), outline_end + 1)),
+                    defines={node.name},
+                    references=_references([node]),
+                    scope=scope,
+                )
+            ]
+
+        start, end = _start(node), group[-1].end_lineno
+        outline = []
+        for statement in group:
+            # Short statements in full, the first line of others
+            last = statement.end_lineno
+            if last - _start(statement) >= OUTLINE_STATEMENT_LINES or hasattr(statement, "body"):
+                last = _start(statement)
+            outline += range(_start(statement), last + 1)
+        return [
+            CodeUnit(
+                name=f"{scope or '<module>'}:{start}",
+                kind="statements",
+                start=start,
+                end=end,
+                indent=indent,
+                outline=tuple(outline),
+                defines=_defines(group),
+                references=_references(group),
+                scope=scope,
+            )
+        ]
+
+    def unit_at(self, line: int) -> Optional[CodeUnit]:
+        for unit in self.units:
+            if unit.start <= line <= unit.end:
+                return unit
+        return None
+
+    def select(self, text: str, errors: str = "") -> List[CodeUnit]:
+        """
+        The units relevant to a task described by `text` and to its `errors`, most relevant first:
+        those holding the lines of a traceback, defining a name mentioned in the text, then
+        referencing one.
+        """
+        selected: Dict[int, CodeUnit] = {}
+
+        def add(unit: Optional[CodeUnit]):
+            if unit is not None and unit.kind != "class":
+                selected.setdefault(unit.start, unit)
+
+        for line in _LINE_PATTERN.findall(errors or ""):
+            add(self.unit_at(int(line)))
+        words = {word.lower() for word in _WORD_PATTERN.findall(f"{text}\n{errors or ''}")}
+        mentioned = [name for name in list(self.symbols) + list(self.classes) if _mentioned(name, words)]
+        for word in mentioned:
+            for unit in self.symbols.get(word, []):
+                add(unit)
+            for unit in self.classes.get(word, []):
+                if unit.kind == "method":
+                    add(unit)
+        for word in mentioned:
+            for unit in self.references.get(word, []):
+                add(unit)
+        return list(selected.values())
+
+    def focus(self, text: str, errors: str = "", max_ratio: float = MAX_FOCUS_RATIO) -> Optional["FocusedView"]:
+        """A view of the code showing the units relevant to the task, None if the whole code should be sent."""
+        if not self.units:
+            return None
+        budget = max_ratio * len(self.lines)
+        regions, size = [], 0
+        for unit in self.select(text, errors):
+            if size + unit.size > budget:
+                continue
+            regions.append(unit)
+            size += unit.size
+        if not regions:
+            return None
+        regions.sort(key=lambda unit: unit.start)
+        return FocusedView(self, regions)
+
+
+class SpliceError(ValueError):
+    """An LLM answer whose regions can't be spliced into the code."""
+
+
+class FocusedView:
+    """An outline of the code with some regions in full, and the splicing of the edited regions back in."""
+
+    def __init__(self, index: SymbolIndex, regions: List[CodeUnit]):
+        self.code = index.code
+        self.lines = list(index.lines)
+        self.units = list(index.units)
+        self.regions = regions
+
+    @property
+    def region_lines(self) -> int:
+        return sum(region.size for region in self.regions)
+
+    def render(self) -> str:
+        number = {region.start: i + 1 for i, region in enumerate(self.regions)}
+        outline = [FOCUS_INSTRUCTIONS, ""]
+        line = 1
+        for unit in self.units:
+            # Comments and blank lines between units
+            outline += self.lines[line - 1 : unit.start - 1]
+            line = unit.end + 1
+            prefix = " " * unit.indent
+            if unit.start in number:
+                outline.append(
+                    f"{prefix}# (region {number[unit.start]}: {unit.kind} {unit.name}, lines {unit.start}-{unit.end},"
+                    " shown below)"
+                )
+            else:
+                outline += self._outline(unit)
+        outline += self.lines[line - 1 :]
+
+        regions = []
+        for i, region in enumerate(self.regions):
+            regions.append(f"# region {i + 1}: {region.kind} {region.name}, lines {region.start}-{region.end}")
+            regions += [self._dedent(text, region.indent) for text in self.lines[region.start - 1 : region.end]]
+            regions.append(f"# endregion {i + 1}")
+        return "\n".join(outline + [""] + regions)
+
+    def _outline(self, unit: CodeUnit) -> List[str]:
+        """The lines of a unit in the outline, with each run of hidden lines replaced by a marker."""
+        shown = set(unit.outline)
+        lines, hidden = [], []
+        for line in range(unit.start, unit.end + 2):
+            if line in shown or line > unit.end:
+                if hidden:
+                    text = next((self.lines[h - 1] for h in hidden if self.lines[h - 1].strip()), "")
+                    indent = text[: len(text) - len(text.lstrip())]
+                    lines.append(f"{indent}# ... lines {hidden[0]}-{hidden[-1]}")
+                    hidden = []
+                if line <= unit.end:
+                    lines.append(self.lines[line - 1])
+            else:
+                hidden.append(line)
+        return lines
+
+    @staticmethod
+    def _dedent(text: str, indent: int) -> str:
+        return text[indent:] if text[:indent].isspace() else text
+
+    @staticmethod
+    def _indent(text: str, indent: int) -> str:
+        return " " * indent + text if text.strip() else text
+
+    def splice(self, response: str) -> str:
+        """
+        The code with the regions of an LLM `response` in place of the original ones.
+        Raises SpliceError if the response has no regions, e.g. because it rewrote the whole program
+        from the outline, or if the code with its regions does not parse.
+        """
+        matches = _CODE_BLOCK_PATTERN.findall(response)
+        answer = matches[-1] if matches else response
+        edits = {name: body for name, body in _REGION_PATTERN.findall(answer + "\n")}
+        if not edits:
+            raise SpliceError("the answer has no regions, each region must start with its '# region N' line")
+
+        replacements = []
+        for i, region in enumerate(self.regions):
+            body = edits.get(str(i + 1))
+            if body is not None:
+                indented = [self._indent(text, region.indent) for text in body.rstrip("\n").splitlines()]
+                replacements.append((region.start - 1, region.end, indented))
+        if NEW_REGION in edits:
+            # New definitions go after the existing ones, before the code running the program
+            position = self._definitions_end()
+            replacements.append((position, position, ["", ""] + edits[NEW_REGION].rstrip("\n").splitlines()))
+        unknown = set(edits) - {str(i + 1) for i in range(len(self.regions))} - {NEW_REGION}
+        if unknown:
+            logger.warning(f"symbol index: ignored unknown regions {sorted(unknown)}")
+
+        lines = list(self.lines)
+        for start, end, replacement in sorted(replacements, key=lambda r: (r[0], r[1]), reverse=True):
+            lines[start:end] = replacement
+        code = "\n".join(lines) + ("\n" if self.code.endswith("\n") else "")
+        try:
+            ast.parse(code)
+        except (SyntaxError, ValueError) as e:
+            raise SpliceError(f"the code with the edited regions does not parse: {e}") from e
+        return code
+
+    def _definitions_end(self) -> int:
+        ends = [unit.end for unit in self.units if unit.kind != "statements" or unit.scope is not None]
+        return max(ends) if ends else len(self.lines)
@@ -0,0 +1,208 @@
+import os
+import threading
+from typing import Any, Callable, Dict, Optional
+
+"""
+Token and cost budgets of a session.
+
+The time Budget given to Agent.execute does not bound how many tokens a turn sends: large code and
+long error messages go into every prompt. A TokenAccount limits the prompt tokens, completion
+tokens and estimated cost of each turn and of the whole session. The GatewayLLM of a session checks
+it before every request and caps the completion length to what is left; the controller and the
+skills trim the context they send to fit, and give up with a message when it can't fit.
+
+Limits of 0 are unlimited. They are configured from the environment:
+    TURN_MAX_PROMPT_TOKENS, TURN_MAX_COMPLETION_TOKENS, TURN_MAX_COST
+    SESSION_MAX_PROMPT_TOKENS, SESSION_MAX_COMPLETION_TOKENS, SESSION_MAX_COST
+and the cost is estimated from LLM_PROMPT_PRICE_PER_1K and LLM_COMPLETION_PRICE_PER_1K.
+"""
+
+
+class TokenBudgetExceeded(Exception):
+    """Raised when a request does not fit in the remaining token or cost budget."""
+
+
+class TokenUsage:
+    def __init__(self, prompt_tokens: int = 0, completion_tokens: int = 0, cost: float = 0.0):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cost = cost
+
+    def add(self, prompt_tokens: int, completion_tokens: int, cost: float) -> None:
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cost += cost
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": round(self.cost, 6),
+        }
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> "TokenUsage":
+        return TokenUsage(data.get("prompt_tokens", 0), data.get("completion_tokens", 0), data.get("cost", 0.0))
+
+
+class TokenLimits:
+    def __init__(self, max_prompt_tokens: int = 0, max_completion_tokens: int = 0, max_cost: float = 0):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_completion_tokens = max_completion_tokens
+        self.max_cost = max_cost
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "max_completion_tokens": self.max_completion_tokens,
+            "max_cost": self.max_cost,
+        }
+
+    @staticmethod
+    def from_env(prefix: str) -> "TokenLimits":
+        return TokenLimits(
+            max_prompt_tokens=int(os.environ.get(f"{prefix}_MAX_PROMPT_TOKENS", 0)),
+            max_completion_tokens=int(os.environ.get(f"{prefix}_MAX_COMPLETION_TOKENS", 0)),
+            max_cost=float(os.environ.get(f"{prefix}_MAX_COST", 0)),
+        )
+
+
+class TokenAccount:
+    """The token usage of a session and of its current turn, checked against their limits."""
+
+    def __init__(
+        self,
+        turn_limits: Optional[TokenLimits] = None,
+        session_limits: Optional[TokenLimits] = None,
+        prompt_price_per_1k: float = 0,
+        completion_price_per_1k: float = 0,
+    ):
+        """
+        Initialize a new instance
+
+        Parameters:
+            turn_limits (TokenLimits): limits of each turn
+            session_limits (TokenLimits): limits of the whole session
+            prompt_price_per_1k (float): estimated cost of 1000 prompt tokens
+            completion_price_per_1k (float): estimated cost of 1000 completion tokens
+        """
+        self.turn_limits = turn_limits or TokenLimits()
+        self.session_limits = session_limits or TokenLimits()
+        self.prompt_price_per_1k = prompt_price_per_1k
+        self.completion_price_per_1k = completion_price_per_1k
+        self.turn = TokenUsage()
+        self.session = TokenUsage()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_env() -> "TokenAccount":
+        return TokenAccount(
+            turn_limits=TokenLimits.from_env("TURN"),
+            session_limits=TokenLimits.from_env("SESSION"),
+            prompt_price_per_1k=float(os.environ.get("LLM_PROMPT_PRICE_PER_1K", 0)),
+            completion_price_per_1k=float(os.environ.get("LLM_COMPLETION_PRICE_PER_1K", 0)),
+        )
+
+    def start_turn(self) -> None:
+        with self._lock:
+            self.turn = TokenUsage()
+
+    def cost(self, prompt_tokens: int, completion_tokens: int) -> float:
+        return (prompt_tokens * self.prompt_price_per_1k + completion_tokens * self.completion_price_per_1k) / 1000
+
+    def remaining_prompt_tokens(self) -> Optional[int]:
+        """Prompt tokens that can still be sent, None if unlimited."""
+        with self._lock:
+            return self._remaining(lambda u: u.prompt_tokens, lambda l: l.max_prompt_tokens, self.prompt_price_per_1k)
+
+    def remaining_completion_tokens(self, prompt_tokens: int = 0) -> Optional[int]:
+        """Completion tokens that can still be received after sending `prompt_tokens`, None if unlimited."""
+        with self._lock:
+            prompt_cost = self.cost(prompt_tokens, 0)
+            return self._remaining(
+                lambda u: u.completion_tokens,
+                lambda l: l.max_completion_tokens,
+                self.completion_price_per_1k,
+                prompt_cost,
+            )
+
+    def _remaining(self, used, limit, price_per_1k: float, pending_cost: float = 0.0) -> Optional[int]:
+        remaining = None
+        for usage, limits in ((self.turn, self.turn_limits), (self.session, self.session_limits)):
+            if limit(limits) > 0:
+                left = limit(limits) - used(usage)
+                remaining = left if remaining is None else min(remaining, left)
+            if limits.max_cost > 0 and price_per_1k > 0:
+                left = int((limits.max_cost - usage.cost - pending_cost) * 1000 / price_per_1k)
+                remaining = left if remaining is None else min(remaining, left)
+        return None if remaining is None else max(remaining, 0)
+
+    def check(self, prompt_tokens: int) -> Optional[int]:
+        """
+        Check that a request of `prompt_tokens` fits in the budget.
+
+        Returns:
+            the maximum number of completion tokens of the request, None if unlimited
+
+        Raises:
+            TokenBudgetExceeded: if the prompt does not fit, or no completion tokens are left
+        """
+        remaining_prompt = self.remaining_prompt_tokens()
+        if remaining_prompt is not None and prompt_tokens > remaining_prompt:
+            raise TokenBudgetExceeded(
+                f"the request needs {prompt_tokens} prompt tokens but only {remaining_prompt} are left in the budget"
+            )
+        remaining_completion = self.remaining_completion_tokens(prompt_tokens)
+        if remaining_completion is not None and remaining_completion <= 0:
+            raise TokenBudgetExceeded("no completion tokens are left in the budget")
+        return remaining_completion
+
+    def record(self, prompt_tokens: int, completion_tokens: int) -> None:
+        cost = self.cost(prompt_tokens, completion_tokens)
+        with self._lock:
+            self.turn.add(prompt_tokens, completion_tokens, cost)
+            self.session.add(prompt_tokens, completion_tokens, cost)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Usage and limits of the current turn and of the session."""
+        with self._lock:
+            return {
+                "turn": self.turn.to_dict() | {"limits": self.turn_limits.to_dict()},
+                "session": self.session.to_dict() | {"limits": self.session_limits.to_dict()},
+            }
+
+
+def truncate_to_tokens(
+    text: str, max_tokens: int, keep_end: bool = False, count_tokens: Optional[Callable[[str], int]] = None
+) -> str:
+    """
+    Shorten `text` to at most `max_tokens` tokens, as counted by `count_tokens`, or to about `max_tokens`
+    tokens estimated at 4 characters per token. Keeps the beginning of the text, or its end for output
+    such as tracebacks.
+    """
+    marker = "\n[...truncated...]\n"
+
+    def keep(chars: int) -> str:
+        if keep_end:
+            return marker + text[len(text) - chars:]
+        return text[:chars] + marker
+
+    if count_tokens is None:
+        max_chars = max(max_tokens, 0) * 4
+        if len(text) <= max_chars:
+            return text
+        if max_chars <= len(marker):
+            return ""
+        return keep(max_chars - len(marker))
+
+    if count_tokens(text) <= max_tokens:
+        return text
+    # The longest part of the text that fits, found in as many counts as the text has bits of length
+    low, high = 0, len(text) - 1
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(keep(middle)) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return keep(low) if low > 0 else ""
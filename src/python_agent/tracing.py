@@ -0,0 +1,224 @@
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import uuid
+from logging.handlers import RotatingFileHandler
+from typing import Any, Dict, Iterator, List, Optional
+
+from python_agent.events import AgentEvents, Event
+
+"""
+Span traces of AgentApp turns.
+
+TurnTracer turns the events of an AgentApp into one span tree per turn:
+    turn > plan > llm
+         > chain > skill > llm
+                         > sandbox
+and appends it as one JSON line to a rotating file. Each span has a `name`, a `start` timestamp,
+a `duration` in seconds, an `error` flag, its `attributes` (chain, skill, token counts, output sizes)
+and its `children`.
+
+Tracing is off unless TRACE_PATH is set. A rotating file must be written by one process only:
+when the app runs with several worker processes, `{pid}` in TRACE_PATH is replaced by the process
+id, so that each process writes its own file. The traces can be summarized offline with:
+    python -m python_agent.tracing summary traces-*.jsonl
+    python -m python_agent.tracing show traces-*.jsonl <trace_id>
+"""
+
+# Events opening and closing a span, with the name of the span
+OPENING_EVENTS = {"turn_started": "turn", "plan_started": "plan", "chain_started": "chain", "skill_started": "skill"}
+CLOSING_EVENTS = {"turn_finished": "turn", "plan_finished": "plan", "chain_finished": "chain", "skill_finished": "skill"}
+# Events recorded as a complete span, their start is derived from their duration
+LEAF_EVENTS = {"llm_request": "llm", "sandbox_exited": "sandbox"}
+
+IGNORED_FIELDS = {"kind", "timestamp", "duration", "is_error", "chain", "skill", "message"}
+
+
+class JsonlTraceWriter:
+    """Appends traces as JSON lines to a file that is rotated when it gets too large."""
+
+    def __init__(self, path: str, max_bytes: int = 10_000_000, backup_count: int = 5):
+        self._logger = logging.getLogger(f"python_agent.tracing.{os.path.abspath(path)}")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+
+    def __call__(self, trace: Dict[str, Any]) -> None:
+        self._logger.info(json.dumps(trace, default=str))
+
+    @staticmethod
+    def from_env() -> Optional["JsonlTraceWriter"]:
+        """
+        Writer configured from TRACE_PATH, TRACE_MAX_BYTES and TRACE_BACKUP_COUNT, with `{pid}` in TRACE_PATH
+        replaced by the process id. None if TRACE_PATH is empty or not set.
+        """
+        path = os.environ.get("TRACE_PATH", "")
+        if not path:
+            return None
+        return JsonlTraceWriter(
+            path.replace("{pid}", str(os.getpid())),
+            max_bytes=int(os.environ.get("TRACE_MAX_BYTES", 10_000_000)),
+            backup_count=int(os.environ.get("TRACE_BACKUP_COUNT", 5)),
+        )
+
+
+class TurnTracer:
+    """Builds the span tree of each turn of an AgentApp from its events."""
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._stack: List[Dict[str, Any]] = []
+
+    def observe(self, events: AgentEvents) -> None:
+        events.subscribe(self.record)
+
+    def record(self, event: Event) -> None:
+        kind = event["kind"]
+        if kind == "turn_started":
+            self._stack = [self._span("turn", event, event["timestamp"])]
+            self._stack[0]["trace_id"] = uuid.uuid4().hex
+            self._stack[0]["attributes"]["message_size"] = len(event.get("message") or "")
+        elif not self._stack:
+            # The tracer started observing in the middle of a turn
+            return
+        elif kind in OPENING_EVENTS:
+            span = self._span(OPENING_EVENTS[kind], event, event["timestamp"])
+            self._stack[-1]["children"].append(span)
+            self._stack.append(span)
+        elif kind in CLOSING_EVENTS:
+            name = CLOSING_EVENTS[kind]
+            if all(span["name"] != name for span in self._stack):
+                return
+            # Spans left open by a failure are closed with the span enclosing them, as errors
+            while self._stack[-1]["name"] != name:
+                self._close_unfinished(self._stack.pop(), event["timestamp"])
+            span = self._stack.pop()
+            self._close(span, event)
+            if kind == "turn_finished":
+                self._write(span)
+        elif kind in LEAF_EVENTS:
+            span = self._span(LEAF_EVENTS[kind], event, event["timestamp"] - event.get("duration", 0))
+            self._close(span, event)
+            self._stack[-1]["children"].append(span)
+
+    @staticmethod
+    def _span(name: str, event: Event, start: float) -> Dict[str, Any]:
+        attributes = {k: v for k, v in event.items() if k not in IGNORED_FIELDS}
+        for key in ("chain", "skill"):
+            if event.get(key) is not None:
+                attributes[key] = event[key]
+        return {"name": name, "start": start, "duration": None, "error": False, "attributes": attributes, "children": []}
+
+    @staticmethod
+    def _close(span: Dict[str, Any], event: Event) -> None:
+        span["duration"] = event.get("duration", event["timestamp"] - span["start"])
+        span["attributes"].update({k: v for k, v in event.items() if k not in IGNORED_FIELDS})
+        error = event.get("is_error", False) or event.get("returncode") not in (None, 0)
+        span["error"] = bool(error) or any(child["error"] for child in span["children"])
+
+    @staticmethod
+    def _close_unfinished(span: Dict[str, Any], timestamp: float) -> None:
+        span["duration"] = timestamp - span["start"]
+        span["attributes"]["unfinished"] = True
+        span["error"] = True
+
+    def _write(self, trace: Dict[str, Any]) -> None:
+        self._stack = []
+        try:
+            self._writer(trace)
+        except Exception:
+            logging.getLogger("council").exception("failed to write trace")
+
+
+def read_traces(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def walk(span: Dict[str, Any], depth: int = 0) -> Iterator[tuple]:
+    yield depth, span
+    for child in span["children"]:
+        yield from walk(child, depth + 1)
+
+
+def span_label(span: Dict[str, Any]) -> str:
+    attributes = span["attributes"]
+    if span["name"] == "chain":
+        return f"chain {attributes.get('chain', '')}"
+    if span["name"] in ("skill", "llm"):
+        return f"{span['name']} {attributes.get('skill') or attributes.get('chain') or 'controller'}"
+    return span["name"]
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def summary(traces: List[Dict[str, Any]], slowest: int) -> None:
+    durations: Dict[str, List[float]] = {}
+    for trace in traces:
+        for _, span in walk(trace):
+            if span["duration"] is not None:
+                durations.setdefault(span_label(span), []).append(span["duration"])
+
+    print(f"{len(traces)} turns")
+    print(f"{'span':50} {'count':>6} {'p50':>8} {'p95':>8} {'max':>8} {'total':>9}")
+    for label, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        print(
+            f"{label:50} {len(values):6} {statistics.median(values):8.2f} {percentile(values, 0.95):8.2f} "
+            f"{max(values):8.2f} {sum(values):9.2f}"
+        )
+
+    print("\nslowest turns")
+    for trace in sorted(traces, key=lambda t: -(t["duration"] or 0))[:slowest]:
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trace["start"]))
+        chains = ", ".join(c["attributes"].get("chain", "") for c in trace["children"] if c["name"] == "chain")
+        flag = " ERROR" if trace["error"] else ""
+        print(f"{trace['trace_id']} {started} {trace['duration']:8.2f}s {chains}{flag}")
+
+
+def show(trace: Dict[str, Any]) -> None:
+    for depth, span in walk(trace):
+        offset = span["start"] - trace["start"]
+        duration = span["duration"] if span["duration"] is not None else float("nan")
+        details = " ".join(
+            f"{k}={v}" for k, v in span["attributes"].items() if k not in ("chain", "skill")
+        )
+        flag = " ERROR" if span["error"] else ""
+        print(f"{'  ' * depth}{span_label(span):40} +{offset:7.2f}s {duration:7.2f}s {details}{flag}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Summarize AgentApp turn traces.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="time spent per span and the slowest turns")
+    summary_parser.add_argument("paths", nargs="+")
+    summary_parser.add_argument("--slowest", type=int, default=10)
+    show_parser = subparsers.add_parser("show", help="the span tree of one turn")
+    show_parser.add_argument("paths", nargs="+")
+    show_parser.add_argument("trace_id")
+    args = parser.parse_args(argv)
+
+    traces = [trace for path in args.paths for trace in read_traces(path)]
+    if args.command == "summary":
+        summary(traces, args.slowest)
+    else:
+        trace = next((t for t in traces if t["trace_id"].startswith(args.trace_id)), None)
+        if trace is None:
+            sys.exit(f"trace {args.trace_id} not found")
+        show(trace)
+
+
+if __name__ == "__main__":
+    main()
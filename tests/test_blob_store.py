@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from python_agent.blob_store import BLOB_KEY, BlobStore, blob_id, is_blob_ref
+
+CODE = "print('hello')\n" * 100
+
+
+def test_large_strings_are_stored_once():
+    store = BlobStore()
+    used = set()
+    value = {"code": CODE, "history": [{"code": CODE}, {"code": "x = 1"}], "stdout": ("hello\n" * 200,)}
+    encoded = store.encode(value, used)
+    assert encoded["code"] == {BLOB_KEY: blob_id(CODE)}
+    assert encoded["history"] == [{"code": {BLOB_KEY: blob_id(CODE)}}, {"code": "x = 1"}]
+    assert len(used) == 2
+    assert store.blobs(used)[blob_id(CODE)] == CODE
+
+
+def test_round_trip_through_json():
+    store = BlobStore()
+    used = set()
+    value = {"code": CODE, "messages": [CODE, "short", None, 3]}
+    saved = json.loads(json.dumps({"value": store.encode(value, used), "blobs": store.blobs(used)}))
+
+    restored = BlobStore()
+    decoded = restored.decode(saved["value"], saved["blobs"])
+    assert decoded == value
+    # The copies of the same content are one string again
+    assert decoded["code"] is decoded["messages"][0]
+    assert len(restored) == 1
+
+
+def test_small_strings_stay_inline():
+    store = BlobStore(min_size=10)
+    used = set()
+    assert store.encode({"a": "short"}, used) == {"a": "short"}
+    assert used == set()
+
+
+def test_missing_blobs_are_reported():
+    with pytest.raises(KeyError, match="missing blob"):
+        BlobStore().decode({BLOB_KEY: "0" * 32})
+
+
+def test_intern_shares_equal_strings():
+    store = BlobStore()
+    first = store.intern({"code": "".join(CODE)})
+    second = store.intern(["".join(CODE)])
+    assert first["code"] is second[0]
+
+
+def test_blob_refs_are_single_key_dicts():
+    assert is_blob_ref({BLOB_KEY: "abc"})
+    assert not is_blob_ref({BLOB_KEY: "abc", "other": 1})
+    assert not is_blob_ref("abc")
@@ -0,0 +1,88 @@
+import threading
+import time
+
+from python_agent.code_analysis import AnalysisScheduler, CodeAnalyzer
+from python_agent.symbol_index import SymbolIndex
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_the_task_runs_once_the_key_is_quiet():
+    scheduler = AnalysisScheduler(delay=0.1)
+    ran = []
+    start = time.monotonic()
+    scheduler.submit("session", lambda: ran.append(time.monotonic() - start))
+    wait_for(lambda: ran)
+    assert ran[0] >= 0.1
+
+
+def test_a_task_submitted_again_replaces_the_waiting_one():
+    scheduler = AnalysisScheduler(delay=0.1)
+    ran = []
+    for i in range(5):
+        scheduler.submit("session", lambda i=i: ran.append(i))
+        time.sleep(0.02)
+    wait_for(lambda: ran)
+    time.sleep(0.15)
+    assert ran == [4]
+
+
+def test_keys_are_debounced_separately():
+    scheduler = AnalysisScheduler(delay=0.05)
+    ran = []
+    scheduler.submit("a", lambda: ran.append("a"))
+    scheduler.submit("b", lambda: ran.append("b"))
+    wait_for(lambda: len(ran) == 2)
+    assert sorted(ran) == ["a", "b"]
+
+
+def test_a_key_runs_one_task_at_a_time():
+    scheduler = AnalysisScheduler(delay=0, workers=2)
+    release = threading.Event()
+    ran = []
+    scheduler.submit("session", lambda: (ran.append(1), release.wait(5)))
+    wait_for(lambda: ran)
+    scheduler.submit("session", lambda: ran.append(2))
+    time.sleep(0.05)
+    assert ran == [1]
+    release.set()
+    wait_for(lambda: ran == [1, 2])
+
+
+def test_a_failing_task_does_not_stop_the_worker():
+    scheduler = AnalysisScheduler(delay=0, workers=1)
+    ran = []
+    scheduler.submit("a", lambda: 1 / 0)
+    scheduler.submit("b", lambda: ran.append("b"))
+    wait_for(lambda: ran == ["b"])
+
+
+def test_the_diagnostics_of_the_code_analysed_last_are_kept():
+    analyzer = CodeAnalyzer(SymbolIndex(), None, scheduler=AnalysisScheduler(delay=0))
+    code = "print(x)\n"
+    analyzer.submit(code)
+    wait_for(lambda: analyzer.diagnostics(code) is not None)
+    assert analyzer.diagnostics(code)[0].endswith("NameError: name 'x' is not defined")
+    assert analyzer.diagnostics("print(1)\n") is None
+
+
+def test_superseded_code_is_not_analysed():
+    scheduler = AnalysisScheduler(delay=0.05)
+    analyzer = CodeAnalyzer(SymbolIndex(), None, scheduler=scheduler)
+    analyzer.submit("print(x)\n")
+    analyzer.submit("print(1)\n")
+    wait_for(lambda: analyzer.diagnostics("print(1)\n") == [])
+    assert analyzer.diagnostics("print(x)\n") is None
+
+
+def test_no_code_is_not_analysed():
+    scheduler = AnalysisScheduler(delay=0)
+    analyzer = CodeAnalyzer(SymbolIndex(), None, scheduler=scheduler)
+    analyzer.submit(None)
+    analyzer.submit("")
+    assert scheduler._pending == {}
@@ -0,0 +1,129 @@
+import pytest
+
+from python_agent.code_document import CodeDocument, RevisionConflict, apply_patch, checksum, make_patch
+
+
+@pytest.mark.parametrize(
+    "old, new",
+    [
+        ("a\nb\nc\n", "a\nB\nc\n"),
+        ("a\nb\nc\n", "a\nc\n"),
+        ("a\nc\n", "a\nb1\nb2\nc\n"),
+        ("", "print(1)\n"),
+        ("print(1)\n", ""),
+        ("x = 1\r\ny = 2\n", "x = 1\r\ny = 3\n"),
+        ("same\n", "same\n"),
+    ],
+)
+def test_patches_turn_the_old_text_into_the_new_one(old, new):
+    assert apply_patch(old, make_patch(old, new)) == new
+
+
+def test_the_patch_covers_the_changed_lines_only():
+    assert make_patch("a\nb\nc\nd", "a\nx\ny\nd") == {"start": 1, "end": 3, "lines": ["x", "y"]}
+
+
+def test_patches_outside_of_the_document_conflict():
+    with pytest.raises(RevisionConflict):
+        apply_patch("a\nb", {"start": 1, "end": 5, "lines": []})
+
+
+def test_checksum_is_fnv1a_of_the_utf8_text():
+    # Same values as `checksum` in app.js
+    assert checksum("") == "811c9dc5"
+    assert checksum("a") == "e40c292c"
+    assert checksum("é") != checksum("e")
+
+
+def test_changes_create_revisions():
+    document = CodeDocument("a\n")
+    assert document.commit("a\n") == 0
+    assert document.commit("b\n") == 1
+    assert document.commit(None) == 2
+    assert document.text == ""
+
+
+def test_patches_apply_to_the_current_revision():
+    document = CodeDocument("a\nb\n")
+    text = "a\nB\n"
+    assert document.apply(0, make_patch(document.text, text), checksum(text)) == 1
+    assert document.text == text
+    assert document.apply(1, None) == 1
+
+
+def test_patches_against_an_old_revision_conflict():
+    document = CodeDocument("a\n")
+    document.commit("b\n")
+    with pytest.raises(RevisionConflict, match="based on revision 0"):
+        document.apply(0, make_patch("a\n", "c\n"))
+    assert document.text == "b\n"
+
+
+def test_a_checksum_mismatch_conflicts_and_keeps_the_document():
+    document = CodeDocument("a\n")
+    with pytest.raises(RevisionConflict, match="checksum"):
+        document.apply(0, make_patch("a\n", "b\n"), checksum("c\n"))
+    assert (document.revision, document.text) == (0, "a\n")
+
+
+def test_diffs_from_known_revisions():
+    document = CodeDocument("a\n", history_size=2)
+    document.commit("b\n")
+    document.commit("c\n")
+    assert apply_patch("b\n", document.diff_from(1)) == "c\n"
+    assert document.diff_from(0) is None
+
+
+def test_round_trip():
+    document = CodeDocument("a\n")
+    document.commit("b\n")
+    restored = CodeDocument.from_dict(document.to_dict())
+    assert (restored.revision, restored.text) == (1, "b\n")
+    assert apply_patch("a\n", restored.diff_from(0)) == "b\n"
+
+
+class DocumentApp:
+    """Stands in for an AgentApp in the /post_code endpoint: a document."""
+
+    def __init__(self):
+        self.document = CodeDocument("a\nb\n")
+
+    def update_code(self, base_revision, patch, checksum=None):
+        return self.document.apply(base_revision, patch, checksum)
+
+    def analyze_code(self):
+        pass
+
+    def snapshot(self):
+        return {"document": self.document.to_dict(), "blobs": {}}
+
+    def restore(self, snapshot):
+        self.document = CodeDocument.from_dict(snapshot["document"])
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    import app
+
+    from python_agent.session_store import SessionManager, SQLiteSessionStore
+
+    sessions = SessionManager(store=SQLiteSessionStore(str(tmp_path / "sessions.db")), factory=DocumentApp)
+    monkeypatch.setattr(app, "sessions", sessions)
+    return app.app.test_client()
+
+
+def test_post_code_answers_a_stale_patch_with_409_and_the_document(client):
+    headers = {"X-Session-Id": "editor"}
+    patch = make_patch("a\nb\n", "a\nB\n")
+    response = client.post("/post_code", json={"base_revision": 0, "patch": patch}, headers=headers)
+    assert (response.status_code, response.json) == (200, {"revision": 1})
+
+    response = client.post("/post_code", json={"base_revision": 0, "patch": patch}, headers=headers)
+    assert response.status_code == 409
+    assert (response.json["revision"], response.json["code"]) == (1, "a\nB\n")
+
+    bad = {"base_revision": 1, "patch": make_patch("a\nB\n", "c\n"), "checksum": checksum("d\n")}
+    response = client.post("/post_code", json=bad, headers=headers)
+    assert response.status_code == 409
+    assert response.json["code"] == "a\nB\n"
@@ -0,0 +1,119 @@
+import threading
+
+import pytest
+
+from python_agent.jobs import JobQueue, JobQueueFull
+
+
+def blocking(release: threading.Event, started: threading.Event = None):
+    def run(job):
+        if started is not None:
+            started.set()
+        release.wait(5)
+        return {"job": job.id}, 200
+
+    return run
+
+
+def wait_done(*jobs):
+    for job in jobs:
+        after, done = 0, False
+        while not done:
+            events, done = job.wait_for_events(after, timeout=5)
+            assert events or done
+            after += len(events)
+
+
+def test_submissions_beyond_the_capacity_are_rejected():
+    release = threading.Event()
+    jobs = JobQueue(max_workers=1, max_queued=1)
+    first = jobs.submit("a", blocking(release))
+    second = jobs.submit("b", blocking(release))
+    with pytest.raises(JobQueueFull):
+        jobs.submit("c", blocking(release))
+    release.set()
+    wait_done(first, second)
+    assert jobs.pending == 0
+    assert first.result == ({"job": first.id}, 200)
+    assert jobs.get(second.id) is second
+
+
+def test_jobs_of_a_session_wait_without_a_worker():
+    release_a, release_b, started_b = threading.Event(), threading.Event(), threading.Event()
+    jobs = JobQueue(max_workers=2, max_queued=4)
+    a1 = jobs.submit("a", blocking(release_a))
+    a2 = jobs.submit("a", blocking(release_a))
+    b1 = jobs.submit("b", blocking(release_b, started_b))
+    # The second job of session a doesn't take the worker session b needs
+    assert started_b.wait(5)
+    assert a2.status == "queued"
+    release_a.set()
+    release_b.set()
+    wait_done(a1, a2, b1)
+    assert a1.finished_at <= a2.finished_at
+
+
+def test_jobs_of_a_session_run_in_order_one_at_a_time():
+    jobs = JobQueue(max_workers=4, max_queued=16)
+    running, order, overlaps = [], [], []
+    lock = threading.Lock()
+
+    def run(job):
+        with lock:
+            running.append(job)
+            overlaps.append(len(running))
+        order.append(job.id)
+        with lock:
+            running.remove(job)
+        return {}, 200
+
+    submitted = [jobs.submit("a", run) for _ in range(10)]
+    wait_done(*submitted)
+    assert order == [job.id for job in submitted]
+    assert overlaps == [1] * 10
+    assert jobs.pending == 0
+
+
+def test_cancel_drops_the_queued_jobs_of_the_session():
+    release, started = threading.Event(), threading.Event()
+    jobs = JobQueue(max_workers=1, max_queued=4)
+    running = jobs.submit("a", blocking(release, started))
+    assert started.wait(5)
+    queued = [jobs.submit("a", blocking(release)) for _ in range(2)]
+    other = jobs.submit("b", blocking(release))
+    assert jobs.cancel("a") == 2
+    for job in queued:
+        assert job.status == "cancelled"
+        assert job.result == ({"error": "the job was cancelled"}, 409)
+    release.set()
+    wait_done(running, other)
+    assert running.status == "done"
+    assert other.status == "done"
+    assert jobs.pending == 0
+
+
+def test_failed_jobs_report_the_error():
+    jobs = JobQueue(max_workers=1, max_queued=1)
+
+    def fail(job):
+        raise ValueError("boom")
+
+    job = jobs.submit("a", fail)
+    wait_done(job)
+    assert job.status == "failed"
+    assert job.result == ({"error": "boom"}, 500)
+
+
+def test_events_are_delivered_after_the_last_one_received():
+    jobs = JobQueue(max_workers=1, max_queued=1)
+
+    def run(job):
+        for i in range(3):
+            job.add_event({"kind": "step", "i": i})
+        return {}, 200
+
+    job = jobs.submit("a", run)
+    wait_done(job)
+    events, done = job.wait_for_events(1, timeout=1)
+    assert done
+    assert [event_id for event_id, _ in events] == [2, 3]
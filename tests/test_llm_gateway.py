@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+from council.llm import LLMMessage, LLMResult
+from council.runners import Consumption
+
+from python_agent.cancellation import TurnCancellation, TurnCancelled
+from python_agent.llm_gateway import LLMGateway, Priority
+
+
+class BlockingLLM:
+    """Answers each request with its prompt once `release` is set, and records the prompts it got."""
+
+    def __init__(self):
+        self.prompts = []
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def post_chat_request(self, messages, **kwargs):
+        with self._lock:
+            self.prompts.append(messages[0].content)
+        assert self.release.wait(5)
+        return LLMResult(choices=[messages[0].content], consumptions=[Consumption(10, "token", "total")])
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def start(gateway, llm, prompt, results, **kwargs):
+    def send():
+        try:
+            results[prompt] = gateway.post_chat_request(llm, [LLMMessage.user_message(prompt)], **kwargs)
+        except Exception as e:
+            results[prompt] = e
+
+    thread = threading.Thread(target=send, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_interactive_requests_are_admitted_before_bulk_ones():
+    gateway, llm, results = LLMGateway(max_in_flight=1), BlockingLLM(), {}
+    threads = [start(gateway, llm, "first", results)]
+    wait_for(lambda: llm.prompts == ["first"])
+    threads.append(start(gateway, llm, "bulk", results, priority=Priority.BULK))
+    wait_for(lambda: len(gateway._waiting) == 1)
+    threads.append(start(gateway, llm, "interactive", results, priority=Priority.INTERACTIVE))
+    wait_for(lambda: len(gateway._waiting) == 2)
+
+    llm.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert llm.prompts == ["first", "interactive", "bulk"]
+
+
+def test_identical_requests_are_sent_once():
+    gateway, llm, results = LLMGateway(), BlockingLLM(), {}
+    first = start(gateway, llm, "same", results)
+    wait_for(lambda: llm.prompts)
+    second_result = {}
+    second = start(gateway, llm, "same", second_result)
+    wait_for(lambda: gateway.coalesced == 1)
+
+    llm.release.set()
+    first.join(5)
+    second.join(5)
+    assert llm.prompts == ["same"]
+    assert results["same"] is second_result["same"]
+    assert gateway._pending == {}
+
+
+def test_a_cancelled_request_stops_waiting_for_admission():
+    gateway, llm, results = LLMGateway(max_in_flight=1), BlockingLLM(), {}
+    start(gateway, llm, "first", results)
+    wait_for(lambda: llm.prompts)
+    cancellation = TurnCancellation()
+    cancellation.start_turn()
+    waiting = start(gateway, llm, "waiting", results, cancellation=cancellation)
+    wait_for(lambda: len(gateway._waiting) == 1)
+
+    cancellation.cancel()
+    waiting.join(5)
+    assert isinstance(results["waiting"], TurnCancelled)
+    assert gateway._waiting == []
+    assert "waiting" not in gateway._pending
+    llm.release.set()
+    assert llm.prompts == ["first"]
+
+
+def test_an_abandoned_request_keeps_its_slot_and_reports_its_result():
+    gateway, llm, results = LLMGateway(max_in_flight=1), BlockingLLM(), {}
+    cancellation = TurnCancellation()
+    cancellation.start_turn()
+    abandoned = []
+    sender = start(
+        gateway, llm, "abandoned", results, cancellation=cancellation, on_abandoned=abandoned.append
+    )
+    wait_for(lambda: llm.prompts)
+
+    cancellation.cancel()
+    sender.join(5)
+    assert isinstance(results["abandoned"], TurnCancelled)
+    assert gateway._in_flight == 1
+
+    llm.release.set()
+    wait_for(lambda: abandoned)
+    assert abandoned[0].first_choice == "abandoned"
+    wait_for(lambda: gateway._in_flight == 0)
+
+
+def test_requests_over_the_tokens_per_minute_wait():
+    gateway = LLMGateway(tokens_per_minute=100)
+    llm = BlockingLLM()
+    llm.release.set()
+    gateway.post_chat_request(llm, [LLMMessage.user_message("a")], prompt_tokens=80)
+    assert gateway._rate_limit_delay(10) == 0
+    assert gateway._rate_limit_delay(100) == pytest.approx(60, abs=1)
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+from council.chains import Chain
+from council.contexts import ChatMessage
+from council.runners import Budget
+
+from python_agent.plan import PlanStep, final_steps
+
+
+def step(name, previous=None, data=None):
+    chain = Chain(name=name, description=name, runners=[])
+    return PlanStep(chain, Budget(10), f"{name} it", data or {}, name=name, previous=previous)
+
+
+def run(step, message):
+    """Record `message` as the last message of the chain of `step`, as the agent runner does."""
+    context = SimpleNamespace(chainHistory={step.name: [SimpleNamespace(messages=[message])]})
+    step.record(context)
+
+
+def test_the_first_step_starts_from_the_controller_state():
+    first = step("generate", data={"code": "print(1)"})
+    assert first.runnable
+    assert first.initial_state.message == "generate it"
+    assert first.initial_state.data == {"code": "print(1)"}
+
+
+def test_each_step_starts_from_the_result_of_the_previous_one():
+    first = step("generate", data={"code": ""})
+    second = step("run", previous=first)
+    assert not second.runnable
+
+    run(first, ChatMessage.skill("generated", data={"code": "print(2)"}))
+    assert second.runnable
+    assert second.initial_state.message == "run it"
+    assert second.initial_state.data == {"code": "print(2)"}
+
+
+def test_steps_after_a_failure_are_skipped():
+    first = step("generate")
+    second = step("run", previous=first)
+    run(first, ChatMessage.skill("failed", data={}, is_error=True))
+    assert not second.runnable
+
+
+def test_steps_that_did_not_run_record_nothing():
+    first = step("generate")
+    first.record(SimpleNamespace(chainHistory={}))
+    assert first.result is None
+
+
+def test_the_outcome_of_a_plan_is_its_last_step_that_ran():
+    first = step("generate")
+    second = step("run", previous=first)
+    third = step("fix", previous=second)
+    run(first, ChatMessage.skill("generated", data={}))
+    run(second, ChatMessage.skill("failed", data={}, is_error=True))
+    assert final_steps([first, second, third]) == [second]
+
+
+def test_each_plan_has_its_own_outcome():
+    a1, b1 = step("generate"), step("general")
+    a2 = step("run", previous=a1)
+    run(a1, ChatMessage.skill("generated", data={}))
+    run(a2, ChatMessage.skill("ran", data={}))
+    run(b1, ChatMessage.skill("answered", data={}))
+    assert final_steps([a1, a2, b1]) == [a2, b1]
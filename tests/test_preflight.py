@@ -0,0 +1,79 @@
+import ast
+
+import pytest
+
+from python_agent.preflight import check_imports, preflight_check
+
+AVAILABLE = frozenset({"math", "os", "sys"})
+
+
+def missing_modules(code: str):
+    return [message.split("'")[1] for _, _, message in check_imports(ast.parse(code), AVAILABLE)]
+
+
+def test_reports_modules_not_installed():
+    assert missing_modules("import math\nimport numpy as np\nfrom pygame.locals import K_UP\n") == ["numpy", "pygame"]
+
+
+def test_relative_imports_are_not_checked():
+    assert missing_modules("from . import helpers\nfrom .models import Cat\n") == []
+
+
+@pytest.mark.parametrize(
+    "handler",
+    [
+        "except ImportError:",
+        "except ModuleNotFoundError:",
+        "except (ValueError, ImportError):",
+        "except:",
+        "except Exception:",
+        "except (ImportError, Exception) as e:",
+        "except BaseException:",
+    ],
+)
+def test_guarded_imports_are_not_reported(handler):
+    code = f"try:\n    import numpy\n    from scipy import signal\n{handler}\n    numpy = None\n"
+    assert missing_modules(code) == []
+
+
+def test_imports_guarded_by_other_handlers_are_reported():
+    code = "try:\n    import numpy\nexcept ValueError:\n    pass\n"
+    assert missing_modules(code) == ["numpy"]
+
+
+def test_only_the_try_body_is_guarded():
+    code = "try:\n    import math\nexcept ImportError:\n    import numpy\n"
+    assert missing_modules(code) == ["numpy"]
+
+
+def test_diagnostics_are_in_source_order():
+    code = "print(y)\nname = input()\nprint(x)\n"
+    diagnostics = preflight_check(code)
+    assert [d.splitlines()[0] for d in diagnostics] == [
+        'File "<string>", line 1, column 7',
+        'File "<string>", line 2, column 8',
+        'File "<string>", line 3, column 7',
+    ]
+    assert diagnostics[0].endswith("NameError: name 'y' is not defined")
+    assert "call to 'input()' is not allowed" in diagnostics[1]
+
+
+def test_names_bound_anywhere_are_defined():
+    code = (
+        "def area(r):\n    return math.pi * r ** 2\n\n"
+        "import math\n"
+        "for i in range(3):\n    print(area(i), __name__)\n"
+        "try:\n    pass\nexcept ValueError as error:\n    print(error)\n"
+    )
+    assert preflight_check(code) == []
+
+
+def test_star_imports_disable_the_name_check():
+    assert preflight_check("from math import *\nprint(pi)\n") == []
+
+
+def test_syntax_errors_are_reported_alone():
+    diagnostics = preflight_check("def f(:\n    print(x)\n")
+    assert len(diagnostics) == 1
+    assert diagnostics[0].startswith('File "<string>", line 1')
+    assert "SyntaxError" in diagnostics[0]
@@ -0,0 +1,131 @@
+import io
+import json
+
+import pytest
+from council.contexts import ChatMessageKind
+
+from python_agent.blob_store import BLOB_KEY, BlobStore, blob_id
+from python_agent.session_archive import (
+    ArchiveDirectory,
+    ArchiveError,
+    ArchiveTooLarge,
+    LazyChatMessage,
+    SessionArchive,
+    write_archive,
+)
+
+CODE = "\n".join(f"print({i})" for i in range(300)) + "\n"
+
+
+def snapshot():
+    return {
+        "chat_history": [
+            {"kind": "USER", "message": "print numbers", "source": None, "is_error": False, "data": None},
+            {"kind": "AGENT", "message": "done", "source": "agent", "is_error": False, "data": {"code": CODE}},
+        ],
+        "controller_state": {"code": CODE},
+        "state_history": [{"code": CODE}],
+        "document": {"revision": 1, "history": [[1, CODE]]},
+        "token_usage": {"prompt_tokens": 10},
+    }
+
+
+def write(tmp_path, records=None, name="session.jsonl"):
+    path = tmp_path / name
+    with open(path, "wb") as f:
+        write_archive(snapshot(), f)
+    if records is not None:
+        lines = path.read_bytes().splitlines(keepends=True)
+        body = b"".join(json.dumps(record).encode() + b"\n" for record in records)
+        path.write_bytes(lines[0] + body + lines[-1])
+    return str(path)
+
+
+def test_the_code_is_stored_once(tmp_path):
+    path = write(tmp_path)
+    with open(path) as f:
+        assert f.read().count("print(299)") == 1
+    assert SessionArchive(path).snapshot() == snapshot()
+
+
+def test_records_reference_their_blobs(tmp_path):
+    archive = SessionArchive(write(tmp_path))
+    messages = [record for record in archive.records() if record["type"] == "message"]
+    assert messages[1]["data"] == {"code": {BLOB_KEY: blob_id(CODE)}}
+
+
+def test_blobs_are_read_when_the_data_is_used(tmp_path):
+    archive = SessionArchive(write(tmp_path))
+    record = [record for record in archive.records() if record["type"] == "message"][1]
+    message = LazyChatMessage(
+        record["message"], ChatMessageKind.Agent, archive, record["data"], record["source"], record["is_error"]
+    )
+    assert archive._blobs == {}
+    assert message.data == {"code": CODE}
+    assert list(archive._blobs) == [blob_id(CODE)]
+
+
+def test_unread_messages_are_saved_with_their_blobs(tmp_path):
+    path = write(tmp_path)
+    archive = SessionArchive(path)
+    record = [record for record in archive.records() if record["type"] == "message"][1]
+    message = LazyChatMessage(
+        record["message"], ChatMessageKind.Agent, archive, record["data"], record["source"], record["is_error"]
+    )
+    blobs, used = BlobStore(), set()
+    assert message.encoded(blobs, used) == record["data"]
+    assert used == {blob_id(CODE)}
+    assert blobs.get(blob_id(CODE)) == CODE
+
+    # Once saved, the message no longer needs the archive file
+    (tmp_path / "session.jsonl").unlink()
+    assert message.data == {"code": CODE}
+    assert message.encoded(blobs, used) is None
+
+
+@pytest.mark.parametrize(
+    "record, error",
+    [
+        ({"type": "shell", "value": "rm -rf /"}, "unknown session archive record"),
+        ({"type": "controller_state", "value": "code"}, "invalid field 'value'"),
+        ({"type": "message", "kind": "USER", "message": "hi", "source": None, "is_error": False}, "'data'"),
+        ({"type": "message", "kind": "ROBOT", "message": "hi", "source": None, "is_error": False, "data": None}, "kind"),
+        ({"type": "message", "kind": "USER", "message": 42, "source": None, "is_error": False, "data": None}, "'message'"),
+    ],
+)
+def test_invalid_records_are_rejected(tmp_path, record, error):
+    archive = SessionArchive(write(tmp_path, [record]))
+    with pytest.raises(ArchiveError, match=error):
+        list(archive.records())
+
+
+def test_archives_without_the_session_state_are_rejected(tmp_path):
+    archive = SessionArchive(write(tmp_path, [{"type": "document", "value": {}}]))
+    with pytest.raises(ArchiveError, match="no controller_state, state_history record"):
+        list(archive.records())
+
+
+def test_files_that_are_not_archives_are_rejected(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("not a session\n")
+    with pytest.raises(ArchiveError):
+        SessionArchive(str(path))
+
+
+def test_the_directory_keeps_valid_archives_only(tmp_path):
+    directory = ArchiveDirectory(str(tmp_path / "archives"))
+    with open(write(tmp_path), "rb") as f:
+        archive = directory.add(f)
+    assert archive.snapshot() == snapshot()
+    with pytest.raises(ArchiveError):
+        directory.add(io.BytesIO(b"{}\n"))
+    directory.remove(archive.path)
+    assert list((tmp_path / "archives").iterdir()) == []
+
+
+def test_the_directory_rejects_archives_over_the_limit(tmp_path):
+    directory = ArchiveDirectory(str(tmp_path / "archives"), max_bytes=1000)
+    with open(write(tmp_path), "rb") as f:
+        with pytest.raises(ArchiveTooLarge):
+            directory.add(f, chunk_size=256)
+    assert list((tmp_path / "archives").iterdir()) == []
@@ -0,0 +1,150 @@
+import threading
+
+import pytest
+
+from python_agent.session_store import SessionManager, SQLiteSessionStore
+
+
+class FakeApp:
+    """Stands in for an AgentApp: a list of messages."""
+
+    def __init__(self):
+        self.messages = []
+
+    def snapshot(self):
+        return {"messages": list(self.messages), "blobs": {}}
+
+    def restore(self, snapshot):
+        self.messages = list(snapshot["messages"])
+
+
+class CountingStore(SQLiteSessionStore):
+    def __init__(self, path):
+        super().__init__(path)
+        self.version_queries = 0
+        self.loads = 0
+
+    def version(self, session_id):
+        self.version_queries += 1
+        return super().version(session_id)
+
+    def load(self, session_id):
+        self.loads += 1
+        return super().load(session_id)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "sessions.db")
+
+
+def manager(store, capacity=64):
+    return SessionManager(store, FakeApp, capacity=capacity, ttl=0)
+
+
+def test_changes_are_saved_and_rehydrated(path):
+    with manager(SQLiteSessionStore(path)).session("a") as app:
+        app.messages.append("hello")
+    with manager(SQLiteSessionStore(path)).session("a") as app:
+        assert app.messages == ["hello"]
+
+
+def test_changes_are_not_saved_when_the_block_raises(path):
+    sessions = manager(SQLiteSessionStore(path))
+    with pytest.raises(RuntimeError):
+        with sessions.session("a") as app:
+            app.messages.append("half done")
+            raise RuntimeError()
+    with sessions.session("a") as app:
+        assert app.messages == []
+
+
+def test_the_version_is_not_queried_while_no_other_process_writes(path):
+    store = CountingStore(path)
+    sessions = manager(store)
+    for i in range(5):
+        with sessions.session("a") as app:
+            app.messages.append(i)
+    with sessions.session("a", save=False) as app:
+        assert app.messages == [0, 1, 2, 3, 4]
+    assert store.version_queries == 1
+    assert store.loads == 1
+
+
+def test_a_session_saved_by_another_process_is_reloaded(path):
+    store = CountingStore(path)
+    sessions = manager(store)
+    with sessions.session("a") as app:
+        app.messages.append("mine")
+    with manager(SQLiteSessionStore(path)).session("a") as other:
+        other.messages.append("theirs")
+    with sessions.session("a") as app:
+        assert app.messages == ["mine", "theirs"]
+    assert store.loads == 2
+
+
+def test_least_recently_used_sessions_are_evicted_with_their_lock(path):
+    store = CountingStore(path)
+    sessions = manager(store, capacity=2)
+    for session_id in ("a", "b", "a", "c"):
+        with sessions.session(session_id):
+            pass
+    assert sessions.peek("a") is not None
+    assert sessions.peek("b") is None
+    assert set(sessions._locks) == {"a", "c"}
+    with sessions.session("b"):
+        pass
+    assert store.loads == 4
+
+
+def test_requests_do_not_wait_for_the_turn_of_their_session(path):
+    sessions = manager(SQLiteSessionStore(path))
+    started, finish = threading.Event(), threading.Event()
+
+    def turn():
+        with sessions.turn("a") as app:
+            started.set()
+            finish.wait(5)
+            app.messages.append("turn")
+
+    thread = threading.Thread(target=turn)
+    thread.start()
+    assert started.wait(5)
+    with sessions.session("a") as app:
+        app.messages.append("posted")
+    assert sessions.peek("a") is app
+    finish.set()
+    thread.join(5)
+
+    with manager(SQLiteSessionStore(path)).session("a") as saved:
+        assert saved.messages == ["posted", "turn"]
+
+
+def test_turns_of_a_session_run_one_at_a_time(path):
+    sessions = manager(SQLiteSessionStore(path))
+    running, overlaps = [], []
+
+    def turn(i):
+        with sessions.turn("a") as app:
+            running.append(i)
+            overlaps.append(len(running))
+            app.messages.append(i)
+            running.remove(i)
+
+    threads = [threading.Thread(target=turn, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert overlaps == [1] * 8
+    with sessions.session("a") as app:
+        assert sorted(app.messages) == list(range(8))
+
+
+def test_expired_sessions_are_deleted(path):
+    store = SQLiteSessionStore(path)
+    with manager(store).session("a"):
+        pass
+    assert store.expire(3600) == []
+    assert store.expire(0) == ["a"]
+    assert store.version("a") is None
@@ -0,0 +1,123 @@
+import pytest
+
+from types import SimpleNamespace
+
+from python_agent.skills import SPLICE_RETRY_MESSAGE, splice_answer
+from python_agent.symbol_index import FocusedView, SpliceError, SymbolIndex
+
+
+def function(i: int) -> str:
+    body = "".join(f"    x = x + {j}\n" for j in range(8))
+    return f'def func_{i}(x):\n    """Function {i}."""\n{body}    return x\n'
+
+
+CODE = (
+    "import math\n\n\n"
+    + "\n\n".join(function(i) for i in range(12))
+    + "\n\nclass Shape:\n"
+    "    def __init__(self, size):\n"
+    "        self.size = size\n"
+    "\n"
+    "    def area(self):\n"
+    "        return self.size ** 2\n"
+    "\n\n"
+    "if __name__ == '__main__':\n"
+    "    print(func_3(1), Shape(2).area())\n"
+)
+
+
+@pytest.fixture
+def view() -> FocusedView:
+    index = SymbolIndex()
+    assert index.update(CODE)
+    view = index.focus("change func_4 and Shape.area")
+    assert view is not None
+    return view
+
+
+def regions(rendered: str) -> str:
+    """The regions section of a rendered view, as an LLM answering with its regions unchanged would."""
+    return rendered[rendered.index("\n# region 1:") + 1 :]
+
+
+def answer(code: str) -> str:
+    return f"Here are the changes.\n```python\n{code}\n```"
+
+
+def test_splicing_unchanged_regions_gives_the_code_back(view):
+    assert view.splice(answer(regions(view.render()))) == CODE
+
+
+def test_splice_replaces_the_edited_region_only(view):
+    edited = regions(view.render()).replace("    x = x + 3\n", "    x = x * 3\n", 1)
+    lines = view.splice(answer(edited)).splitlines()
+    changed = [(line, before) for line, before in zip(lines, CODE.splitlines()) if line != before]
+    assert changed == [("    x = x * 3", "    x = x + 3")]
+    assert lines.index("def func_4(x):") < lines.index("    x = x * 3") < lines.index("def func_5(x):")
+
+
+def test_methods_are_indented_back(view):
+    rendered = view.render()
+    assert "\ndef area(self):\n    return self.size ** 2\n" in rendered
+    edited = regions(rendered).replace("return self.size ** 2", "return self.size * self.size")
+    code = view.splice(answer(edited))
+    assert "    def area(self):\n        return self.size * self.size\n" in code
+    assert code.replace("self.size * self.size", "self.size ** 2") == CODE
+
+
+def test_answer_repeating_the_outline_splices_the_regions_shown_in_full(view):
+    edited = view.render().replace("    x = x + 3\n", "    x = x * 3\n", 1)
+    code = view.splice(answer(edited))
+    assert code is not None
+    assert "# ..." not in code
+    assert code == view.splice(answer(regions(edited)))
+
+
+def test_answer_without_regions_is_not_spliced(view):
+    outline = view.render()[: view.render().index("\n# region 1:")]
+    with pytest.raises(SpliceError, match="no regions"):
+        view.splice(answer(outline))
+    with pytest.raises(SpliceError, match="no regions"):
+        view.splice("I can't help with that.")
+
+
+def test_regions_that_do_not_parse_are_not_spliced(view):
+    broken = regions(view.render()).replace("    return x\n# endregion", "    return (x\n# endregion", 1)
+    with pytest.raises(SpliceError, match="does not parse"):
+        view.splice(answer(broken))
+
+
+def test_new_region_goes_after_the_definitions(view):
+    new = "# region new\ndef func_12(x):\n    return x\n# endregion new"
+    code = view.splice(answer(new))
+    assert code is not None
+    assert code.index("def func_12") > code.index("def area")
+    assert code.index("def func_12") < code.index("if __name__")
+
+
+class ScriptedLLM:
+    """Answers with the next of `answers`, and records the messages of each request."""
+
+    def __init__(self, *answers: str):
+        self.answers = list(answers)
+        self.requests = []
+
+    def post_chat_request(self, messages):
+        self.requests.append(messages)
+        return SimpleNamespace(first_choice=self.answers.pop(0))
+
+
+def test_an_answer_that_cant_be_spliced_is_sent_back_with_the_reason(view):
+    llm = ScriptedLLM("Here is the whole program, rewritten.", answer(regions(view.render())))
+    assert splice_answer(llm, view, ["prompt"], "skill") == CODE
+    assert len(llm.requests) == 2
+    retry = llm.requests[1]
+    assert retry[0] == "prompt"
+    assert retry[1].content == "Here is the whole program, rewritten."
+    assert retry[2].content.startswith(SPLICE_RETRY_MESSAGE.split("{")[0] + "the answer has no regions")
+
+
+def test_the_answer_is_sent_back_once(view):
+    llm = ScriptedLLM("no regions", "still no regions")
+    assert splice_answer(llm, view, ["prompt"], "skill") is None
+    assert len(llm.requests) == 2
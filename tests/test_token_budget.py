@@ -0,0 +1,75 @@
+import pytest
+
+from python_agent.token_budget import TokenAccount, TokenBudgetExceeded, TokenLimits, truncate_to_tokens
+
+
+def words(text: str) -> int:
+    """A token counter counting words."""
+    return len(text.split())
+
+
+def test_unlimited_accounts_have_no_allowance():
+    account = TokenAccount()
+    assert account.remaining_prompt_tokens() is None
+    assert account.check(10_000) is None
+
+
+def test_prompt_tokens_are_limited_per_turn_and_per_session():
+    account = TokenAccount(TokenLimits(max_prompt_tokens=100), TokenLimits(max_prompt_tokens=150))
+    account.record(80, 10)
+    assert account.remaining_prompt_tokens() == 20
+    with pytest.raises(TokenBudgetExceeded):
+        account.check(21)
+    account.start_turn()
+    assert account.remaining_prompt_tokens() == 70
+    account.record(70, 0)
+    assert account.remaining_prompt_tokens() == 0
+    assert account.to_dict()["session"]["prompt_tokens"] == 150
+
+
+def test_the_completion_is_capped_to_what_is_left():
+    account = TokenAccount(TokenLimits(max_completion_tokens=50))
+    assert account.check(1000) == 50
+    account.record(1000, 50)
+    with pytest.raises(TokenBudgetExceeded, match="no completion tokens"):
+        account.check(1)
+
+
+def test_the_cost_limit_counts_the_prompt_of_the_request():
+    account = TokenAccount(
+        session_limits=TokenLimits(max_cost=1.0), prompt_price_per_1k=1.0, completion_price_per_1k=2.0
+    )
+    assert account.remaining_prompt_tokens() == 1000
+    # 500 prompt tokens cost 0.5, leaving 0.5 for 250 completion tokens
+    assert account.check(500) == 250
+    account.record(500, 250)
+    assert account.to_dict()["session"]["cost"] == 1.0
+    with pytest.raises(TokenBudgetExceeded):
+        account.check(1)
+
+
+def test_truncation_estimates_4_characters_per_token():
+    text = "x" * 1000
+    assert truncate_to_tokens(text, 250) == text
+    truncated = truncate_to_tokens(text, 100)
+    assert len(truncated) == 400
+    assert truncated.endswith("[...truncated...]\n")
+    assert truncate_to_tokens(text, 0) == ""
+
+
+def test_truncation_with_a_counter_fits_exactly():
+    text = " ".join(f"line{i}" for i in range(100))
+    truncated = truncate_to_tokens(text, 10, keep_end=True, count_tokens=words)
+    assert words(truncated) <= 10
+    assert truncated.endswith("line99")
+    assert truncated.startswith("\n[...truncated...]\n")
+    # One more word would not fit
+    assert words(truncate_to_tokens(text, 11, keep_end=True, count_tokens=words)) == 11
+
+
+def test_truncation_keeps_the_beginning_by_default():
+    text = " ".join(f"line{i}" for i in range(100))
+    truncated = truncate_to_tokens(text, 5, count_tokens=words)
+    assert truncated.startswith("line0 line1")
+    assert words(truncated) <= 5
+    assert truncate_to_tokens(text, 1000, count_tokens=words) == text